@@ -0,0 +1,89 @@
+import logging
+import math
+import threading
+import time
+import redis
+from cache import LRUCache
+from metrics import REGISTRY
+
+REJECTED = REGISTRY.counter("api_rejected_total", "Requests shed by admission control", ("reason",))
+
+
+class RateLimiter(object):
+    """In-process token buckets per (account, login): `rate` requests per second with bursts up to `burst`.
+
+    rates overrides the rate per account. Buckets live in a bounded LRU, so an idle identity
+    simply starts over with a full bucket. A batch is charged one token per item but never more than
+    `burst`, otherwise one larger than the bucket could never get in.
+    """
+
+    def __init__(self, rate, burst=None, rates=None, max_keys=100000):
+        self.rate = float(rate)
+        self.burst = float(burst or max(rate, 1))
+        self.rates = rates or {}
+        self.buckets = LRUCache(max_keys)
+        self._lock = threading.Lock()
+
+    def limits(self, account):
+        rate = float(self.rates.get(account, self.rate))
+        return rate, max(self.burst, rate) if account in self.rates else self.burst
+
+    def acquire(self, account, login, cost=1):
+        """0 when the request may proceed, otherwise the seconds to wait before retrying"""
+        rate, burst = self.limits(account)
+        if rate <= 0:
+            return 0
+        cost = min(cost, burst)
+        key = (account, login)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                tokens = burst
+            else:
+                tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            if tokens >= cost:
+                self.buckets.set(key, (tokens - cost, now))
+                return 0
+            self.buckets.set(key, (tokens, now))
+        return (cost - tokens) / rate
+
+
+class RedisRateLimiter(RateLimiter):
+    """Limits shared by every process through Redis: fixed windows of burst / rate seconds holding
+    `burst` requests each, counted with INCRBY + EXPIRE. Unavailable or failing storage lets requests through."""
+
+    def __init__(self, store, rate, burst=None, rates=None):
+        super(RedisRateLimiter, self).__init__(rate, burst, rates)
+        self.store = store
+
+    def acquire(self, account, login, cost=1):
+        rate, burst = self.limits(account)
+        if rate <= 0:
+            return 0
+        window = burst / rate
+        now = time.time()
+        index = int(now // window)
+        key = "rl:%s:%s:%s" % (account, login, index)
+        try:
+            count = self.store.incr(key, min(cost, int(burst)), ttl=int(math.ceil(window)) + 1)
+        except redis.exceptions.RedisError as e:
+            # an error reply such as OOM or WRONGTYPE, Store.incr only absorbs unavailable storage
+            logging.warning("Rate limit not counted: %s" % e)
+            count = None
+        if count is None or count <= burst:
+            return 0
+        return (index + 1) * window - now
+
+
+def limit_keys(body):
+    """{(account, login, token): cost} for a method request or a batch of them, read before any validation"""
+    items = body if isinstance(body, list) else [body]
+    keys = {}
+    for item in items:
+        if isinstance(item, dict):
+            token = item.get("token")
+            key = (str(item.get("account") or ""), str(item.get("login") or ""),
+                   token if isinstance(token, str) else None)
+            keys[key] = keys.get(key, 0) + 1
+    return keys
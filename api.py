@@ -1,32 +1,53 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import array
 import json
 import datetime
 import logging
 import hashlib
+import os
+import hmac
+import math
+import select
+import time
 import uuid
 from optparse import OptionParser
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import BaseHTTPRequestHandler
 from six import string_types
-from scoring import get_score, get_interests
-from store import Store
+from scoring import (InterestsCache, get_score, get_interests_many, interests_etag, iter_interests, score_key,
+                     score_flights)
+from store import Store, ShardedStore, PrefetchedStore
+from cache import LRUCache
+from metrics import REGISTRY, REQUESTS, REQUEST_LATENCY, NCLIENTS
+from server import PreforkSupervisor, install_shutdown_handler, make_listener, make_server
+from logs import log_access, setup_logging
+from admission import REJECTED, RateLimiter, RedisRateLimiter, limit_keys
+from profiler import SamplingProfiler, install_dump_handler
+from streaming import StreamedResponse, parse_body
 
 SALT = "Otus"
 ADMIN_LOGIN = "admin"
 ADMIN_SALT = "42"
 OK = 200
+NOT_MODIFIED = 304
 BAD_REQUEST = 400
 FORBIDDEN = 403
 NOT_FOUND = 404
+REQUEST_ENTITY_TOO_LARGE = 413
 INVALID_REQUEST = 422
+TOO_MANY_REQUESTS = 429
 INTERNAL_ERROR = 500
+SERVICE_UNAVAILABLE = 503
 ERRORS = {
     BAD_REQUEST: "Bad Request",
     FORBIDDEN: "Forbidden",
     NOT_FOUND: "Not Found",
+    REQUEST_ENTITY_TOO_LARGE: "Request Entity Too Large",
     INVALID_REQUEST: "Invalid Request",
+    TOO_MANY_REQUESTS: "Too Many Requests",
     INTERNAL_ERROR: "Internal Server Error",
+    SERVICE_UNAVAILABLE: "Service Unavailable",
 }
 UNKNOWN = 0
 MALE = 1
@@ -51,6 +72,11 @@ class Field(object):
     def prepare_value(self, value):
         return value
 
+    def clean(self, value):
+        """Validate and return the prepared value in one step"""
+        self.validate(value)
+        return self.prepare_value(value)
+
 
 class CharField(Field):
     def validate(self, value):
@@ -92,25 +118,28 @@ class PhoneField(Field):
 
 
 class DateField(Field):
-    def validate(self, value):
+    def parse(self, value):
         try:
-            datetime.datetime.strptime(value, '%d.%m.%Y')
+            return datetime.datetime.strptime(value, '%d.%m.%Y')
         except ValueError:
             raise ValueError("Incorect date format, should be DD.MM.YYYY")
 
+    def validate(self, value):
+        self.clean(value)
+
     def prepare_value(self, value):
         return datetime.datetime.strptime(value, '%d.%m.%Y')
 
+    def clean(self, value):
+        return self.parse(value)
+
 
 class BirthDayField(DateField):
-    def validate(self, value):
-        super(BirthDayField, self).validate(value)
-        bdate = datetime.datetime.strptime(value, '%d.%m.%Y')
+    def clean(self, value):
+        bdate = self.parse(value)
         if datetime.datetime.now().year - bdate.year > 70:
             raise ValueError("Incorrect birth day")
-
-    def prepare_value(self, value):
-        return datetime.datetime.strptime(value, '%d.%m.%Y')
+        return bdate
 
 
 class GenderField(Field):
@@ -124,6 +153,11 @@ class GenderField(Field):
 
 class ClientIDsField(Field):
     def validate(self, values):
+        if isinstance(values, array.array) and values.typecode == 'q':
+            # parse_body's compact form of a large id list
+            if values and min(values) < 0:
+                raise ValueError("All elements must be positive integers")
+            return
         if not isinstance(values, list):
             raise ValueError("Invalid data type, must be an array")
         if not all(isinstance(v, int) and v >= 0 for v in values):
@@ -135,48 +169,70 @@ class ClientIDsField(Field):
 
 class DeclarativeFieldsMetaclass(type):
     def __new__(meta, name, bases, attrs):
-        new_class = super(DeclarativeFieldsMetaclass, meta).__new__(meta, name, bases, attrs)
         fields = {}
-        for field_name, field in attrs.items():
+        for field_name, field in list(attrs.items()):
             if isinstance(field, Field):
-                #field._name = field_name
-                fields[field_name] = field
+                # values live in the instance, the field itself is only reachable through `fields`
+                fields[field_name] = attrs.pop(field_name)
+        attrs.setdefault("__slots__", ())
+        new_class = super(DeclarativeFieldsMetaclass, meta).__new__(meta, name, bases, attrs)
         new_class.fields = fields
+        # validation plan compiled once per class instead of walking the fields dict on every request
+        new_class.validation_plan = tuple((field_name, field, field.required, field.nullable, field.empty_values)
+                                          for field_name, field in fields.items())
         return new_class
 
 
 class BaseRequest(object, metaclass=DeclarativeFieldsMetaclass):
+    __slots__ = ("_values", "_errors", "_cleaned")
+
     def __init__(self, **kwargs):
         self._errors = {}
-        self.base_fields = []
-        for field_name, value in kwargs.items():
-            setattr(self, field_name, value)
-            self.base_fields.append(field_name)
+        self._values = kwargs
+        self._cleaned = {}
+
+    def __getattr__(self, name):
+        if name in BaseRequest.__slots__:
+            raise AttributeError(name)
+        try:
+            return self._values[name]
+        except KeyError:
+            pass
+        if name in self.fields:
+            return None
+        raise AttributeError(name)
+
+    @property
+    def base_fields(self):
+        return list(self._values)
 
     def __getitem__(self, name):
         """Return field's value in appropriate format"""
-        if name in self.base_fields:
-            value = getattr(self, str(name), None)
-            field = self.fields[name]
-            return field.prepare_value(value)
+        if name in self._values:
+            if name in self._cleaned:
+                return self._cleaned[name]
+            return self.fields[name].prepare_value(self._values[name])
         else:
             return None
 
     def validate(self):
-        for name, field in self.fields.items():
-            if name not in self.base_fields:
-                if field.required:
-                    self._errors[name] = "This field is required"
+        values = self._values
+        errors = self._errors
+        cleaned = self._cleaned
+        for name, field, required, nullable, empty_values in self.validation_plan:
+            if name not in values:
+                if required:
+                    errors[name] = "This field is required"
                 continue
 
-            value = getattr(self, name)
-            if value in field.empty_values and not field.nullable:
-                self._errors[name] = "This field can't be blank"
+            value = values[name]
+            if not nullable and value in empty_values:
+                errors[name] = "This field can't be blank"
 
             try:
-                field.validate(value)
+                cleaned[name] = field.clean(value)
             except ValueError as e:
-                self._errors[name] = e
+                errors[name] = e
 
     @property
     def errors(self):
@@ -202,9 +258,10 @@ class OnlineScoreRequest(BaseRequest):
     def validate(self):
         super(OnlineScoreRequest, self).validate()
         if not self._errors:
-            if not (("phone" in self.base_fields and "email" in self.base_fields) or
-                    ("first_name" in self.base_fields and "last_name" in self.base_fields) or
-                    ("gender" in self.base_fields and "birthday" in self.base_fields)):
+            values = self._values
+            if not (("phone" in values and "email" in values) or
+                    ("first_name" in values and "last_name" in values) or
+                    ("gender" in values and "birthday" in values)):
                 self._errors["arguments"] = "No valid arguments pair"
 
 
@@ -220,25 +277,71 @@ class MethodRequest(BaseRequest):
         return self.login == ADMIN_LOGIN
 
 
-def check_auth(request):
-    if request.login == ADMIN_LOGIN:
-        key = datetime.datetime.now().strftime("%Y%m%d%H") + ADMIN_SALT
-        digest = hashlib.sha512(key.encode('utf-8')).hexdigest()
-    else:
-        key = request.account + request.login + SALT
-        digest = hashlib.sha512(key.encode('utf-8')).hexdigest()
-    if digest == request.token:
-        return True
-    return False
+class TokenVerifier(object):
+    """Memoizes token digests: a bounded cache of verified (account, login) pairs and one admin digest per hour"""
+
+    def __init__(self, maxsize=1024, admin_grace=60):
+        self.digests = LRUCache(maxsize)
+        self.admin_grace = admin_grace
+        self.failures = 0
+        self._admin_hour = None
+        self._admin_digests = ()
+
+    def admin_digests(self, now):
+        hour = (now.year, now.month, now.day, now.hour)
+        if hour != self._admin_hour:
+            previous = now - datetime.timedelta(hours=1)
+            self._admin_digests = (self.admin_digest(now), self.admin_digest(previous))
+            self._admin_hour = hour
+        if now.minute * 60 + now.second < self.admin_grace:
+            # tokens issued just before the hour changed stay valid for the grace window
+            return self._admin_digests
+        return self._admin_digests[:1]
+
+    def admin_digest(self, moment):
+        key = moment.strftime("%Y%m%d%H") + ADMIN_SALT
+        return hashlib.sha512(key.encode('utf-8')).hexdigest().encode('ascii')
+
+    def user_digest(self, account, login):
+        key = account + login + SALT
+        return hashlib.sha512(key.encode('utf-8')).hexdigest().encode('ascii')
+
+    def matches(self, account, login, token):
+        """The comparison alone: verify() counts failures, callers peeking ahead of it use this.
+        Only digests that matched a token are cached, so made-up logins can't evict partners' entries."""
+        if login == ADMIN_LOGIN:
+            expected, verified = self.admin_digests(datetime.datetime.now()), True
+        else:
+            digest = self.digests.get((account, login))
+            verified = digest is not None
+            expected = (digest if verified else self.user_digest(account, login),)
+        if isinstance(token, string_types):
+            token = token.encode('utf-8')
+            for digest in expected:
+                if hmac.compare_digest(digest, token):
+                    if not verified:
+                        self.digests.set((account, login), digest)
+                    return True
+        return False
 
+    def verify(self, request):
+        if self.matches(request.account, request.login, request.token):
+            return True
+        self.failures += 1
+        return False
 
-def online_score_handler(request, ctx, store):
-    r = OnlineScoreRequest(**request.arguments)
-    r.validate()
+    def stats(self):
+        return {"hits": self.digests.hits, "misses": self.digests.misses, "failures": self.failures}
+
+
+token_verifier = TokenVerifier()
+
+
+def check_auth(request):
+    return token_verifier.verify(request)
 
-    if not r.is_valid():
-        return r.errors, INVALID_REQUEST
 
+def online_score_handler(request, r, ctx, store):
     ctx['has'] = r.base_fields
     if request.is_admin:
         return {"score": 42}, OK
@@ -248,79 +351,427 @@ def online_score_handler(request, ctx, store):
         return {"score": score}, OK
 
 
-def clients_interests_handler(request, ctx, store):
-    r = ClientsInterestsRequest(**request.arguments)
-    r.validate()
-    if not r.is_valid():
-        return r.errors, INVALID_REQUEST
-
-    response = {}
-    for cid in r.client_ids:
-        response[cid] = get_interests(store, cid)
+def clients_interests_handler(request, r, ctx, store):
     ctx["nclients"] = len(r.client_ids)
-
+    NCLIENTS.observe(ctx["nclients"])
+    stream_min_clients = MainHTTPHandler.stream_min_clients
+    if stream_min_clients and ctx["nclients"] >= stream_min_clients and not ctx.get("batch"):
+        # fetched and written batch by batch, so neither cached nor given an ETag; each batch gets the whole
+        # request_budget, writing earlier ones to a slow client would use up a shared one
+        ctx["streamed"] = True
+        # the first batch is fetched before any header goes out, so a storage failure is still a plain 500
+        batches = iter_interests(store, r.client_ids, batch_budget=MainHTTPHandler.request_budget)
+        return StreamedResponse(batches).start(), OK
+    interests_cache = MainHTTPHandler.interests_cache
+    # batch_handler passes on the hit it found while choosing keys to prefetch
+    cached = ctx.get("cached_interests")
+    if cached is None and interests_cache is not None:
+        cached = interests_cache.get(r.client_ids)
+    if cached is None:
+        seq = interests_cache.sequence() if interests_cache is not None else None
+        response = get_interests_many(store, r.client_ids)
+        cached = (response, interests_etag(response))
+        if interests_cache is not None:
+            interests_cache.set(r.client_ids, cached, seq)
+    response, ctx["etag"] = cached
     return response, OK
 
 
-def method_handler(request, ctx, store):
-    handlers = {"online_score": online_score_handler,
-                "clients_interests": clients_interests_handler}
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates or "W/" + etag in candidates
+
+
+def apply_etag(context, code, if_none_match, headers):
+    """Add the response's ETag to headers, return the code with a matching If-None-Match turned into 304"""
+    etag = context.get("etag")
+    if etag is not None and code == OK:
+        headers.append(("ETag", etag))
+        if etag_matches(if_none_match, etag):
+            code = context["code"] = NOT_MODIFIED
+    return code
+
 
-    method_request = MethodRequest(**request["body"])
+METHODS = {
+    "online_score": online_score_handler,
+    "clients_interests": clients_interests_handler,
+}
+ARGUMENTS = {
+    "online_score": OnlineScoreRequest,
+    "clients_interests": ClientsInterestsRequest,
+}
+
+
+def method_arguments(method_request):
+    """The method's arguments request, validated once for whoever runs the method"""
+    r = ARGUMENTS[method_request.method](**method_request.arguments)
+    r.validate()
+    return r
+
+
+def prepare_method(body, ctx, auth=None):
+    """Everything before a method runs, shared by /method, /batch and async_api: validation, auth and the
+    arguments. (method_request, arguments, None, None) when the method may run, otherwise
+    (None, None, response, code) to answer with. `auth` memoizes check_auth by credentials."""
+    method_request = MethodRequest(**body)
     method_request.validate()
 
     if not method_request.is_valid():
-        return method_request.errors, INVALID_REQUEST
-
-    if not check_auth(method_request):
-        return ERRORS[FORBIDDEN], FORBIDDEN
+        return None, None, method_request.errors, INVALID_REQUEST
+
+    if auth is None:
+        auth = {}
+    credentials = (method_request.account, method_request.login, method_request.token)
+    if credentials not in auth:
+        auth[credentials] = check_auth(method_request)
+    if not auth[credentials]:
+        return None, None, ERRORS[FORBIDDEN], FORBIDDEN
+
+    if method_request.method in METHODS:
+        ctx["method"] = method_request.method
+    r = method_arguments(method_request)
+    if not r.is_valid():
+        return None, None, r.errors, INVALID_REQUEST
+    return method_request, r, None, None
 
-    response, code = handlers[method_request.method](method_request, ctx, store)
 
-    return response, code
+def method_handler(request, ctx, store):
+    method_request, r, response, code = prepare_method(request["body"], ctx)
+    if method_request is None:
+        return response, code
+    return METHODS[method_request.method](method_request, r, ctx, store)
+
+
+def batch_handler(request, ctx, store):
+    items = request["body"]
+    if not isinstance(items, list):
+        return "Batch must be an array of method requests", INVALID_REQUEST
+
+    auth = {}
+    prepared = []
+    # store keys the items will read, so the whole batch fetches them in one round trip per kind
+    score_keys, interests_keys = [], []
+    # response cache hits by item index, their keys aren't fetched at all
+    cached_interests = {}
+    interests_cache = MainHTTPHandler.interests_cache
+    for body in items:
+        if not isinstance(body, dict):
+            prepared.append((None, None, "Batch item must be a method request object", INVALID_REQUEST))
+            continue
+        try:
+            item = prepare_method(body, {}, auth)
+            prepared.append(item)
+            method_request, r = item[:2]
+            if method_request is None:
+                continue
+            if method_request.method == "clients_interests":
+                cached = interests_cache.get(r.client_ids) if interests_cache is not None else None
+                if cached is not None:
+                    cached_interests[len(prepared) - 1] = cached
+                else:
+                    interests_keys.extend("i:%s" % cid for cid in r.client_ids)
+            elif not method_request.is_admin:
+                score_keys.append(score_key(r['first_name'], r['last_name'], r['birthday']))
+        except Exception as e:
+            logging.exception("Unexpected error: %s" % e)
+            prepared.append((None, None, None, INTERNAL_ERROR))
+
+    values = {}
+    # scores go through cache_get_many, which serves what it can from the local cache
+    for fetch, keys in ((store.cache_get_many, score_keys), (store.get_many, interests_keys)):
+        if keys:
+            unique = list(dict.fromkeys(keys))
+            try:
+                values.update(zip(unique, fetch(unique)))
+            except Exception as e:
+                # items fall back to fetching their own keys
+                logging.exception("Batch prefetch failed: %s" % e)
+    prefetched = PrefetchedStore(store, values)
+
+    results = []
+    for i, (method_request, r, response, code) in enumerate(prepared):
+        if method_request is not None:
+            item_ctx = {"batch": True}
+            if i in cached_interests:
+                item_ctx["cached_interests"] = cached_interests[i]
+            try:
+                response, code = METHODS[method_request.method](method_request, r, item_ctx, prefetched)
+            except Exception as e:
+                logging.exception("Unexpected error: %s" % e)
+                response, code = None, INTERNAL_ERROR
+        results.append(format_response(response, code))
+    ctx["nitems"] = len(items)
+
+    return results, OK
+
+
+REGISTRY.gauge("store_pool_connections", "Redis pool connections by state",
+               lambda: {(state,): MainHTTPHandler.store.pool_stats()[state] for state in ("in_use", "idle")},
+               ("state",))
+REGISTRY.gauge("store_pool_waits", "Times a caller found the Redis pool exhausted",
+               lambda: MainHTTPHandler.store.pool_stats()["waits"])
+REGISTRY.gauge("store_local_cache", "In-process score cache counters",
+               lambda: {(name,): value for name, value in MainHTTPHandler.store.local_cache_stats().items()},
+               ("stat",))
+REGISTRY.gauge("store_circuit_open", "Redis nodes whose circuit breaker rejects calls",
+               lambda: MainHTTPHandler.store.open_circuits())
+REGISTRY.gauge("auth_token_cache", "check_auth digest cache counters",
+               lambda: {(name,): value for name, value in token_verifier.stats().items()}, ("stat",))
+REGISTRY.gauge("store_write_behind_depth", "Cache writes waiting in the write-behind queue",
+               lambda: MainHTTPHandler.store.write_behind_depth())
+REGISTRY.gauge("interests_response_cache", "clients_interests response cache counters",
+               lambda: {(name,): value for name, value in MainHTTPHandler.interests_cache.stats().items()}
+               if MainHTTPHandler.interests_cache is not None else {}, ("stat",))
+REGISTRY.gauge("score_singleflight_inflight", "Score computations currently in flight",
+               lambda: len(score_flights))
+
+
+def format_response(response, code):
+    if code not in ERRORS:
+        return {"response": response, "code": code}
+    if isinstance(response, dict):
+        # field validation keeps the raised ValueError, its message is what the client gets
+        response = {name: str(error) if isinstance(error, Exception) else error for name, error in response.items()}
+    return {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
+
+
+def finish_request(context, path, route, code, duration, log_sample_rate):
+    """Access log line and request metrics, the same for every server; route is the handled path or None"""
+    context["path"] = path
+    context["duration_ms"] = round(duration * 1000, 3)
+    log_access(context, code, log_sample_rate)
+    labels = (context.get("method") or route or "unknown", code)
+    REQUESTS.inc(labels)
+    REQUEST_LATENCY.observe(duration, labels)
+
+
+def metrics_handler(store):
+    return REGISTRY.render(), "text/plain; version=0.0.4; charset=utf-8", OK
+
+
+def parse_nodes(specs):
+    """["host:port,replica:port", ...] -> (primaries, {primary: [replicas]})"""
+    nodes, replicas = [], {}
+    for spec in specs:
+        primary, *rest = [part.strip() for part in spec.split(",") if part.strip()]
+        nodes.append(primary)
+        if rest:
+            replicas[primary] = rest
+    return nodes, replicas
 
 
 class MainHTTPHandler(BaseHTTPRequestHandler):
     router = {
-        "method": method_handler
+        "method": method_handler,
+        "batch": batch_handler,
+    }
+    get_router = {
+        "metrics": metrics_handler,
     }
     store = Store()
+    # seconds a request may spend on storage calls, retries included; no call starts past it,
+    # but one in flight can still take up to the Redis socket timeout
+    request_budget = 3.0
+    # persistent connections: an idle connection is closed after `timeout` seconds, or as soon as a new
+    # connection waits for a worker (checked every keepalive_poll_interval), any connection after
+    # max_keepalive_requests responses
+    protocol_version = "HTTP/1.1"
+    timeout = 15
+    keepalive_poll_interval = 0.05
+    max_keepalive_requests = 1000
+    # share of successful requests written to the access log, errors are always logged
+    log_sample_rate = 1.0
+    # opt-in SamplingProfiler, None costs a single attribute check per request
+    profiler = None
+    # RateLimiter or RedisRateLimiter keyed by account/login, None disables rate limiting
+    rate_limiter = None
+    # InterestsCache of recent clients_interests results, None disables it
+    interests_cache = None
+    # clients_interests requests with at least this many ids get a streamed response, 0 disables streaming
+    stream_min_clients = 10000
+    # larger bodies are refused with 413 without being read
+    max_body_size = 10 * 1024 * 1024
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.requests_handled = 0
+
+    def keep_alive_allowed(self):
+        """Only a pooled server can hold connections open, and only while no new connection waits for a worker"""
+        busy = getattr(self.server, "busy", None)
+        return busy is not None and not busy() and self.requests_handled < self.max_keepalive_requests
+
+    def handle(self):
+        self.handle_one_request()
+        while not self.close_connection and self.wait_for_request():
+            self.handle_one_request()
+
+    def wait_for_request(self):
+        """Wait for the next request on a kept-alive connection without blocking in readline(), so an idle
+        client gives its worker up the moment another connection queues for one or the server stops"""
+        deadline = time.monotonic() + self.timeout
+        busy = getattr(self.server, "busy", None)
+        while not self.request_buffered():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or (busy is not None and busy()):
+                return False
+            readable, _, _ = select.select([self.connection], [], [], min(remaining, self.keepalive_poll_interval))
+            if readable:
+                return True
+        return True
+
+    def request_buffered(self):
+        """True if a pipelined request is already in rfile's buffer, checked with a non-blocking peek"""
+        self.connection.settimeout(0.0)
+        try:
+            return bool(self.rfile.peek(1))
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def send_body(self, code, content_type, body, close=False, headers=()):
+        self.requests_handled += 1
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        if code != NOT_MODIFIED:
+            # a 304 has no body, and a Content-Length would have to match the 200's body (RFC 9110 8.6)
+            self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        if close or self.close_connection or not self.keep_alive_allowed():
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_chunks(self, code, content_type, chunks, headers=()):
+        """Write a body of unknown length as it is produced: chunked for HTTP/1.1, delimited by close otherwise.
+        A failure midway cuts the response short, the status line is already out."""
+        self.requests_handled += 1
+        chunked = self.request_version == "HTTP/1.1"
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        for name, value in headers:
+            self.send_header(name, value)
+        if not chunked or self.close_connection or not self.keep_alive_allowed():
+            self.send_header("Connection", "close")
+        self.end_headers()
+        try:
+            for chunk in chunks:
+                if chunk:
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk) if chunked else chunk)
+        except Exception as e:
+            logging.exception("Streamed response aborted: %s" % e)
+            self.close_connection = True
+            return False
+        if chunked:
+            self.wfile.write(b"0\r\n\r\n")
+        return True
+
+    def log_request(self, code='-', size='-'):
+        # handled requests are covered by the access log written from do_POST
+        pass
+
+    def log_message(self, format, *args):
+        # protocol errors and timeouts, through logging instead of a blocking write to stderr
+        logging.warning("%s - %s" % (self.address_string(), format % args))
+
+    def rate_limited(self, body):
+        """Seconds to wait if any account/login in the request is over its limit, checked before validation.
+
+        Only identities whose token checks out are charged, so requests with a forged token can't spend
+        a partner's budget; they fail auth anyway, at the cost of a memoized digest comparison.
+        """
+        for (account, login, token), cost in limit_keys(body).items():
+            # not counted as an auth failure here, method_handler does that once per request
+            if not token_verifier.matches(account, login, token):
+                continue
+            retry_after = self.rate_limiter.acquire(account, login, cost)
+            if retry_after:
+                REJECTED.inc(("rate_limited",))
+                return retry_after
+        return 0
 
     def get_request_id(self, headers):
         return headers.get('HTTP_X_REQUEST_ID', uuid.uuid4().hex)
 
+    def do_GET(self):
+        path = self.path.strip("/")
+        if path in self.get_router:
+            body, content_type, code = self.get_router[path](self.store)
+        else:
+            body, content_type, code = json.dumps(format_response(None, NOT_FOUND)), "application/json", NOT_FOUND
+        self.send_body(code, content_type, body.encode('utf-8'))
+
     def do_POST(self):
+        started = time.perf_counter()
         response, code = {}, OK
         context = {"request_id": self.get_request_id(self.headers)}
         request = None
+        path = None
         try:
-            data_string = self.rfile.read(int(self.headers['Content-Length']))
-            request = json.loads(data_string)
+            length = int(self.headers['Content-Length'])
+            if length < 0:
+                # read(-1) would read to EOF, past the size limit
+                code = BAD_REQUEST
+            elif length > self.max_body_size:
+                code = REQUEST_ENTITY_TOO_LARGE
+            else:
+                request = parse_body(self.rfile.read(length))
         except:
             code = BAD_REQUEST
 
-        if request:
+        retry_after = 0
+        if request and self.rate_limiter is not None:
+            retry_after = self.rate_limited(request)
+        if retry_after:
+            code = TOO_MANY_REQUESTS
+        elif request or (request == [] and self.path.strip("/") == "batch"):
+            # an empty batch still gets its empty array of results
             path = self.path.strip("/")
-            logging.info("%s: %s %s" % (self.path, data_string, context["request_id"]))
             if path in self.router:
+                store = self.store
+                if self.request_budget:
+                    store = store.with_deadline(time.monotonic() + self.request_budget)
+                profiled = self.profiler is not None and self.profiler.wants(self.headers)
+                if profiled:
+                    self.profiler.begin(context, path)
                 try:
-                    response, code = self.router[path]({"body": request, "headers": self.headers}, context, self.store)
+                    response, code = self.router[path]({"body": request, "headers": self.headers}, context, store)
                 except Exception as e:
                     logging.exception("Unexpected error: %s" % e)
                     code = INTERNAL_ERROR
+                finally:
+                    if profiled:
+                        self.profiler.end()
             else:
                 code = NOT_FOUND
 
-        self.send_response(code)
-        self.send_header("Content-Type", "application/json")
-        self.end_headers()
-        if code not in ERRORS:
-            r = {"response": response, "code": code}
-        else:
-            r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
+        r = format_response(response, code)
         context.update(r)
-        logging.info(context)
-        self.wfile.write(json.dumps(r).encode('utf-8'))
+        headers = []
+        if retry_after:
+            headers.append(("Retry-After", str(int(math.ceil(retry_after)))))
+        code = apply_etag(context, code, self.headers.get("If-None-Match"), headers)
+        if isinstance(response, StreamedResponse) and code == OK:
+            if not self.send_chunks(code, "application/json", response.chunks(code), headers=headers):
+                code = context["code"] = INTERNAL_ERROR
+        else:
+            try:
+                body = b"" if code == NOT_MODIFIED else json.dumps(r).encode('utf-8')
+            except Exception as e:
+                logging.exception("Unserializable response: %s" % e)
+                code, headers = INTERNAL_ERROR, []
+                r = format_response(None, code)
+                context.update(r)
+                body = json.dumps(r).encode('utf-8')
+            # after an unreadable body the stream position is unknown, so the connection can't be reused
+            self.send_body(code, "application/json", body, close=request is None, headers=headers)
+        finish_request(context, self.path, path if path in self.router else None, code,
+                       time.perf_counter() - started, self.log_sample_rate)
         return
 
 
@@ -328,13 +779,104 @@ if __name__ == "__main__":
     op = OptionParser()
     op.add_option("-p", "--port", action="store", type=int, default=8080)
     op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("--redis-host", action="store", default="localhost")
+    op.add_option("--redis-port", action="store", type=int, default=6379)
+    op.add_option("--redis-node", action="append", default=[],
+                  help="shard as host:port[,replica_host:replica_port...], repeat for every shard")
+    op.add_option("--pool-size", action="store", type=int, default=50)
+    op.add_option("-w", "--workers", action="store", type=int, default=0)
+    op.add_option("--request-budget", action="store", type=float, default=3.0,
+                  help="seconds for storage calls per request; no attempt starts later, a running one may "
+                       "still take up to the Redis socket timeout")
+    op.add_option("--local-cache-size", action="store", type=int, default=0)
+    op.add_option("--local-cache-ttl", action="store", type=int, default=60)
+    op.add_option("--processes", action="store", type=int, default=0)
+    op.add_option("--write-behind-size", action="store", type=int, default=10000)
+    op.add_option("--keepalive-timeout", action="store", type=float, default=15)
+    op.add_option("--keepalive-requests", action="store", type=int, default=1000)
+    op.add_option("--log-sample-rate", action="store", type=float, default=1.0)
+    op.add_option("--interests-cache-size", action="store", type=int, default=0,
+                  help="cached clients_interests results, 0 disables the cache")
+    op.add_option("--interests-cache-ttl", action="store", type=float, default=5)
+    op.add_option("--max-body-size", action="store", type=int, default=MainHTTPHandler.max_body_size,
+                  help="largest accepted request body in bytes, larger ones get 413")
+    op.add_option("--stream-min-clients", action="store", type=int, default=MainHTTPHandler.stream_min_clients,
+                  help="stream clients_interests responses with at least this many ids, 0 disables")
+    op.add_option("--max-inflight", action="store", type=int, default=0,
+                  help="requests served or waiting for a worker, the excess gets 503 (needs --workers)")
+    op.add_option("--rate-limit", action="store", type=float, default=0,
+                  help="requests per second per account/login, 0 disables")
+    op.add_option("--rate-burst", action="store", type=float, default=None)
+    op.add_option("--account-rate-limit", action="append", default=[], help="account=rate override, repeatable")
+    op.add_option("--shared-rate-limit", action="store_true", default=False,
+                  help="count rate limits in Redis, shared by all processes")
+    op.add_option("--profile-rate", action="store", type=float, default=0.0,
+                  help="share of requests to profile")
+    op.add_option("--profile-token", action="store", default=os.environ.get("API_PROFILE_TOKEN"),
+                  help="profile requests sending this value in X-Debug-Profile, API_PROFILE_TOKEN by default")
+    op.add_option("--profile-output", action="store", default="profile.collapsed")
+    op.add_option("--profile-interval", action="store", type=float, default=None,
+                  help="dump the profile every N seconds, otherwise on SIGUSR2")
     (opts, args) = op.parse_args()
-    logging.basicConfig(filename=opts.log, level=logging.INFO,
-                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
-    server = HTTPServer(("localhost", opts.port), MainHTTPHandler)
-    logging.info("Starting server at %s" % opts.port)
+    log_listener = setup_logging(opts.log)
+
+    def serve(ready=None):
+        # runs after fork in pre-fork mode, so every process gets its own connection pool and log writer thread
+        listener = setup_logging(opts.log) if opts.processes else None
+        store_options = dict(max_connections=opts.pool_size, local_cache_size=opts.local_cache_size,
+                             local_cache_ttl=opts.local_cache_ttl, write_behind_size=opts.write_behind_size)
+        if opts.redis_node:
+            nodes, replicas = parse_nodes(opts.redis_node)
+            MainHTTPHandler.store = ShardedStore(nodes, replicas, **store_options)
+        else:
+            MainHTTPHandler.store = Store(host=opts.redis_host, port=opts.redis_port, **store_options)
+        MainHTTPHandler.max_body_size = opts.max_body_size
+        MainHTTPHandler.stream_min_clients = opts.stream_min_clients
+        if opts.interests_cache_size:
+            MainHTTPHandler.interests_cache = InterestsCache(opts.interests_cache_size, opts.interests_cache_ttl)
+            MainHTTPHandler.store.add_set_listener(MainHTTPHandler.interests_cache.invalidate)
+        MainHTTPHandler.request_budget = opts.request_budget
+        MainHTTPHandler.timeout = opts.keepalive_timeout
+        MainHTTPHandler.max_keepalive_requests = opts.keepalive_requests
+        MainHTTPHandler.log_sample_rate = opts.log_sample_rate
+        if opts.rate_limit or opts.account_rate_limit:
+            rates = dict((account, float(rate)) for account, _, rate in
+                         (item.rpartition("=") for item in opts.account_rate_limit))
+            if opts.shared_rate_limit:
+                MainHTTPHandler.rate_limiter = RedisRateLimiter(MainHTTPHandler.store, opts.rate_limit,
+                                                                opts.rate_burst, rates)
+            else:
+                MainHTTPHandler.rate_limiter = RateLimiter(opts.rate_limit, opts.rate_burst, rates)
+        if opts.profile_rate or opts.profile_token:
+            output = "%s.%s" % (opts.profile_output, os.getpid()) if opts.processes else opts.profile_output
+            MainHTTPHandler.profiler = SamplingProfiler(opts.profile_rate, opts.profile_token, output=output,
+                                                        dump_interval=opts.profile_interval)
+            install_dump_handler(MainHTTPHandler.profiler)
+        server = make_server(("localhost", opts.port), MainHTTPHandler, workers=opts.workers,
+                             max_inflight=opts.max_inflight, sock=listen_socket)
+        install_shutdown_handler(server)
+        logging.info("Starting server at %s" % opts.port)
+        if ready is not None:
+            ready()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+        # flushes queued cache writes
+        MainHTTPHandler.store.close()
+        if MainHTTPHandler.profiler is not None:
+            MainHTTPHandler.profiler.stop()
+            MainHTTPHandler.profiler.dump()
+        if listener is not None:
+            listener.stop()
+
+    # bound once before forking, workers inherit it and a reload never drops queued connections
+    listen_socket = make_listener(("localhost", opts.port)) if opts.processes else None
     try:
-        server.serve_forever()
-    except KeyboardInterrupt:
-        pass
-    server.server_close()
+        if opts.processes:
+            PreforkSupervisor(serve, opts.processes).run()
+        else:
+            serve()
+    finally:
+        log_listener.stop()
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import json
+import logging
+import signal
+import time
+import uuid
+from http.client import HTTPMessage
+from http.server import BaseHTTPRequestHandler
+from optparse import OptionParser
+from api import (OK, NOT_MODIFIED, BAD_REQUEST, NOT_FOUND, REQUEST_ENTITY_TOO_LARGE, INTERNAL_ERROR,
+                 MainHTTPHandler, apply_etag, finish_request, format_response, metrics_handler, prepare_method)
+from metrics import NCLIENTS
+from scoring import get_score_async, get_interests_many_async, interests_etag
+from store import AsyncStore
+from logs import setup_logging
+from streaming import parse_body
+
+NOT_IMPLEMENTED = 501
+
+
+async def online_score_handler(request, r, ctx, store):
+    ctx['has'] = r.base_fields
+    if request.is_admin:
+        return {"score": 42}, OK
+    else:
+        score = await get_score_async(store, r['phone'], r['email'], birthday=r['birthday'], gender=r['gender'],
+                                      first_name=r['first_name'], last_name=r['last_name'])
+        return {"score": score}, OK
+
+
+async def clients_interests_handler(request, r, ctx, store):
+    ctx["nclients"] = len(r.client_ids)
+    NCLIENTS.observe(ctx["nclients"])
+    response = await get_interests_many_async(store, r.client_ids)
+    ctx["etag"] = interests_etag(response)
+    return response, OK
+
+
+# coroutine counterparts of api.METHODS, everything before them runs through api.prepare_method
+METHODS = {
+    "online_score": online_score_handler,
+    "clients_interests": clients_interests_handler,
+}
+
+
+async def method_handler(request, ctx, store):
+    method_request, r, response, code = prepare_method(request["body"], ctx)
+    if method_request is None:
+        return response, code
+    return await METHODS[method_request.method](method_request, r, ctx, store)
+
+
+class AsyncHTTPServer(object):
+    """Minimal HTTP/1.1 server with keep-alive: POST /method and GET /metrics. /batch is served
+    by MainHTTPHandler only, other methods get 501."""
+    router = {
+        "method": method_handler
+    }
+    get_router = {
+        "metrics": metrics_handler,
+    }
+
+    def __init__(self, store, idle_timeout=75, stop_timeout=30, log_sample_rate=1.0,
+                 max_body_size=MainHTTPHandler.max_body_size, request_budget=None):
+        self.store = store
+        # seconds a request may spend on storage calls, as MainHTTPHandler.request_budget; None for no limit
+        self.request_budget = request_budget
+        self.max_body_size = max_body_size
+        self.idle_timeout = idle_timeout
+        self.log_sample_rate = log_sample_rate
+        self.stop_timeout = stop_timeout
+        self.server = None
+        self.closing = False
+        self._connections = {}
+
+    async def start(self, host, port):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server
+
+    async def stop(self):
+        """Stop accepting, close idle keep-alive connections and wait for in-flight requests"""
+        self.closing = True
+        self.server.close()
+        for writer, busy in list(self._connections.items()):
+            if not busy:
+                writer.close()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.stop_timeout
+        while any(self._connections.values()) and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        await self.server.wait_closed()
+        await self.store.close()
+
+    async def handle(self, reader, writer):
+        self._connections[writer] = False
+        try:
+            while not self.closing:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line:
+                    break
+                self._connections[writer] = True
+                keep_alive = await self.handle_one_request(request_line, reader, writer)
+                self._connections[writer] = False
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._connections.pop(writer, None)
+            writer.close()
+
+    async def handle_one_request(self, request_line, reader, writer):
+        try:
+            command, path, version = request_line.decode('latin-1').split()
+        except ValueError:
+            await self.send(writer, BAD_REQUEST, format_response(None, BAD_REQUEST), False)
+            return False
+        headers = HTTPMessage()
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode('latin-1').partition(":")
+            headers[name.strip()] = value.strip()
+
+        connection = headers.get("Connection", "").lower()
+        keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+        try:
+            length = int(headers.get("Content-Length") or 0)
+            if length < 0:
+                raise ValueError("Negative Content-Length")
+        except ValueError:
+            await self.send(writer, BAD_REQUEST, format_response(None, BAD_REQUEST), False)
+            return False
+        if length > self.max_body_size:
+            code = REQUEST_ENTITY_TOO_LARGE
+            await self.send(writer, code, format_response(None, code), False)
+            return False
+        body = await reader.readexactly(length)
+
+        if command == "GET":
+            route = path.strip("/")
+            if route in self.get_router:
+                body, content_type, code = self.get_router[route](self.store)
+                await self.send_body(writer, code, content_type, body.encode('utf-8'), keep_alive and not self.closing)
+                return keep_alive
+            code = NOT_FOUND
+            r, response_headers = format_response(None, code), ()
+        elif command != "POST":
+            code = NOT_IMPLEMENTED
+            r, response_headers = {"error": "Unsupported method (%r)" % command, "code": code}, ()
+        else:
+            code, r, response_headers = await self.process(path, headers, body)
+        await self.send(writer, code, r, keep_alive and not self.closing, response_headers)
+        return keep_alive
+
+    async def process(self, path, headers, data_string):
+        """(code, response document, extra headers) for a POST, logged and counted like MainHTTPHandler's"""
+        started = time.perf_counter()
+        response, code = {}, OK
+        context = {"request_id": headers.get('HTTP_X_REQUEST_ID', uuid.uuid4().hex)}
+        request = None
+        route = None
+        try:
+            request = parse_body(data_string)
+        except:
+            code = BAD_REQUEST
+
+        if request:
+            route = path.strip("/")
+            if route in self.router:
+                store = self.store
+                if self.request_budget:
+                    store = store.with_deadline(time.monotonic() + self.request_budget)
+                try:
+                    response, code = await self.router[route]({"body": request, "headers": headers}, context, store)
+                except Exception as e:
+                    logging.exception("Unexpected error: %s" % e)
+                    code = INTERNAL_ERROR
+            else:
+                code = NOT_FOUND
+                route = None
+
+        r = format_response(response, code)
+        context.update(r)
+        response_headers = []
+        code = apply_etag(context, code, headers.get("If-None-Match"), response_headers)
+        finish_request(context, path, route, code, time.perf_counter() - started, self.log_sample_rate)
+        return code, r, response_headers
+
+    async def send(self, writer, code, r, keep_alive, headers=()):
+        body = b"" if code == NOT_MODIFIED else json.dumps(r).encode('utf-8')
+        await self.send_body(writer, code, "application/json", body, keep_alive, headers)
+
+    async def send_body(self, writer, code, content_type, body, keep_alive, headers=()):
+        # a 304 goes out without body or Content-Length, as from MainHTTPHandler.send_body
+        reason = BaseHTTPRequestHandler.responses.get(code, ("",))[0]
+        lines = ["HTTP/1.1 %s %s" % (code, reason), "Content-Type: %s" % content_type]
+        if code != NOT_MODIFIED:
+            lines.append("Content-Length: %s" % len(body))
+        lines.extend("%s: %s" % (name, value) for name, value in headers)
+        lines.append("Connection: %s" % ("keep-alive" if keep_alive else "close"))
+        head = "\r\n".join(lines) + "\r\n\r\n"
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
+
+
+async def serve(opts):
+    store = AsyncStore(opts.redis_host, opts.redis_port, max_connections=opts.pool_size)
+    # the storage gauges of /metrics read the serving store from MainHTTPHandler
+    MainHTTPHandler.store = store
+    server = AsyncHTTPServer(store, idle_timeout=opts.idle_timeout, log_sample_rate=opts.log_sample_rate,
+                             max_body_size=opts.max_body_size, request_budget=opts.request_budget)
+    await server.start("localhost", opts.port)
+    logging.info("Starting asyncio server at %s" % opts.port)
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopped.set)
+    await stopped.wait()
+    logging.info("Shutting down")
+    await server.stop()
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-p", "--port", action="store", type=int, default=8080)
+    op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("--redis-host", action="store", default="localhost")
+    op.add_option("--redis-port", action="store", type=int, default=6379)
+    op.add_option("--pool-size", action="store", type=int, default=50)
+    op.add_option("--request-budget", action="store", type=float, default=MainHTTPHandler.request_budget,
+                  help="seconds for storage calls per request, 0 disables the limit")
+    op.add_option("--idle-timeout", action="store", type=int, default=75)
+    op.add_option("--log-sample-rate", action="store", type=float, default=1.0)
+    op.add_option("--max-body-size", action="store", type=int, default=MainHTTPHandler.max_body_size)
+    (opts, args) = op.parse_args()
+    log_listener = setup_logging(opts.log)
+    try:
+        asyncio.run(serve(opts))
+    finally:
+        log_listener.stop()
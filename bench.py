@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Load generator for api.py: replays JSONL method requests or synthesizes a method mix,
+then reports throughput and latency percentiles per method and per status code."""
+
+import hashlib
+import http.client
+import itertools
+import json
+import logging
+import math
+import random
+import threading
+import time
+from optparse import OptionParser
+from urllib.parse import urlparse
+import api
+import interests
+from fake_redis import FakeRedisServer
+from server import make_server
+from store import Store
+
+PERCENTILES = (50, 95, 99, 99.9)
+
+
+def make_token(account, login):
+    return hashlib.sha512((account + login + api.SALT).encode('utf-8')).hexdigest()
+
+
+def load_requests(path):
+    """Read (path, body) pairs from JSONL: either {"path": ..., "body": ...} or bare method request bodies"""
+    requests = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            if isinstance(item, dict) and isinstance(item.get("body"), (dict, list)):
+                requests.append((item.get("path", "/method"), item["body"]))
+            elif isinstance(item, dict) and "method" in item:
+                requests.append(("/method", item))
+    return requests
+
+
+def synthesize(count, mix, max_clients=50, client_space=10000, seed=0):
+    """Build `count` valid requests, mix maps method name to its share"""
+    rnd = random.Random(seed)
+    account, login = "horns&hoofs", "h&f"
+    token = make_token(account, login)
+    methods, weights = zip(*mix.items())
+    requests = []
+    for _ in range(count):
+        method = rnd.choices(methods, weights)[0]
+        if method == "online_score":
+            arguments = {"phone": "79%09d" % rnd.randrange(10 ** 9), "email": "user@otus.ru",
+                         "first_name": "user%s" % rnd.randrange(client_space), "last_name": "test"}
+        else:
+            arguments = {"client_ids": rnd.sample(range(client_space), rnd.randint(1, max_clients))}
+        body = {"account": account, "login": login, "token": token, "method": method, "arguments": arguments}
+        requests.append(("/method", body))
+    return requests
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(","):
+        method, _, share = part.partition("=")
+        mix[method.strip()] = float(share or 1)
+    return mix
+
+
+class QuietHandler(api.MainHTTPHandler):
+    def log_message(self, *args):
+        pass
+
+
+def start_local_server(workers=8, client_space=10000, seed=0):
+    """Run api.py in-process against a fake Redis seeded with interests, return (url, stop)"""
+    redis_server = FakeRedisServer().start()
+    store = Store(port=redis_server.port, max_connections=workers * 2)
+    rnd = random.Random(seed)
+    pipe = store.client.pipeline(transaction=False)
+    for cid in range(client_space):
+        pipe.set("i:%s" % cid, interests.encode(rnd.sample(interests.DICTIONARY, 2)))
+    pipe.execute()
+    api.MainHTTPHandler.store = store
+    http_server = make_server(("localhost", 0), QuietHandler, workers=workers)
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+
+    def stop():
+        http_server.shutdown()
+        http_server.server_close()
+        store.close()
+        redis_server.stop()
+
+    return "http://localhost:%s" % http_server.server_address[1], stop
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of an already sorted list"""
+    if not values:
+        return 0.0
+    rank = max(int(math.ceil(q / 100.0 * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+class Recorder(object):
+    def __init__(self):
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def add(self, method, code, latency):
+        with self.lock:
+            self.samples.setdefault((method, code), []).append(latency)
+
+    def summary(self, elapsed):
+        groups = {}
+        for (method, code), latencies in self.samples.items():
+            groups.setdefault(("method", method), []).extend(latencies)
+            groups.setdefault(("code", code), []).extend(latencies)
+            groups.setdefault(("total", "all"), []).extend(latencies)
+        rows = []
+        for (kind, name), latencies in sorted(groups.items(), key=lambda item: (item[0][0], str(item[0][1]))):
+            latencies.sort()
+            row = {"group": kind, "name": name, "count": len(latencies),
+                   "rps": len(latencies) / elapsed if elapsed else 0.0}
+            for q in PERCENTILES:
+                row["p%s" % str(q).replace(".", "")] = percentile(latencies, q) * 1000
+            rows.append(row)
+        return rows
+
+
+def run(url, requests, concurrency=8, rate=None, total=None, timeout=10):
+    """Send requests (cycled up to `total`) from `concurrency` threads, optionally paced to `rate` req/s.
+
+    With a target rate latency is measured from the scheduled send time, so a stalled server
+    shows up in the percentiles instead of silently lowering the offered load.
+    """
+    parsed = urlparse(url)
+    total = total or len(requests)
+    counter = itertools.count()
+    counter_lock = threading.Lock()
+    recorder = Recorder()
+    started = time.monotonic()
+
+    def work():
+        connection = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=timeout)
+        while True:
+            with counter_lock:
+                i = next(counter)
+            if i >= total:
+                break
+            path, body = requests[i % len(requests)]
+            scheduled = time.monotonic()
+            if rate:
+                scheduled = started + i / float(rate)
+                delay = scheduled - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            method = body.get("method", path) if isinstance(body, dict) else path.strip("/")
+            data = json.dumps(body)
+            try:
+                connection.request("POST", path, data, {"Content-Type": "application/json"})
+                response = connection.getresponse()
+                response.read()
+                code = response.status
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                code = "error"
+            recorder.add(method, code, time.monotonic() - scheduled)
+        connection.close()
+
+    threads = [threading.Thread(target=work) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return recorder.summary(time.monotonic() - started)
+
+
+def format_report(rows):
+    lines = ["%-8s %-20s %8s %10s %9s %9s %9s %9s" % ("group", "name", "count", "req/s", "p50 ms", "p95 ms",
+                                                     "p99 ms", "p999 ms")]
+    for row in rows:
+        lines.append("%-8s %-20s %8d %10.1f %9.2f %9.2f %9.2f %9.2f" % (
+            row["group"], row["name"], row["count"], row["rps"], row["p50"], row["p95"], row["p99"], row["p999"]))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog [options] [requests.jsonl]")
+    op.add_option("-u", "--url", action="store", default=None,
+                  help="running api.py to test, by default one is started in-process on a fake Redis")
+    op.add_option("-n", "--requests", action="store", type=int, default=10000)
+    op.add_option("-c", "--concurrency", action="store", type=int, default=8)
+    op.add_option("-r", "--rate", action="store", type=float, default=None, help="target requests per second")
+    op.add_option("--mix", action="store", default="online_score=0.7,clients_interests=0.3")
+    op.add_option("--max-clients", action="store", type=int, default=50)
+    op.add_option("--workers", action="store", type=int, default=8, help="worker threads of the in-process server")
+    op.add_option("--seed", action="store", type=int, default=0)
+    op.add_option("--json", action="store_true", default=False)
+    (opts, args) = op.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    if args:
+        requests = load_requests(args[0])
+        if not requests:
+            op.error("no method requests found in %s" % args[0])
+    else:
+        requests = synthesize(opts.requests, parse_mix(opts.mix), opts.max_clients, seed=opts.seed)
+
+    stop = None
+    url = opts.url
+    if url is None:
+        url, stop = start_local_server(opts.workers, seed=opts.seed)
+    try:
+        rows = run(url, requests, opts.concurrency, opts.rate, opts.requests)
+    finally:
+        if stop is not None:
+            stop()
+    print(json.dumps(rows, indent=2) if opts.json else format_report(rows))
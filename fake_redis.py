@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""In-memory Redis stand-in speaking RESP over TCP, for offline benchmarks and tests"""
+
+import fnmatch
+import socket
+import socketserver
+import threading
+import time
+from optparse import OptionParser
+
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections.add(self.connection)
+
+    def finish(self):
+        with self.server.lock:
+            self.server.connections.discard(self.connection)
+        socketserver.StreamRequestHandler.finish(self)
+
+    def handle(self):
+        queued = None
+        watched = {}
+        resp3 = False
+        while True:
+            try:
+                command = self.read_command()
+            except (ConnectionError, ValueError):
+                return
+            if command is None:
+                return
+            name = command[0].upper()
+            if name == b"HELLO":
+                resp3 = len(command) > 1 and command[1] == b"3"
+            if name == b"MULTI":
+                queued = []
+                self.wfile.write(b"+OK\r\n")
+            elif name == b"WATCH" and queued is None:
+                watched.update(self.server.watch(command[1:]))
+                self.wfile.write(b"+OK\r\n")
+            elif name == b"UNWATCH" and queued is None:
+                watched = {}
+                self.wfile.write(b"+OK\r\n")
+            elif name == b"DISCARD" and queued is not None:
+                queued, watched = None, {}
+                self.wfile.write(b"+OK\r\n")
+            elif name == b"EXEC" and queued is not None:
+                self.wfile.write(self.server.execute_transaction(queued, watched, resp3))
+                queued, watched = None, {}
+            elif queued is not None:
+                queued.append(command)
+                self.wfile.write(b"+QUEUED\r\n")
+            else:
+                self.wfile.write(self.server.execute(command, resp3))
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            return line.split()
+        args = []
+        for _ in range(int(line[1:])):
+            size = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(size + 2)[:-2])
+        return args
+
+
+class Status(bytes):
+    pass
+
+
+class Map(dict):
+    pass
+
+
+def encode(value, resp3=False):
+    if isinstance(value, Status):
+        return b"+%s\r\n" % value
+    if isinstance(value, Map):
+        items = b"".join(encode(k, resp3) + encode(v, resp3) for k, v in value.items())
+        if resp3:
+            return b"%%%d\r\n%s" % (len(value), items)
+        return b"*%d\r\n%s" % (len(value) * 2, items)
+    if value is None or value is False:
+        return b"_\r\n" if resp3 else b"$-1\r\n"
+    if value is True:
+        return b"+OK\r\n"
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, Exception):
+        return b"-ERR %s\r\n" % str(value).encode('utf-8')
+    if isinstance(value, list):
+        return b"*%d\r\n%s" % (len(value), b"".join(encode(v, resp3) for v in value))
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    """Supports the commands Store uses: strings with expiry, MGET, pipelines, WATCH/MULTI/EXEC, SCAN, INCR"""
+    daemon_threads = True
+    allow_reuse_address = True
+    # commands that modify the key given as their first argument, for WATCH
+    writes = ("set", "setex", "incr", "incrby", "expire", "pexpire")
+
+    def __init__(self, host="localhost", port=0):
+        socketserver.ThreadingTCPServer.__init__(self, (host, port), FakeRedisHandler)
+        self.data = {}
+        self.versions = {}
+        self.epoch = 0
+        self.lock = threading.RLock()
+        self.commands = 0
+        self.connections = set()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        """Serve from a daemon thread and return self"""
+        threading.Thread(target=self.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+        return self
+
+    def stop(self):
+        """Stop listening and drop client connections, like a Redis node going away"""
+        self.shutdown()
+        self.server_close()
+        with self.lock:
+            connections = list(self.connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def execute(self, command, resp3=False):
+        name = command[0].upper().decode('ascii', 'replace')
+        method = getattr(self, "cmd_" + name.lower(), None)
+        if method is None:
+            return encode(ValueError("unknown command '%s'" % name))
+        with self.lock:
+            self.commands += 1
+            try:
+                result = method(*command[1:])
+            except (TypeError, ValueError) as e:
+                return encode(ValueError(e))
+            self.touch(name.lower(), command[1:])
+            return encode(result, resp3)
+
+    def touch(self, name, args):
+        if name == "flushdb":
+            self.epoch += 1
+            return
+        keys = args if name == "del" else args[:1] if name in self.writes else ()
+        for key in keys:
+            self.versions[key] = self.versions.get(key, 0) + 1
+
+    def watch(self, keys):
+        with self.lock:
+            return {key: (self.epoch, self.versions.get(key, 0)) for key in keys}
+
+    def execute_transaction(self, commands, watched, resp3=False):
+        """EXEC: nothing runs and the reply is null if a watched key was written since WATCH"""
+        with self.lock:
+            if any(self.watch([key])[key] != version for key, version in watched.items()):
+                return b"_\r\n" if resp3 else b"*-1\r\n"
+            replies = [self.execute(c, resp3) for c in commands]
+        return b"*%d\r\n%s" % (len(replies), b"".join(replies))
+
+    def lookup(self, key):
+        item = self.data.get(key)
+        if item is None:
+            return None
+        value, expires = item
+        if expires is not None and expires <= time.monotonic():
+            del self.data[key]
+            return None
+        return value
+
+    def cmd_ping(self, *args):
+        return Status(b"PONG")
+
+    def cmd_hello(self, protocol=b"2", *args):
+        # redis-py negotiates RESP3 by default, plain RESP2 replies are still understood after this
+        return Map({b"server": b"redis", b"version": b"7.0.0", b"proto": int(protocol)})
+
+    def cmd_select(self, db):
+        return True
+
+    def cmd_client(self, *args):
+        return True
+
+    def cmd_flushdb(self, *args):
+        self.data.clear()
+        return True
+
+    def cmd_get(self, key):
+        return self.lookup(key)
+
+    def cmd_mget(self, *keys):
+        return [self.lookup(key) for key in keys]
+
+    def cmd_set(self, key, value, *options):
+        expires = None
+        options = [o.upper() for o in options]
+        if b"KEEPTTL" in options and self.lookup(key) is not None:
+            expires = self.data[key][1]
+        if b"EX" in options:
+            expires = time.monotonic() + int(options[options.index(b"EX") + 1])
+        elif b"PX" in options:
+            expires = time.monotonic() + int(options[options.index(b"PX") + 1]) / 1000.0
+        self.data[key] = (value, expires)
+        return True
+
+    def cmd_setex(self, key, seconds, value):
+        self.data[key] = (value, time.monotonic() + int(seconds))
+        return True
+
+    def cmd_del(self, *keys):
+        return sum(1 for key in keys if self.data.pop(key, None) is not None)
+
+    def cmd_exists(self, *keys):
+        return sum(1 for key in keys if self.lookup(key) is not None)
+
+    def cmd_incr(self, key):
+        return self.cmd_incrby(key, 1)
+
+    def cmd_incrby(self, key, amount):
+        value = int(self.lookup(key) or 0) + int(amount)
+        expires = self.data[key][1] if key in self.data else None
+        self.data[key] = (str(value).encode('ascii'), expires)
+        return value
+
+    def cmd_expire(self, key, seconds):
+        return self.cmd_pexpire(key, int(seconds) * 1000)
+
+    def cmd_pexpire(self, key, milliseconds):
+        value = self.lookup(key)
+        if value is None:
+            return 0
+        self.data[key] = (value, time.monotonic() + int(milliseconds) / 1000.0)
+        return 1
+
+    def cmd_pttl(self, key):
+        if self.lookup(key) is None:
+            return -2
+        expires = self.data[key][1]
+        if expires is None:
+            return -1
+        return int((expires - time.monotonic()) * 1000)
+
+    def cmd_ttl(self, key):
+        pttl = self.cmd_pttl(key)
+        return pttl if pttl < 0 else pttl // 1000
+
+    def cmd_scan(self, cursor, *options):
+        options = list(options)
+        match, count = b"*", 10
+        for i in range(0, len(options) - 1, 2):
+            if options[i].upper() == b"MATCH":
+                match = options[i + 1]
+            elif options[i].upper() == b"COUNT":
+                count = int(options[i + 1])
+        keys = sorted(self.data)
+        start = int(cursor)
+        batch = keys[start:start + count]
+        following = start + count if start + count < len(keys) else 0
+        pattern = match.decode('utf-8')
+        found = [key for key in batch
+                 if self.lookup(key) is not None and fnmatch.fnmatchcase(key.decode('utf-8', 'replace'), pattern)]
+        return [str(following).encode('ascii'), found]
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-p", "--port", action="store", type=int, default=6379)
+    (opts, args) = op.parse_args()
+    server = FakeRedisServer(port=opts.port)
+    print("Fake redis listening on %s" % server.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
@@ -0,0 +1,78 @@
+import json
+
+# Shared dictionary of interest names. Values are stored as positions in this list, so it is append-only:
+# never reorder or remove entries, add new interests at the end.
+DICTIONARY = ["cars", "pets", "travel", "hi-tech", "sport", "music", "books", "tv", "cinema", "geek", "otus"]
+CODES = {name: code for code, name in enumerate(DICTIONARY)}
+
+# Legacy values are Python list reprs and always start with "[", the binary format starts with a zero byte
+MAGIC = b"\x00"
+VERSION = 1
+HEADER = MAGIC + bytes([VERSION])
+
+
+def write_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(data, pos):
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def encode(interests):
+    """Pack interests as varints: dictionary entries as code + 1, anything else as 0, length, utf-8 bytes"""
+    out = bytearray(HEADER)
+    for name in interests:
+        code = CODES.get(name)
+        if code is not None:
+            write_varint(out, code + 1)
+        else:
+            raw = name.encode('utf-8')
+            out.append(0)
+            write_varint(out, len(raw))
+            out += raw
+    return bytes(out)
+
+
+def decode_binary(data):
+    if data[1] != VERSION:
+        raise ValueError("Unsupported interests format version %s" % data[1])
+    interests = []
+    pos = len(HEADER)
+    while pos < len(data):
+        code, pos = read_varint(data, pos)
+        if code:
+            interests.append(DICTIONARY[code - 1])
+        else:
+            size, pos = read_varint(data, pos)
+            interests.append(data[pos:pos + size].decode('utf-8'))
+            pos += size
+    return interests
+
+
+def decode_legacy(data):
+    r = data.decode('utf-8').replace('\'', '\"')
+    return json.loads(r) if r else []
+
+
+def is_binary(data):
+    return data[:1] == MAGIC
+
+
+def decode(data):
+    """Decode a stored value in either format, empty or missing values are an empty list"""
+    if not data:
+        return []
+    if is_binary(data):
+        return decode_binary(data)
+    return decode_legacy(data)
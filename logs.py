@@ -0,0 +1,103 @@
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import random
+from metrics import REGISTRY
+
+ACCESS_LOGGER = logging.getLogger("api.access")
+MAX_STRING = 256
+MAX_ITEMS = 20
+
+DROPPED = REGISTRY.counter("log_records_dropped_total", "Log records dropped because the log queue was full")
+
+
+def truncate(value, max_string=MAX_STRING, max_items=MAX_ITEMS):
+    """Cap strings and collections so one request can't produce a huge log line"""
+    if isinstance(value, str):
+        if len(value) > max_string:
+            return "%s...(%d chars)" % (value[:max_string], len(value))
+        return value
+    if isinstance(value, dict):
+        items = list(value.items())
+        result = {str(k): truncate(v, max_string, max_items) for k, v in items[:max_items]}
+        if len(items) > max_items:
+            result["..."] = "%d more" % (len(items) - max_items)
+        return result
+    if isinstance(value, (list, tuple, set)):
+        items = list(value)
+        result = [truncate(v, max_string, max_items) for v in items[:max_items]]
+        if len(items) > max_items:
+            result.append("...(%d items)" % len(items))
+        return result
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    return truncate(str(value), max_string, max_items)
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message, extra `fields` and the traceback if any"""
+
+    def format(self, record):
+        line = {
+            "ts": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": truncate(record.getMessage()),
+        }
+        line.update(truncate(getattr(record, "fields", None) or {}))
+        if record.exc_info:
+            line["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            line["exc"] = record.exc_text
+        return json.dumps(line, ensure_ascii=False)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the listener thread; when the queue is full the record is dropped, never waited on"""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DROPPED.inc()
+
+    def prepare(self, record):
+        # the message and traceback are rendered here, everything else is formatted on the listener thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging(filename=None, level=logging.INFO, queue_size=10000):
+    """Route the root logger through a bounded queue to a JSON file/stderr handler, return the started listener"""
+    target = logging.FileHandler(filename) if filename else logging.StreamHandler()
+    target.setFormatter(JSONFormatter())
+    listener = logging.handlers.QueueListener(queue.Queue(queue_size), target, respect_handler_level=True)
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(DroppingQueueHandler(listener.queue))
+    root.setLevel(level)
+    listener.start()
+    return listener
+
+
+def log_access(context, code, sample_rate=1.0):
+    """Access record for a handled request; successful ones are sampled, errors are always kept.
+
+    Only request metadata is logged: request bodies and response payloads may hold personal data.
+    """
+    if code < 400 and sample_rate < 1.0 and random.random() >= sample_rate:
+        return
+    fields = {key: value for key, value in context.items() if key != "response"}
+    fields["code"] = code
+    if sample_rate < 1.0 and code < 400:
+        fields["sample_rate"] = sample_rate
+    ACCESS_LOGGER.log(logging.WARNING if code >= 500 else logging.INFO, "request", extra={"fields": fields})
@@ -0,0 +1,181 @@
+import bisect
+import threading
+import time
+from functools import wraps
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                             for name, value in pairs)
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    kind = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            yield self.name, format_labels(self.labels, labels), value
+
+
+class Gauge(object):
+    """Value read from a callback at scrape time, so the hot path pays nothing for it"""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, callback, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.callback = callback
+
+    def samples(self):
+        values = self.callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in sorted(values.items()):
+            yield self.name, format_labels(self.labels, labels), value
+
+
+class Histogram(object):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    def count(self, labels=()):
+        state = self._values.get(labels)
+        return state[2] if state else 0
+
+    def time(self, labels=()):
+        return _Timer(self, labels)
+
+    def samples(self):
+        with self._lock:
+            items = sorted((labels, ([c for c in state[0]], state[1], state[2]))
+                           for labels, state in self._values.items())
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, c in zip(self.buckets + (float("inf"),), counts):
+                cumulative += c
+                yield (self.name + "_bucket", format_labels(self.labels, labels, [("le", format_value(bound))]),
+                       cumulative)
+            yield self.name + "_sum", format_labels(self.labels, labels), total
+            yield self.name + "_count", format_labels(self.labels, labels), count
+
+
+class _Timer(object):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, self.labels)
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, callback, labels=()):
+        return self.register(Gauge(name, documentation, callback, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def render(self):
+        """Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.documentation))
+            lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append("%s%s %s" % (name, labels, format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.counter("api_requests_total", "Handled requests", ("method", "code"))
+REQUEST_LATENCY = REGISTRY.histogram("api_request_duration_seconds", "Request handling time", ("method", "code"))
+STORE_LATENCY = REGISTRY.histogram("store_operation_duration_seconds", "Store call time", ("operation",))
+STORE_RETRIES = REGISTRY.counter("store_retries_total", "Store call retries after a timeout", ("operation",))
+WRITE_BEHIND = REGISTRY.counter("store_write_behind_total", "Deferred cache writes by outcome", ("result",))
+SCORE_CACHE = REGISTRY.counter("score_cache_requests_total", "get_score cache lookups", ("result",))
+REGISTRY.gauge("score_cache_hit_ratio", "Share of get_score cache lookups served from cache",
+               lambda: SCORE_CACHE.value(("hit",)) / float(
+                   (SCORE_CACHE.value(("hit",)) + SCORE_CACHE.value(("miss",))) or 1))
+SCORE_FLIGHTS = REGISTRY.counter("score_singleflight_total",
+                                 "get_score cache misses by role: leaders compute, waiters share a running computation",
+                                 ("role",))
+SCORE_FLIGHT_WAIT = REGISTRY.histogram("score_singleflight_wait_seconds",
+                                       "Time waiters spent blocked on a concurrent score computation")
+NCLIENTS = REGISTRY.histogram("clients_interests_nclients", "Client ids per clients_interests request",
+                              buckets=(1, 5, 10, 50, 100, 500, 1000, 5000, 10000, 50000))
+
+
+def timed(operation):
+    """Record the wrapped Store method's duration under `operation`"""
+    labels = (operation,)
+
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                STORE_LATENCY.observe(time.perf_counter() - start, labels)
+        return wrapper
+    return decorator
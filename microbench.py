@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Microbenchmarks for the request hot path with saved baselines and a regression check"""
+
+import datetime
+import hashlib
+import json
+import sys
+import timeit
+from optparse import OptionParser
+import api
+import interests
+import scoring
+
+TOKEN = hashlib.sha512(("horns&hoofs" + "h&f" + api.SALT).encode('utf-8')).hexdigest()
+SCORE_ARGUMENTS = {"phone": "79175002040", "email": "stupnikov@otus.ru", "gender": 1, "birthday": "01.01.2000",
+                   "first_name": "a", "last_name": "b"}
+INTERESTS_ARGUMENTS = {"client_ids": list(range(100)), "date": "20.07.2017"}
+METHOD_BODY = {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "token": TOKEN,
+               "arguments": SCORE_ARGUMENTS}
+
+FIELD_VALUES = [
+    ("CharField", api.CharField(), "Stanislav"),
+    ("ArgumentsField", api.ArgumentsField(), SCORE_ARGUMENTS),
+    ("EmailField", api.EmailField(), "stupnikov@otus.ru"),
+    ("PhoneField", api.PhoneField(), "79175002040"),
+    ("DateField", api.DateField(), "20.07.2017"),
+    ("BirthDayField", api.BirthDayField(), "01.01.2000"),
+    ("GenderField", api.GenderField(), 1),
+    ("ClientIDsField", api.ClientIDsField(), INTERESTS_ARGUMENTS["client_ids"]),
+]
+
+
+def validated(request_class, arguments):
+    r = request_class(**arguments)
+    r.validate()
+    return r
+
+
+def benchmarks():
+    """Name -> zero-argument callable exercising one stage of request handling"""
+    cases = {}
+    for name, field, value in FIELD_VALUES:
+        cases["field.%s.validate" % name] = lambda field=field, value=value: field.validate(value)
+        cases["field.%s.prepare_value" % name] = lambda field=field, value=value: field.prepare_value(value)
+    cases["request.OnlineScoreRequest.validate"] = lambda: validated(api.OnlineScoreRequest, SCORE_ARGUMENTS)
+    cases["request.ClientsInterestsRequest.validate"] = lambda: validated(api.ClientsInterestsRequest,
+                                                                         INTERESTS_ARGUMENTS)
+    cases["request.MethodRequest.validate"] = lambda: validated(api.MethodRequest, METHOD_BODY)
+
+    user_request = validated(api.MethodRequest, METHOD_BODY)
+    admin_request = validated(api.MethodRequest, dict(METHOD_BODY, login=api.ADMIN_LOGIN))
+    cases["check_auth.user"] = lambda: api.check_auth(user_request)
+    cases["check_auth.admin"] = lambda: api.check_auth(admin_request)
+
+    birthday = datetime.datetime(2000, 1, 1)
+    cases["scoring.score_key"] = lambda: scoring.score_key("a", "b", birthday)
+    raw_interests = str(["cars", "pets", "travel"]).encode('utf-8')
+    cases["scoring.decode_interests"] = lambda: scoring.decode_interests(raw_interests)
+    packed_interests = interests.encode(["cars", "pets", "travel"])
+    cases["scoring.decode_interests.binary"] = lambda: scoring.decode_interests(packed_interests)
+
+    interests_response = {cid: ["cars", "pets"] for cid in INTERESTS_ARGUMENTS["client_ids"]}
+    cases["response.encode.online_score"] = lambda: json.dumps(api.format_response({"score": 5.0}, api.OK)).encode(
+        'utf-8')
+    cases["response.encode.clients_interests"] = lambda: json.dumps(
+        api.format_response(interests_response, api.OK)).encode('utf-8')
+    return cases
+
+
+def measure(fn, repeat=5, min_time=0.05):
+    """Best time per call in nanoseconds"""
+    timer = timeit.Timer(fn)
+    number = 1
+    while timer.timeit(number) < min_time:
+        number *= 2
+    return min(timer.repeat(repeat, number)) / number * 1e9
+
+
+def run(names=None, repeat=5, min_time=0.05):
+    cases = benchmarks()
+    return {name: measure(fn, repeat, min_time) for name, fn in sorted(cases.items())
+            if not names or any(name.startswith(prefix) for prefix in names)}
+
+
+def compare(results, baseline, threshold):
+    """Return (name, baseline_ns, current_ns) for every benchmark slower than baseline by more than threshold"""
+    regressions = []
+    for name, current in sorted(results.items()):
+        previous = baseline.get(name)
+        if previous and current > previous * (1 + threshold):
+            regressions.append((name, previous, current))
+    return regressions
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog [options] [benchmark prefix ...]")
+    op.add_option("-b", "--baseline", action="store", default=None, help="baseline JSON to compare against")
+    op.add_option("-s", "--save", action="store", default=None, help="write results as a new baseline")
+    op.add_option("-t", "--threshold", action="store", type=float, default=0.2,
+                  help="allowed slowdown relative to the baseline, 0.2 means 20%")
+    op.add_option("-r", "--repeat", action="store", type=int, default=5)
+    op.add_option("--min-time", action="store", type=float, default=0.05)
+    (opts, args) = op.parse_args()
+
+    results = run(args, opts.repeat, opts.min_time)
+    baseline = {}
+    if opts.baseline:
+        with open(opts.baseline) as f:
+            baseline = json.load(f)["results"]
+    for name, ns in results.items():
+        line = "%-45s %12.1f ns" % (name, ns)
+        if name in baseline:
+            line += "  %+7.1f%%" % ((ns / baseline[name] - 1) * 100)
+        print(line)
+    if opts.save:
+        with open(opts.save, "w") as f:
+            json.dump({"python": sys.version.split()[0], "results": results}, f, indent=2, sort_keys=True)
+    regressions = compare(results, baseline, opts.threshold)
+    for name, previous, current in regressions:
+        print("REGRESSION %s: %.1f ns -> %.1f ns" % (name, previous, current))
+    sys.exit(1 if regressions else 0)
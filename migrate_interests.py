@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Rewrite legacy i:* interests values into the binary format, walking the keyspace with SCAN"""
+
+import logging
+from optparse import OptionParser
+import redis
+import interests
+from store import Store
+
+
+def migrate(store, match="i:*", batch=1000, dry_run=False):
+    """Convert every legacy value under `match`, return counters of scanned, converted, skipped and failed keys
+    plus the byte sizes before and after. Values are rewritten with KEEPTTL, so expirations survive."""
+    stats = {"scanned": 0, "converted": 0, "skipped": 0, "failed": 0, "bytes_before": 0, "bytes_after": 0}
+    keys = []
+    for key in store.scan(match, count=batch):
+        keys.append(key)
+        if len(keys) >= batch:
+            migrate_batch(store, keys, stats, dry_run)
+            keys = []
+    if keys:
+        migrate_batch(store, keys, stats, dry_run)
+    return stats
+
+
+def migrate_batch(store, keys, stats, dry_run, attempts=3):
+    """Convert keys in one WATCH/MULTI/EXEC, so an interests write landing between the read and the
+    rewrite aborts it instead of being overwritten with the converted old value. The batch is then
+    re-read; one that keeps conflicting is retried key by key, a key that keeps changing is left as is."""
+    for attempt in range(attempts):
+        try:
+            batch_stats = convert_batch(store, keys, dry_run)
+        except redis.WatchError:
+            continue
+        for name, value in batch_stats.items():
+            stats[name] += value
+        return
+    if len(keys) > 1:
+        for key in keys:
+            migrate_batch(store, [key], stats, dry_run, attempts)
+        return
+    logging.warning("%s keeps changing, left as is", keys[0])
+    stats["scanned"] += 1
+    stats["failed"] += 1
+
+
+def convert_batch(store, keys, dry_run):
+    stats = {"scanned": len(keys), "converted": 0, "skipped": 0, "failed": 0, "bytes_before": 0, "bytes_after": 0}
+    with store.client.pipeline(transaction=True) as pipe:
+        pipe.watch(*keys)
+        updates = []
+        for key, value in zip(keys, pipe.mget(keys)):
+            if not value or interests.is_binary(value):
+                stats["skipped"] += 1
+                continue
+            try:
+                decoded = interests.decode_legacy(value)
+                # valid JSON isn't enough: encode() would crash on numbers and turn a dict into its keys
+                if not isinstance(decoded, list) or not all(isinstance(name, str) for name in decoded):
+                    raise ValueError("Not a list of interest names")
+                encoded = interests.encode(decoded)
+            except ValueError:
+                logging.warning("Can't decode interests in %s: %r", key, value[:100])
+                stats["failed"] += 1
+                continue
+            stats["converted"] += 1
+            stats["bytes_before"] += len(value)
+            stats["bytes_after"] += len(encoded)
+            updates.append((key, encoded))
+        if updates and not dry_run:
+            pipe.multi()
+            for key, encoded in updates:
+                pipe.set(key, encoded, keepttl=True)
+            pipe.execute()
+    return stats
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("--redis-host", action="store", default="localhost")
+    op.add_option("--redis-port", action="store", type=int, default=6379)
+    op.add_option("--redis-db", action="store", type=int, default=0)
+    op.add_option("--match", action="store", default="i:*")
+    op.add_option("-b", "--batch", action="store", type=int, default=1000, help="keys per SCAN page and pipeline")
+    op.add_option("-n", "--dry-run", action="store_true", default=False, help="only report what would change")
+    (opts, args) = op.parse_args()
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname).1s %(message)s',
+                        datefmt='%Y.%m.%d %H:%M:%S')
+    store = Store(opts.redis_host, opts.redis_port, opts.redis_db)
+    try:
+        stats = migrate(store, opts.match, opts.batch, opts.dry_run)
+    finally:
+        store.close()
+    logging.info("%s%s", "Dry run: " if opts.dry_run else "",
+                 ", ".join("%s=%s" % (name, stats[name]) for name in sorted(stats)))
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Fill the score cache from a JSONL file of profiles before traffic arrives.
+
+Each line is an online_score arguments object (or {"arguments": {...}}). Rows are validated
+with OnlineScoreRequest and scored in a process pool, then written with pipelined SETEX.
+Progress is checkpointed as a byte offset, so an interrupted run continues where it stopped.
+"""
+
+import collections
+import json
+import logging
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from optparse import OptionParser
+from api import OnlineScoreRequest
+from scoring import SCORE_TTL, compute_score, score_key
+from store import Store
+
+
+def read_chunks(f, chunk_size):
+    """Yield (end offset, lines) from a binary file, the offset points just past the chunk's last line"""
+    offset = f.tell()
+    lines = []
+    for line in iter(f.readline, b""):
+        offset += len(line)
+        if line.strip():
+            lines.append(line)
+        if len(lines) >= chunk_size:
+            yield offset, lines
+            lines = []
+    if lines:
+        yield offset, lines
+
+
+def score_lines(lines):
+    """Validate and score raw JSONL lines, return ([(key, score)], invalid rows).
+
+    Profiles sharing a cache key are written once per chunk; like across chunks, the later row wins.
+    """
+    items = collections.OrderedDict()
+    invalid = 0
+    for line in lines:
+        try:
+            arguments = json.loads(line)
+            if isinstance(arguments, dict) and isinstance(arguments.get("arguments"), dict):
+                arguments = arguments["arguments"]
+            r = OnlineScoreRequest(**arguments)
+            r.validate()
+        except (ValueError, TypeError):
+            invalid += 1
+            continue
+        if not r.is_valid():
+            invalid += 1
+            continue
+        key = score_key(r['first_name'], r['last_name'], r['birthday'])
+        items[key] = compute_score(r['phone'], r['email'], r['birthday'], r['gender'], r['first_name'],
+                                   r['last_name'])
+    return list(items.items()), invalid
+
+
+def load_checkpoint(path, source):
+    if not path or not os.path.exists(path):
+        return {"offset": 0, "rows": 0}
+    with open(path) as f:
+        checkpoint = json.load(f)
+    if checkpoint.get("source") != os.path.abspath(source):
+        raise ValueError("Checkpoint %s belongs to %s" % (path, checkpoint.get("source")))
+    return checkpoint
+
+
+def save_checkpoint(path, source, offset, rows):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"source": os.path.abspath(source), "offset": offset, "rows": rows}, f)
+    os.replace(tmp, path)
+
+
+class Throttle(object):
+    """Paces writes to `rate` rows per second on average, no limit when rate is falsy"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.started = time.monotonic()
+        self.rows = 0
+
+    def wait(self, rows):
+        self.rows += rows
+        if self.rate:
+            delay = self.started + self.rows / float(self.rate) - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+
+def prewarm(store, path, processes=None, chunk_size=1000, rate=None, checkpoint=None, ttl=SCORE_TTL,
+            ttl_jitter=0.1, report_interval=10):
+    """Score every row of `path` into the cache, return counters of rows, written keys and invalid rows.
+
+    TTLs are spread over [ttl * (1 - ttl_jitter), ttl] per chunk so the warmed keys don't all expire at once.
+    """
+    state = load_checkpoint(checkpoint, path)
+    stats = {"rows": 0, "written": 0, "invalid": 0, "resumed_at": state["rows"]}
+    throttle = Throttle(rate)
+    started = last_report = time.monotonic()
+    processes = processes or os.cpu_count() or 1
+    with open(path, "rb") as f, ProcessPoolExecutor(processes) as pool:
+        f.seek(state["offset"])
+        pending = collections.deque()
+        chunks = read_chunks(f, chunk_size)
+        # a bounded window of chunks in flight keeps memory flat on large files
+        window = 2 * processes
+        while True:
+            for offset, lines in chunks:
+                pending.append((offset, len(lines), pool.submit(score_lines, lines)))
+                if len(pending) >= window:
+                    break
+            if not pending:
+                break
+            offset, rows, future = pending.popleft()
+            items, invalid = future.result()
+            chunk_ttl = int(ttl - random.random() * ttl * ttl_jitter)
+            if items and not store.cache_set_many(items, chunk_ttl):
+                raise ConnectionError("Can't write to storage, rerun to resume from row %s"
+                                      % (state["rows"] + stats["rows"]))
+            stats["rows"] += rows
+            stats["written"] += len(items)
+            stats["invalid"] += invalid
+            if checkpoint:
+                save_checkpoint(checkpoint, path, offset, state["rows"] + stats["rows"])
+            throttle.wait(rows)
+            now = time.monotonic()
+            if now - last_report >= report_interval:
+                logging.info("%s rows, %.0f rows/s" % (stats["rows"], stats["rows"] / (now - started)))
+                last_report = now
+    elapsed = time.monotonic() - started
+    stats["rows_per_second"] = stats["rows"] / elapsed if elapsed else 0.0
+    return stats
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog [options] profiles.jsonl")
+    op.add_option("--redis-host", action="store", default="localhost")
+    op.add_option("--redis-port", action="store", type=int, default=6379)
+    op.add_option("-p", "--processes", action="store", type=int, default=None, help="scoring processes, CPU count")
+    op.add_option("--chunk-size", action="store", type=int, default=1000, help="rows per pipeline")
+    op.add_option("-r", "--rate", action="store", type=float, default=None, help="max rows per second")
+    op.add_option("-c", "--checkpoint", action="store", default=None, help="progress file for resuming")
+    op.add_option("--ttl", action="store", type=int, default=SCORE_TTL)
+    op.add_option("--ttl-jitter", action="store", type=float, default=0.1)
+    (opts, args) = op.parse_args()
+    if len(args) != 1:
+        op.error("profiles file is required")
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname).1s %(message)s',
+                        datefmt='%Y.%m.%d %H:%M:%S')
+    store = Store(opts.redis_host, opts.redis_port)
+    try:
+        stats = prewarm(store, args[0], opts.processes, opts.chunk_size, opts.rate, opts.checkpoint, opts.ttl,
+                        opts.ttl_jitter)
+    finally:
+        store.close()
+    logging.info("Done: %(rows)s rows, %(written)s keys written, %(invalid)s invalid, "
+                 "%(rows_per_second).0f rows/s" % stats)
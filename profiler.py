@@ -0,0 +1,115 @@
+import collections
+import hmac
+import logging
+import os
+import random
+import signal
+import sys
+import threading
+import time
+
+DEBUG_HEADER = "X-Debug-Profile"
+
+
+class SamplingProfiler(object):
+    """Statistical profiler for selected requests.
+
+    A background thread periodically reads the stacks of the threads currently serving a profiled
+    request (sys._current_frames) and counts them as collapsed stacks rooted at the API method,
+    the format flamegraph.pl and speedscope read. Threads that are not profiled are never touched.
+    """
+
+    def __init__(self, sample_rate=0.0, debug_token=None, interval=0.005, output="profile.collapsed",
+                 dump_interval=None):
+        self.sample_rate = sample_rate
+        self.debug_token = debug_token.encode('utf-8') if debug_token else None
+        self.interval = interval
+        self.output = output
+        self.dump_interval = dump_interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self._active = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def wants(self, headers):
+        """Profile requests carrying the debug token, plus a random sample_rate share of the rest"""
+        if self.debug_token is not None:
+            token = headers.get(DEBUG_HEADER)
+            if token and hmac.compare_digest(token.encode('utf-8'), self.debug_token):
+                return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def begin(self, context, label):
+        """Start sampling the calling thread, the stack root is context["method"] once a handler sets it"""
+        if self._thread is None:
+            self.start()
+        self._active[threading.get_ident()] = (context, label)
+
+    def end(self):
+        self._active.pop(threading.get_ident(), None)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._stopped.clear()
+                self._thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+
+    def run(self):
+        next_dump = time.monotonic() + self.dump_interval if self.dump_interval else None
+        while not self._stopped.wait(self.interval):
+            self.sample()
+            if next_dump is not None and time.monotonic() >= next_dump:
+                self.dump()
+                next_dump += self.dump_interval
+
+    def sample(self):
+        active = list(self._active.items())
+        if not active:
+            return
+        frames = sys._current_frames()
+        collected = []
+        for thread_id, (context, label) in active:
+            frame = frames.get(thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("%s:%s" % (os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            stack.append(str(context.get("method") or label))
+            collected.append(";".join(reversed(stack)))
+        with self._lock:
+            self.stacks.update(collected)
+            self.samples += len(collected)
+
+    def collapsed(self):
+        with self._lock:
+            return "".join("%s %d\n" % (stack, count) for stack, count in sorted(self.stacks.items()))
+
+    def dump(self, path=None):
+        """Write the aggregated stacks so far, atomically replacing the previous dump"""
+        path = path or self.output
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(self.collapsed())
+        os.replace(tmp, path)
+        logging.info("Wrote %s profile samples to %s" % (self.samples, path))
+        return path
+
+
+def install_dump_handler(profiler, signum=signal.SIGUSR2):
+    """Dump the profile on a signal; the file is written off the signal handler"""
+    def handler(signum, frame):
+        threading.Thread(target=profiler.dump, daemon=True).start()
+
+    signal.signal(signum, handler)
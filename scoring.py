@@ -1,20 +1,29 @@
+import array
 import hashlib
+import heapq
 import json
+import threading
+import time
+import interests
+from cache import LRUCache, SingleFlight
+from metrics import SCORE_CACHE, SCORE_FLIGHTS, SCORE_FLIGHT_WAIT
 
+SCORE_TTL = 60 * 60
+score_flights = SingleFlight()
 
-def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+
+def score_key(first_name=None, last_name=None, birthday=None):
     key_parts = [
         first_name or "",
         last_name or "",
         birthday.strftime("%Y%m%d") if birthday is not None else "",
     ]
     to_hash = "".join(key_parts)
-    key = "uid:" + hashlib.md5(to_hash.encode('utf-8')).hexdigest()
-    # try get from cache,
-    # fallback to heavy calculation in case of cache miss
-    score = store.cache_get(key) or 0
-    if score:
-        return float(score)
+    return "uid:" + hashlib.md5(to_hash.encode('utf-8')).hexdigest()
+
+
+def compute_score(phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    score = 0
     if phone:
         score += 1.5
     if email:
@@ -23,12 +32,201 @@ def get_score(store, phone, email, birthday=None, gender=None, first_name=None,
         score += 1.5
     if first_name and last_name:
         score += 0.5
-    # cache for 60 minutes
-    store.cache_set(key, score,  60 * 60)
     return score
 
 
+def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    key = score_key(first_name, last_name, birthday)
+    # try get from cache,
+    # fallback to heavy calculation in case of cache miss
+    score = store.cache_get(key)
+    if score is not None:
+        SCORE_CACHE.inc(("hit",))
+        return float(score)
+    SCORE_CACHE.inc(("miss",))
+
+    def compute():
+        score = compute_score(phone, email, birthday, gender, first_name, last_name)
+        # cache for 60 minutes, the write doesn't hold up the response
+        store.cache_set_later(key, score, SCORE_TTL)
+        return score
+
+    # concurrent misses on the same key wait for one computation instead of each running their own
+    start = time.perf_counter()
+    score, shared = score_flights.do(key, compute)
+    if shared:
+        SCORE_FLIGHT_WAIT.observe(time.perf_counter() - start)
+    SCORE_FLIGHTS.inc(("waiter" if shared else "leader",))
+    return score
+
+
+PROFILE_FIELDS = ("phone", "email", "birthday", "gender", "first_name", "last_name")
+
+
+def get_scores(store, records):
+    """Score many profiles at once, the result matches calling get_score for each record in order.
+
+    records is either a list of dicts or a dict of equally sized columns (lists or arrays)
+    keyed by PROFILE_FIELDS.
+    """
+    if isinstance(records, dict):
+        size = len(next(iter(records.values()), ()))
+        columns = {name: records.get(name, [None] * size) for name in PROFILE_FIELDS}
+    else:
+        columns = {name: [record.get(name) for record in records] for name in PROFILE_FIELDS}
+    phone, email, birthday, gender, first_name, last_name = (columns[name] for name in PROFILE_FIELDS)
+
+    keys = [score_key(first, last, bdate) for first, last, bdate in zip(first_name, last_name, birthday)]
+    unique = list(dict.fromkeys(keys))
+    cached = dict(zip(unique, store.cache_get_many(unique)))
+    scores = [float(cached[key]) if cached[key] is not None else None for key in keys]
+    missing = [i for i, score in enumerate(scores) if score is None]
+    SCORE_CACHE.inc(("hit",), len(scores) - len(missing))
+    SCORE_CACHE.inc(("miss",), len(missing))
+    if not missing:
+        return scores
+
+    computed = [0] * len(missing)
+    for column, weight in ((phone, 1.5), (email, 1.5)):
+        computed = [score + weight if column[i] else score for score, i in zip(computed, missing)]
+    computed = [score + 1.5 if birthday[i] and gender[i] else score for score, i in zip(computed, missing)]
+    computed = [score + 0.5 if first_name[i] and last_name[i] else score for score, i in zip(computed, missing)]
+
+    # a repeated key reads what an earlier record wrote, exactly like sequential get_score calls
+    written = {}
+    for i, score in zip(missing, computed):
+        key = keys[i]
+        if key in written:
+            scores[i] = float(written[key])
+        else:
+            scores[i] = written[key] = score
+    store.cache_set_many(written.items(), SCORE_TTL)
+    return scores
+
+
+async def get_score_async(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    key = score_key(first_name, last_name, birthday)
+    score = await store.cache_get(key)
+    if score is not None:
+        return float(score)
+    score = compute_score(phone, email, birthday, gender, first_name, last_name)
+    await store.cache_set(key, score, SCORE_TTL)
+    return score
+
+
+def decode_interests(r):
+    return interests.decode(r)
+
+
+def set_interests(store, cid, values):
+    return store.set("i:%s" % cid, interests.encode(values))
+
+
 def get_interests(store, cid):
     r = store.get("i:%s" % cid)
-    r = r.decode('utf-8').replace('\'', '\"')
-    return json.loads(r) if r else []
\ No newline at end of file
+    return decode_interests(r)
+
+
+def get_interests_many(store, cids, deadline=None):
+    """Fetch interests for all cids in one batch, duplicate ids are fetched once"""
+    unique = list(dict.fromkeys(cids))
+    keys = ["i:%s" % cid for cid in unique]
+    values = store.get_many(keys) if deadline is None else store.get_many(keys, deadline=deadline)
+    return {cid: decode_interests(r) for cid, r in zip(unique, values)}
+
+
+def sorted_unique(ids, run_size=4096):
+    """Yield the distinct values of an integer sequence in order. Runs of run_size are sorted into arrays
+    and merged, so Python int objects exist for one run at a time rather than for the whole sequence."""
+    runs = [array.array('q', sorted(ids[start:start + run_size])) for start in range(0, len(ids), run_size)]
+    previous = None
+    for value in heapq.merge(*runs):
+        if value != previous:
+            previous = value
+            yield value
+
+
+def iter_interests(store, cids, batch_size=1000, batch_budget=None):
+    """Yield {cid: interests} for the sorted unique cids, one get_many per batch_size ids.
+
+    With batch_budget every batch gets its own storage deadline, so time spent between batches,
+    e.g. writing the previous one to a slow client, isn't charged to the next fetch.
+    """
+    batch = []
+    for cid in sorted_unique(cids):
+        batch.append(cid)
+        if len(batch) >= batch_size:
+            yield get_interests_many(store, batch, time.monotonic() + batch_budget if batch_budget else None)
+            batch = []
+    if batch:
+        yield get_interests_many(store, batch, time.monotonic() + batch_budget if batch_budget else None)
+
+
+def interests_etag(response):
+    """Strong validator for a clients_interests response, stable across dict ordering"""
+    return '"%s"' % hashlib.md5(json.dumps(sorted(response.items())).encode('utf-8')).hexdigest()
+
+
+class InterestsCache(object):
+    """Short-lived clients_interests results keyed by the set of client ids.
+
+    Every write of an i:<cid> key seen through Store.set bumps a sequence number and marks the cid;
+    a cached entry filled before that write is discarded on its next lookup.
+    """
+
+    def __init__(self, maxsize=1024, ttl=5):
+        self.ttl = ttl
+        self.entries = LRUCache(maxsize, ttl)
+        self.seq = 0
+        self.written = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(cids):
+        return tuple(sorted(set(cids)))
+
+    def sequence(self):
+        """Take before fetching and pass to set(), so a write racing the fetch still invalidates it"""
+        return self.seq
+
+    def get(self, cids):
+        key = self.key(cids)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        seq, value = entry
+        written = self.written
+        for cid in key:
+            mark = written.get(cid)
+            if mark is not None and mark[0] > seq:
+                self.entries.delete(key)
+                return None
+        return value
+
+    def set(self, cids, value, seq):
+        self.entries.set(self.key(cids), (seq, value))
+
+    def invalidate(self, key):
+        """Store.set listener"""
+        if not key.startswith("i:"):
+            return
+        try:
+            cid = int(key[2:])
+        except ValueError:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self.seq += 1
+            self.written[cid] = (self.seq, now)
+            if len(self.written) > self.entries.maxsize * 4:
+                # marks older than the TTL can't match a live entry anymore
+                self.written = {c: mark for c, mark in self.written.items() if now - mark[1] <= self.ttl}
+
+    def stats(self):
+        return self.entries.stats()
+
+
+async def get_interests_many_async(store, cids):
+    unique = list(dict.fromkeys(cids))
+    values = await store.get_many(["i:%s" % cid for cid in unique])
+    return {cid: decode_interests(r) for cid, r in zip(unique, values)}
@@ -0,0 +1,307 @@
+import logging
+import os
+import queue
+import select
+import signal
+import socket
+import threading
+import time
+from http.server import HTTPServer
+from admission import REJECTED
+
+
+OVERLOADED_BODY = b'{"error": "Service Unavailable", "code": 503}'
+OVERLOADED_RESPONSE = (b"HTTP/1.1 503 Service Unavailable\r\nContent-Type: application/json\r\n"
+                       b"Content-Length: %d\r\nRetry-After: 1\r\nConnection: close\r\n\r\n%s"
+                       % (len(OVERLOADED_BODY), OVERLOADED_BODY))
+
+
+class PooledHTTPServer(HTTPServer):
+    """HTTPServer that handles requests in a bounded pool of worker threads.
+
+    With shed=True a connection arriving while the queue is full gets an immediate 503 with
+    Retry-After from the accept loop, before anything is read from it; otherwise it waits.
+    """
+
+    def __init__(self, server_address, handler_class, workers=8, queue_size=None, bind_and_activate=True,
+                 shed=False):
+        self.workers = int(workers)
+        self.shed = shed
+        self.closing = False
+        self._requests = queue.Queue(maxsize=queue_size or self.workers * 4)
+        self._threads = []
+        HTTPServer.__init__(self, server_address, handler_class, bind_and_activate)
+        for i in range(self.workers):
+            t = threading.Thread(target=self._work, name="worker-%s" % i, daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def process_request(self, request, client_address):
+        if not self.shed:
+            # blocks the accept loop once the queue is full, so excess load waits in the listen backlog
+            self._requests.put((request, client_address))
+            return
+        try:
+            self._requests.put_nowait((request, client_address))
+        except queue.Full:
+            REJECTED.inc(("overloaded",))
+            try:
+                request.settimeout(0.1)
+                request.sendall(OVERLOADED_RESPONSE)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+
+    def busy(self):
+        """True while accepted connections are waiting for a free worker or the server is shutting down,
+        keep-alive connections should be given up then"""
+        return self.closing or not self._requests.empty()
+
+    def _work(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        """Stop listening, then let workers drain queued and in-flight requests"""
+        self.closing = True
+        HTTPServer.server_close(self)
+        for _ in self._threads:
+            self._requests.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+
+def install_shutdown_handler(server, signals=(signal.SIGTERM,)):
+    """Stop serve_forever on a signal, server_close() then drains in-flight requests"""
+    def handler(signum, frame):
+        logging.info("Received signal %s, shutting down" % signum)
+        # shutdown() waits for serve_forever to exit, it can't run on the thread serving it
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    for signum in signals:
+        signal.signal(signum, handler)
+
+
+def make_listener(server_address, backlog=128):
+    """Listening socket to bind once in the supervisor and inherit in every worker.
+
+    Unlike SO_REUSEPORT, where each process has its own accept queue and closing it resets the
+    connections waiting there, a stopping worker only drops its copy and the backlog stays with
+    the others. Non-blocking, so a worker that loses the race for a connection goes back to select().
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(server_address)
+        sock.listen(backlog)
+        sock.setblocking(False)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+def make_server(server_address, handler_class, workers=0, max_inflight=0, sock=None):
+    """Build a plain or pooled HTTPServer, optionally serving an inherited listening `sock` from make_listener
+    to share the port with other processes.
+
+    max_inflight bounds connections being served or waiting for a worker, the excess is shed with 503.
+    """
+    if workers:
+        server = PooledHTTPServer(server_address, handler_class, workers=workers, bind_and_activate=False,
+                                  queue_size=max(max_inflight - workers, 1) if max_inflight else None,
+                                  shed=bool(max_inflight))
+    else:
+        server = HTTPServer(server_address, handler_class, bind_and_activate=False)
+    if sock is not None:
+        server.socket.close()
+        server.socket = sock
+        server.server_address = sock.getsockname()
+        return server
+    try:
+        server.server_bind()
+        server.server_activate()
+    except Exception:
+        server.server_close()
+        raise
+    return server
+
+
+class PreforkSupervisor(object):
+    """Keeps N forked worker processes running, restarts crashed ones and recycles them on SIGHUP.
+
+    `serve(ready)` runs in every child after fork and must build its own server and Store there;
+    it calls ready() once it is accepting connections on the listening socket shared with the others.
+    Workers are forked from the supervisor's own image, so SIGHUP replaces them with fresh processes
+    (new connection pools, caches and log files) but loads no new code and re-reads no options;
+    deploying a new version takes a restart of the supervisor.
+
+    A worker that dies within min_uptime seconds of starting is restarted after a delay that doubles
+    from min_restart_delay up to max_restart_delay, so one failing at startup doesn't fork in a loop.
+    """
+
+    # sent on to every worker, e.g. SIGUSR2 asks profiling workers to dump their profile
+    forwarded_signals = (signal.SIGUSR2,)
+
+    def __init__(self, serve, processes, ready_timeout=10, stop_timeout=30, min_uptime=5, min_restart_delay=0.5,
+                 max_restart_delay=30):
+        self.serve = serve
+        self.processes = int(processes)
+        self.ready_timeout = ready_timeout
+        self.stop_timeout = stop_timeout
+        self.min_uptime = min_uptime
+        self.min_restart_delay = min_restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.restart_delay = 0
+        # time.monotonic() at which each crashed worker's replacement is due
+        self.restarts = []
+        self.children = {}
+        self.started = {}
+        self.generation = 0
+        self.running = False
+        self.reload_requested = False
+
+    def spawn(self):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            for signum in (signal.SIGTERM, signal.SIGHUP, signal.SIGCHLD):
+                signal.signal(signum, signal.SIG_DFL)
+            # forwarded signals only matter to workers that install their own handler for them
+            for signum in (signal.SIGINT,) + self.forwarded_signals:
+                signal.signal(signum, signal.SIG_IGN)
+
+            def ready():
+                os.write(write_fd, b"1")
+                os.close(write_fd)
+
+            code = 0
+            try:
+                self.serve(ready)
+            except Exception:
+                logging.exception("Worker %s failed" % os.getpid())
+                code = 1
+            os._exit(code)
+
+        os.close(write_fd)
+        self.children[pid] = self.generation
+        self.started[pid] = time.monotonic()
+        readable, _, _ = select.select([read_fd], [], [], self.ready_timeout)
+        if not readable or not os.read(read_fd, 1):
+            logging.error("Worker %s did not become ready" % pid)
+        os.close(read_fd)
+        logging.info("Started worker %s" % pid)
+        return pid
+
+    def reap(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            generation = self.children.pop(pid, None)
+            started = self.started.pop(pid, None)
+            if generation == self.generation and self.running:
+                if started is not None and time.monotonic() - started < self.min_uptime:
+                    self.restart_delay = min(self.max_restart_delay,
+                                             max(self.restart_delay * 2, self.min_restart_delay))
+                else:
+                    self.restart_delay = 0
+                logging.error("Worker %s exited with status %s, restarting in %.1fs"
+                              % (pid, status, self.restart_delay))
+                self.restarts.append(time.monotonic() + self.restart_delay)
+
+    def restart_due(self):
+        """Replace crashed workers whose restart delay has passed"""
+        now = time.monotonic()
+        due = [at for at in self.restarts if at <= now]
+        self.restarts = [at for at in self.restarts if at > now]
+        for _ in due:
+            self.spawn()
+
+    def reload(self):
+        """Replace workers one by one, each new worker is ready before an old one is stopped"""
+        logging.info("Recycling workers")
+        self.generation += 1
+        for pid in [pid for pid, generation in self.children.items() if generation != self.generation]:
+            self.spawn()
+            self.terminate(pid)
+
+    def terminate(self, pid):
+        self.kill(pid)
+        self.wait(pid)
+
+    def kill(self, pid, signum=signal.SIGTERM):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def wait(self, pid):
+        deadline = time.monotonic() + self.stop_timeout
+        while time.monotonic() < deadline:
+            try:
+                done, _ = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if done:
+                break
+            time.sleep(0.05)
+        else:
+            logging.error("Worker %s did not stop in time, killing" % pid)
+            self.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        self.children.pop(pid, None)
+        self.started.pop(pid, None)
+
+    def stop(self):
+        self.running = False
+        for pid in list(self.children):
+            self.kill(pid)
+        for pid in list(self.children):
+            self.wait(pid)
+
+    def run(self):
+        def handle_stop(signum, frame):
+            self.running = False
+
+        def handle_reload(signum, frame):
+            self.reload_requested = True
+
+        def forward(signum, frame):
+            for pid in list(self.children):
+                try:
+                    os.kill(pid, signum)
+                except OSError:
+                    pass
+
+        signal.signal(signal.SIGTERM, handle_stop)
+        signal.signal(signal.SIGINT, handle_stop)
+        signal.signal(signal.SIGHUP, handle_reload)
+        for signum in self.forwarded_signals:
+            signal.signal(signum, forward)
+        self.running = True
+        for _ in range(self.processes):
+            self.spawn()
+        while self.running:
+            if self.reload_requested:
+                self.reload_requested = False
+                self.reload()
+            self.reap()
+            self.restart_due()
+            time.sleep(0.1)
+        logging.info("Stopping workers")
+        self.stop()
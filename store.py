@@ -1,57 +1,860 @@
+import asyncio
+import bisect
+import contextlib
+import functools
+import hashlib
+import logging
+import queue
+import random
+import threading
+import time
 import redis
+import redis.asyncio
+from concurrent.futures import ThreadPoolExecutor
+from cache import LRUCache
+from metrics import STORE_RETRIES, WRITE_BEHIND, timed
+
+
+class PoolExhaustedError(redis.exceptions.ConnectionError):
+    """No pooled connection freed up in time; says nothing about the health of Redis itself"""
+
+
+class PoolQueue(queue.LifoQueue):
+    def get(self, block=True, timeout=None):
+        try:
+            return super(PoolQueue, self).get(block, timeout)
+        except queue.Empty:
+            # raised past BlockingConnectionPool, which would turn Empty into a plain ConnectionError
+            raise PoolExhaustedError("No connection available.")
+
+
+class StorePool(redis.BlockingConnectionPool):
+    """Bounded, thread-safe connection pool with idle timeout and usage stats.
+
+    A deadline set with wait_until() caps how long the calling thread waits for a free connection.
+    """
+
+    def __init__(self, idle_timeout=None, **kwargs):
+        self.idle_timeout = idle_timeout
+        self._deadline = threading.local()
+        kwargs.setdefault("queue_class", PoolQueue)
+        super(StorePool, self).__init__(**kwargs)
+
+    @property
+    def timeout(self):
+        # read by BlockingConnectionPool.get_connection as the wait for a free connection
+        deadline = getattr(self._deadline, "value", None)
+        if deadline is None:
+            return self._timeout
+        remaining = max(0.0, deadline - time.monotonic())
+        return remaining if self._timeout is None else min(self._timeout, remaining)
+
+    @timeout.setter
+    def timeout(self, value):
+        self._timeout = value
+
+    @contextlib.contextmanager
+    def wait_until(self, deadline):
+        self._deadline.value = deadline
+        try:
+            yield
+        finally:
+            self._deadline.value = None
+
+    def reset(self):
+        # called from __init__ and again after fork, so stats start from scratch in a child process
+        self._stats_lock = threading.Lock()
+        self._checked_out = set()
+        self._waits = 0
+        self._released_at = {}
+        super(StorePool, self).reset()
+
+    def get_connection(self, *args, **kwargs):
+        if self.pool.empty():
+            with self._stats_lock:
+                self._waits += 1
+        connection = super(StorePool, self).get_connection(*args, **kwargs)
+        released_at = self._released_at.pop(id(connection), None)
+        if self.idle_timeout and released_at is not None and time.monotonic() - released_at > self.idle_timeout:
+            try:
+                connection.disconnect()
+                connection.connect()
+            except BaseException:
+                # give the slot back, the disconnected connection reconnects on its next use
+                self.release(connection)
+                raise
+        with self._stats_lock:
+            self._checked_out.add(id(connection))
+        return connection
+
+    def release(self, connection):
+        # the base class also releases connections that failed to connect, those were never counted
+        with self._stats_lock:
+            self._checked_out.discard(id(connection))
+        self._released_at[id(connection)] = time.monotonic()
+        super(StorePool, self).release(connection)
+
+    def stats(self):
+        with self._stats_lock:
+            in_use, waits = len(self._checked_out), self._waits
+        idle = len([c for c in list(self.pool.queue) if c is not None])
+        return {"in_use": in_use, "idle": idle, "waits": waits, "max": self.max_connections}
+
+
+RETRYABLE_ERRORS = (redis.exceptions.TimeoutError, redis.exceptions.ConnectionError, TimeoutError)
+
+
+class CircuitBreaker(object):
+    """Opens after `threshold` consecutive failures and lets a single probe through every `reset_timeout` seconds"""
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, threshold=5, reset_timeout=10):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        if self.state == self.CLOSED:
+            return True
+        with self._lock:
+            # a probe that never reported back doesn't hold the breaker half-open past another reset_timeout
+            now = time.monotonic()
+            if now - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.opened_at = now
+                return True
+            return False
+
+    def success(self):
+        if self.state != self.CLOSED or self.failures:
+            with self._lock:
+                self.state = self.CLOSED
+                self.failures = 0
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+class WriteBehind(object):
+    """Background thread that batches deferred cache writes into pipelined SETEX.
+
+    The queue is bounded: when Redis can't keep up new writes are dropped rather than
+    blocking request threads. stop() flushes everything queued before it, writes that come
+    later go straight to Redis in the caller's thread.
+    """
+    STOP = object()
+
+    def __init__(self, store, maxsize=10000, batch_size=500):
+        self.store = store
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize)
+        self.stopped = False
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.queue.qsize()
+
+    def put(self, key, value, ttl, deadline=None):
+        """Queue the write; after stop() it goes out right away, within the caller's deadline if given"""
+        # checked and queued under the lock, so nothing can land behind the STOP sentinel
+        with self._lock:
+            if not self.stopped:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self.run, name="write-behind", daemon=True)
+                    self._thread.start()
+                try:
+                    self.queue.put_nowait((key, value, ttl))
+                except queue.Full:
+                    WRITE_BEHIND.inc(("dropped",))
+                    return False
+                WRITE_BEHIND.inc(("queued",))
+                return True
+        self.write([(key, value, ttl)], deadline)
+        return True
+
+    def stop(self, timeout=10):
+        with self._lock:
+            self.stopped = True
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        try:
+            self.queue.put(self.STOP, timeout=timeout)
+        except queue.Full:
+            logging.warning("Write-behind queue is stuck, %s cache writes are lost", self.queue.qsize())
+            return
+        thread.join(timeout)
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if any(item is self.STOP for item in batch):
+                batch = [item for item in batch if item is not self.STOP]
+                stopping = True
+            self.write(batch)
+
+    def write(self, batch, deadline=None):
+        by_ttl = {}
+        for key, value, ttl in batch:
+            by_ttl.setdefault(ttl, []).append((key, value))
+        for ttl, items in by_ttl.items():
+            try:
+                written = self.store.cache_set_many(items, ttl, deadline=deadline)
+            except Exception:
+                logging.exception("Write-behind cache write failed")
+                written = False
+            WRITE_BEHIND.inc(("written" if written else "failed",), len(items))
 
 
 class Store(object):
-    def __init__(self, host='localhost', port=6379, db=0):
+    def __init__(self, host='localhost', port=6379, db=0, max_connections=50, socket_timeout=5,
+                 pool_timeout=5, idle_timeout=300, health_check_interval=30, connection_class=None,
+                 local_cache_size=0, local_cache_ttl=60, backoff_base=0.05, backoff_cap=1.0,
+                 breaker_threshold=5, breaker_reset_timeout=10, write_behind_size=0, write_behind_batch=500):
         self.host = str(host)
         self.port = int(port)
         self.db = int(db)
+        self.max_connections = int(max_connections)
+        self.socket_timeout = socket_timeout
+        self.pool_timeout = pool_timeout
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.connection_class = connection_class
+        # optional in-process tier in front of cache_get, entries never outlive their Redis TTL
+        self.local_cache = LRUCache(local_cache_size, local_cache_ttl) if local_cache_size else None
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset_timeout)
+        # cache_set_later goes through a background queue when enabled, otherwise it writes synchronously
+        self.writer = WriteBehind(self, write_behind_size, write_behind_batch) if write_behind_size else None
+        # called with the key after every successful set(), e.g. to invalidate derived in-process caches
+        self.set_listeners = []
+        self._pool = None
+        self._client = None
+        self._lock = threading.Lock()
 
-    def get(self, key, attempts=5):
-        value = None
-        r = redis.StrictRedis(host=self.host, port=self.port, db=self.db, socket_timeout=5)
-        while attempts > 0:
-            try:
-                value = r.get(key)
-                return value
-            except TimeoutError:
-                attempts -= 1
-                continue
-        if value is None:
-            raise ConnectionError("Can't connect to storage")
+    @property
+    def client(self):
+        """Shared client, the pool is created lazily on first use"""
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    kwargs = {}
+                    if self.connection_class is not None:
+                        kwargs["connection_class"] = self.connection_class
+                    self._pool = StorePool(host=self.host, port=self.port, db=self.db,
+                                           max_connections=self.max_connections,
+                                           timeout=self.pool_timeout,
+                                           socket_timeout=self.socket_timeout,
+                                           idle_timeout=self.idle_timeout,
+                                           health_check_interval=self.health_check_interval,
+                                           **kwargs)
+                    self._client = redis.StrictRedis(connection_pool=self._pool)
+        return self._client
+
+    def pool_stats(self):
+        if self._pool is None:
+            return {"in_use": 0, "idle": 0, "waits": 0, "max": self.max_connections}
+        return self._pool.stats()
+
+    def local_cache_stats(self):
+        if self.local_cache is None:
+            return {"hits": 0, "misses": 0, "evictions": 0, "size": 0}
+        return self.local_cache.stats()
+
+    def write_behind_depth(self):
+        return len(self.writer) if self.writer is not None else 0
+
+    def open_circuits(self):
+        return int(self.breaker.state != CircuitBreaker.CLOSED)
 
-    def set(self, key, value, attempts=5):
-        r = redis.StrictRedis(host=self.host, port=self.port, db=self.db, socket_timeout=5)
-        while attempts > 0:
+    def close(self):
+        if self.writer is not None:
+            self.writer.stop()
+        if self._pool is not None:
+            self._pool.disconnect()
+
+    def with_deadline(self, deadline):
+        """View of this store that passes `deadline` (a time.monotonic() value) to every call"""
+        return DeadlineStore(self, deadline)
+
+    def _call(self, operation, fn, attempts, deadline=None):
+        """Run fn with jittered exponential backoff, never through an open breaker.
+
+        No attempt starts past the deadline, but one already running can take up to socket_timeout,
+        so a deadline isn't a hard bound. Every allow() is followed by a call to fn, otherwise
+        the single half-open probe would never report back.
+        """
+        if deadline is not None and time.monotonic() >= deadline:
+            raise ConnectionError("Storage deadline exceeded")
+        if not self.breaker.allow():
+            raise ConnectionError("Storage is unavailable")
+        pool = self._pool
+        for attempt in range(attempts):
             try:
-                r.set(key, value)
-                return True
-            except TimeoutError:
-                attempts -= 1
+                if pool is None:
+                    result = fn()
+                else:
+                    with pool.wait_until(deadline):
+                        result = fn()
+            except PoolExhaustedError:
+                # Redis wasn't reached, so neither a breaker failure nor worth a retry; a half-open probe
+                # lost this way is replaced after reset_timeout
+                raise ConnectionError("No storage connection available")
+            except RETRYABLE_ERRORS:
+                self.breaker.failure()
+                if attempt + 1 >= attempts:
+                    break
+                delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+                if deadline is not None and time.monotonic() + delay >= deadline:
+                    break
+                if not self.breaker.allow():
+                    break
+                STORE_RETRIES.inc((operation,))
+                time.sleep(delay)
                 continue
-        return False
+            except Exception:
+                # Redis answered, e.g. with an error reply, so the connection itself is healthy
+                self.breaker.success()
+                raise
+            except BaseException:
+                self.breaker.failure()
+                raise
+            self.breaker.success()
+            return result
+        raise ConnectionError("Can't connect to storage")
 
-    def cache_get(self, key, attempts=1):
-        r = redis.StrictRedis(host=self.host, port=self.port, db=self.db, socket_timeout=5)
-        while attempts > 0:
-            try:
-                value = r.get(key)
+    def scan(self, match, count=1000):
+        """Iterate over keys matching the pattern with SCAN, without blocking Redis like KEYS would"""
+        return self.client.scan_iter(match=match, count=count)
+
+    @timed("get")
+    def get(self, key, attempts=5, deadline=None):
+        r = self.client
+        return self._call("get", lambda: r.get(key), attempts, deadline)
+
+    @timed("get_many")
+    def get_many(self, keys, attempts=5, chunk_size=1000, deadline=None):
+        """Return values for keys in the same order, one MGET round trip per chunk"""
+        values = []
+        r = self.client
+        for start in range(0, len(keys), chunk_size):
+            chunk = keys[start:start + chunk_size]
+            values.extend(self._call("get_many", lambda: r.mget(chunk), attempts, deadline))
+        return values
+
+    @timed("set")
+    def set(self, key, value, attempts=5, deadline=None):
+        r = self.client
+        try:
+            self._call("set", lambda: r.set(key, value), attempts, deadline)
+        except ConnectionError:
+            return False
+        for listener in self.set_listeners:
+            listener(key)
+        return True
+
+    def add_set_listener(self, listener):
+        self.set_listeners.append(listener)
+
+    @timed("incr")
+    def incr(self, key, amount=1, ttl=None, attempts=1, deadline=None):
+        """INCRBY and, with ttl, EXPIRE in one round trip; None when storage is unavailable"""
+        r = self.client
+
+        def incr():
+            pipe = r.pipeline(transaction=False)
+            pipe.incrby(key, amount)
+            if ttl:
+                pipe.expire(key, ttl)
+            return pipe.execute()[0]
+
+        try:
+            return self._call("incr", incr, attempts, deadline)
+        except ConnectionError:
+            return None
+
+    @timed("cache_get")
+    def cache_get(self, key, attempts=1, deadline=None):
+        if self.local_cache is not None:
+            value = self.local_cache.get(key)
+            if value is not None:
                 return value
-            except TimeoutError:
-                attempts -= 1
-                continue
-        return None
+        r = self.client
+        try:
+            if self.local_cache is None:
+                return self._call("cache_get", lambda: r.get(key), attempts, deadline)
+            # fetch the remaining TTL in the same round trip to keep the local copy from outliving Redis
+            value, pttl = self._call("cache_get", lambda: r.pipeline(transaction=False).get(key).pttl(key).execute(),
+                                     attempts, deadline)
+        except ConnectionError:
+            return None
+        if value is not None and pttl > 0:
+            self.local_cache.set(key, value, pttl / 1000.0)
+        return value
+
+    @timed("cache_get_many")
+    def cache_get_many(self, keys, attempts=1, chunk_size=1000, deadline=None):
+        """Like cache_get for many keys, unavailable storage reads as a miss"""
+        values = [None] * len(keys)
+        remote = list(range(len(keys)))
+        if self.local_cache is not None:
+            remote = []
+            for i, key in enumerate(keys):
+                values[i] = self.local_cache.get(key)
+                if values[i] is None:
+                    remote.append(i)
+        if not remote:
+            return values
+        try:
+            fetched = self.get_many([keys[i] for i in remote], attempts=attempts, chunk_size=chunk_size,
+                                    deadline=deadline)
+        except ConnectionError:
+            return values
+        for i, value in zip(remote, fetched):
+            values[i] = value
+        return values
+
+    @timed("cache_set_many")
+    def cache_set_many(self, items, time, attempts=5, chunk_size=1000, deadline=None):
+        """SETEX every (key, value) pair, one pipeline round trip per chunk, False if a chunk failed"""
+        r = self.client
+        items = list(items)
+        for start in range(0, len(items), chunk_size):
+            chunk = items[start:start + chunk_size]
+
+            def write():
+                pipe = r.pipeline(transaction=False)
+                for key, value in chunk:
+                    pipe.setex(key, time, value)
+                pipe.execute()
 
-    def cache_set(self, key, value, time, attempts=5):
-        while attempts > 0:
             try:
-                r = redis.StrictRedis(host=self.host, port=self.port, db=self.db, socket_timeout=5)
-                r.setex(key, time, value)
-                return
-            except TimeoutError:
-                attempts -= 1
-                continue
-        return
+                self._call("cache_set_many", write, attempts, deadline)
+            except ConnectionError:
+                return False
+            if self.local_cache is not None:
+                encoder = r.connection_pool.get_encoder()
+                for key, value in chunk:
+                    self.local_cache.set(key, encoder.encode(value), time)
+        return True
+
+    @timed("cache_set")
+    def cache_set(self, key, value, time, attempts=5, deadline=None):
+        r = self.client
+        try:
+            self._call("cache_set", lambda: r.setex(key, time, value), attempts, deadline)
+        except ConnectionError:
+            return
+        if self.local_cache is not None:
+            # keep the same bytes Redis would return for this value
+            self.local_cache.set(key, r.connection_pool.get_encoder().encode(value), time)
+
+    def cache_set_later(self, key, value, time, deadline=None):
+        """cache_set off the request path when write-behind is enabled, otherwise within the deadline"""
+        if self.writer is None:
+            return self.cache_set(key, value, time, deadline=deadline)
+        self.writer.put(key, value, time, deadline)
+
+
+class DeadlineStore(object):
+    """Passes a per-request deadline down to every Store call that accepts one"""
+    deadline_aware = ("get", "get_many", "set", "cache_get", "cache_get_many", "cache_set", "cache_set_many",
+                      "cache_set_later")
+
+    def __init__(self, store, deadline):
+        self._store = store
+        self._deadline = deadline
+
+    def __getattr__(self, name):
+        attr = getattr(self._store, name)
+        if name in self.deadline_aware:
+            return functools.partial(attr, deadline=self._deadline)
+        return attr
+
+
+class PrefetchedStore(object):
+    """Serves reads from values fetched up front in one round trip, everything else goes to the wrapped store"""
+
+    def __init__(self, store, values):
+        self._store = store
+        self._values = values
+
+    def __getattr__(self, name):
+        return getattr(self._store, name)
+
+    def get(self, key, *args, **kwargs):
+        if key in self._values:
+            return self._values[key]
+        return self._store.get(key, *args, **kwargs)
+
+    def cache_get(self, key, *args, **kwargs):
+        if key in self._values:
+            return self._values[key]
+        return self._store.cache_get(key, *args, **kwargs)
+
+    def get_many(self, keys, *args, **kwargs):
+        missing = [key for key in keys if key not in self._values]
+        fetched = dict(zip(missing, self._store.get_many(missing, *args, **kwargs))) if missing else {}
+        return [self._values[key] if key in self._values else fetched[key] for key in keys]
+
+
+class HashRing(object):
+    """Consistent hash ring with virtual nodes, adding or removing a node remaps only ~1/N of the keys"""
+
+    def __init__(self, nodes=(), vnodes=160):
+        self.vnodes = vnodes
+        self._hashes = []
+        self._nodes = []
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], "big")
+
+    def add(self, node):
+        for vnode in range(self.vnodes):
+            h = self.hash("%s#%s" % (node, vnode))
+            i = bisect.bisect(self._hashes, h)
+            self._hashes.insert(i, h)
+            self._nodes.insert(i, node)
+
+    def remove(self, node):
+        points = [(h, n) for h, n in zip(self._hashes, self._nodes) if n != node]
+        self._hashes = [h for h, n in points]
+        self._nodes = [n for h, n in points]
+
+    def get(self, key):
+        if not self._nodes:
+            raise LookupError("Hash ring is empty")
+        return self._nodes[bisect.bisect(self._hashes, self.hash(key)) % len(self._nodes)]
+
+
+def parse_node(node):
+    """"host:port" or (host, port) -> (host, port)"""
+    if isinstance(node, str):
+        host, _, port = node.rpartition(":")
+        return host or "localhost", int(port)
+    return node[0], int(node[1])
+
+
+class ShardedStore(object):
+    """Store interface over several Redis nodes, keys are routed by a consistent hash ring.
+
+    nodes are "host:port" strings; replicas maps a node to its read replicas, which serve reads of
+    keys starting with one of replica_prefixes (the interests keyspace by default), falling back to
+    the primary when a replica is unavailable. Bulk calls are split per shard and run in parallel,
+    one group on the calling thread. Every shard is a regular Store built with **kwargs.
+    """
+
+    def __init__(self, nodes, replicas=None, vnodes=160, replica_prefixes=("i:",), **kwargs):
+        self.names = ["%s:%s" % parse_node(node) for node in nodes]
+        self.shards = {}
+        for name in self.names:
+            host, port = parse_node(name)
+            self.shards[name] = Store(host, port, **kwargs)
+        self.replicas = {}
+        for node, addresses in (replicas or {}).items():
+            name = "%s:%s" % parse_node(node)
+            self.replicas[name] = [Store(*parse_node(address), **kwargs) for address in addresses]
+        self.replica_prefixes = tuple(replica_prefixes)
+        self.ring = HashRing(self.names, vnodes)
+        # every caller runs one group itself, so it needs a thread for each other shard; shard pools cap how
+        # many calls can use them at once, threads beyond that would only wait for a connection
+        self.max_workers = max(1, (len(self.shards) - 1) * int(kwargs.get("max_connections", 50)))
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="shard")
+        return self._executor
+
+    def shard(self, key):
+        return self.shards[self.ring.get(key)]
+
+    def reader(self, key, chosen=None):
+        """(store to read from, its primary) for a key; `chosen` keeps one replica per shard across calls"""
+        name = self.ring.get(key)
+        primary = self.shards[name]
+        replicas = self.replicas.get(name)
+        if replicas and key.startswith(self.replica_prefixes):
+            if chosen is None:
+                return random.choice(replicas), primary
+            if name not in chosen:
+                chosen[name] = random.choice(replicas)
+            return chosen[name], primary
+        return primary, primary
+
+    def _parallel(self, calls):
+        if len(calls) == 1:
+            return [calls[0]()]
+        futures = [self.executor.submit(call) for call in calls[1:]]
+        return [calls[0]()] + [future.result() for future in futures]
+
+    def _group(self, keys, route):
+        groups = {}
+        for i, key in enumerate(keys):
+            groups.setdefault(route(key), []).append(i)
+        return groups
+
+    @staticmethod
+    def _read(store, primary, method, *args, **kwargs):
+        try:
+            return getattr(store, method)(*args, **kwargs)
+        except ConnectionError:
+            if store is primary:
+                raise
+            return getattr(primary, method)(*args, **kwargs)
+
+    def pool_stats(self):
+        stats = {"in_use": 0, "idle": 0, "waits": 0, "max": 0}
+        for store in self.all_stores():
+            for name, value in store.pool_stats().items():
+                stats[name] += value
+        return stats
+
+    def local_cache_stats(self):
+        stats = {"hits": 0, "misses": 0, "evictions": 0, "size": 0}
+        for store in self.shards.values():
+            for name, value in store.local_cache_stats().items():
+                stats[name] += value
+        return stats
+
+    def write_behind_depth(self):
+        return sum(store.write_behind_depth() for store in self.shards.values())
+
+    def open_circuits(self):
+        return sum(store.open_circuits() for store in self.all_stores())
+
+    def all_stores(self):
+        stores = list(self.shards.values())
+        for replicas in self.replicas.values():
+            stores.extend(replicas)
+        return stores
+
+    def close(self):
+        for store in self.all_stores():
+            store.close()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def with_deadline(self, deadline):
+        return DeadlineStore(self, deadline)
+
+    def scan(self, match, count=1000):
+        for store in self.shards.values():
+            for key in store.scan(match, count):
+                yield key
+
+    def get(self, key, *args, **kwargs):
+        store, primary = self.reader(key)
+        return self._read(store, primary, "get", key, *args, **kwargs)
+
+    def get_many(self, keys, *args, **kwargs):
+        values = [None] * len(keys)
+        # one replica per shard for the whole call, so each shard's keys go out in one MGET
+        chosen = {}
+        groups = list(self._group(keys, lambda key: self.reader(key, chosen)).items())
+        results = self._parallel([
+            functools.partial(self._read, store, primary, "get_many", [keys[i] for i in indexes], *args, **kwargs)
+            for (store, primary), indexes in groups])
+        for (_, indexes), fetched in zip(groups, results):
+            for i, value in zip(indexes, fetched):
+                values[i] = value
+        return values
+
+    def set(self, key, *args, **kwargs):
+        return self.shard(key).set(key, *args, **kwargs)
+
+    def add_set_listener(self, listener):
+        for store in self.shards.values():
+            store.add_set_listener(listener)
+
+    def incr(self, key, *args, **kwargs):
+        return self.shard(key).incr(key, *args, **kwargs)
+
+    def cache_get(self, key, *args, **kwargs):
+        return self.shard(key).cache_get(key, *args, **kwargs)
+
+    def cache_get_many(self, keys, *args, **kwargs):
+        values = [None] * len(keys)
+        groups = list(self._group(keys, self.shard).items())
+        results = self._parallel([functools.partial(store.cache_get_many, [keys[i] for i in indexes], *args, **kwargs)
+                                  for store, indexes in groups])
+        for (_, indexes), fetched in zip(groups, results):
+            for i, value in zip(indexes, fetched):
+                values[i] = value
+        return values
+
+    def cache_set(self, key, *args, **kwargs):
+        return self.shard(key).cache_set(key, *args, **kwargs)
+
+    def cache_set_later(self, key, *args, **kwargs):
+        return self.shard(key).cache_set_later(key, *args, **kwargs)
+
+    def cache_set_many(self, items, *args, **kwargs):
+        groups = {}
+        for key, value in items:
+            groups.setdefault(self.shard(key), []).append((key, value))
+        return all(self._parallel([functools.partial(store.cache_set_many, shard_items, *args, **kwargs)
+                                   for store, shard_items in groups.items()]))
+
+
+class AsyncStore(object):
+    """Store counterpart for asyncio servers, backed by redis.asyncio.
+
+    Calls go through the same jittered backoff, deadline and circuit breaker as Store. With a deadline
+    every attempt, the wait for a pooled connection included, is cut off at it.
+    """
+
+    def __init__(self, host='localhost', port=6379, db=0, max_connections=50, socket_timeout=5,
+                 pool_timeout=5, health_check_interval=30, backoff_base=0.05, backoff_cap=1.0,
+                 breaker_threshold=5, breaker_reset_timeout=10):
+        self.host = str(host)
+        self.port = int(port)
+        self.db = int(db)
+        self.max_connections = int(max_connections)
+        self.socket_timeout = socket_timeout
+        self.pool_timeout = pool_timeout
+        self.health_check_interval = health_check_interval
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset_timeout)
+        self._pool = None
+        self._client = None
+
+    @property
+    def client(self):
+        # no lock needed, the event loop runs this on a single thread
+        if self._client is None:
+            self._pool = redis.asyncio.BlockingConnectionPool(host=self.host, port=self.port, db=self.db,
+                                                              max_connections=self.max_connections,
+                                                              timeout=self.pool_timeout,
+                                                              socket_timeout=self.socket_timeout,
+                                                              health_check_interval=self.health_check_interval)
+            self._client = redis.asyncio.StrictRedis(connection_pool=self._pool)
+        return self._client
+
+    def pool_stats(self):
+        if self._pool is None:
+            return {"in_use": 0, "idle": 0, "waits": 0, "max": self.max_connections}
+        return {"in_use": len(self._pool._in_use_connections), "idle": len(self._pool._available_connections),
+                "waits": 0, "max": self.max_connections}
+
+    def local_cache_stats(self):
+        return {"hits": 0, "misses": 0, "evictions": 0, "size": 0}
+
+    def write_behind_depth(self):
+        return 0
+
+    def open_circuits(self):
+        return int(self.breaker.state != CircuitBreaker.CLOSED)
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.disconnect()
+
+    def with_deadline(self, deadline):
+        """View of this store that passes `deadline` (a time.monotonic() value) to every call"""
+        return DeadlineStore(self, deadline)
+
+    async def _call(self, operation, fn, attempts, deadline=None):
+        """Store._call for coroutines: fn() returns a new awaitable for every attempt"""
+        if deadline is not None and time.monotonic() >= deadline:
+            raise ConnectionError("Storage deadline exceeded")
+        if not self.breaker.allow():
+            raise ConnectionError("Storage is unavailable")
+        for attempt in range(attempts):
+            try:
+                if deadline is None:
+                    result = await fn()
+                else:
+                    result = await asyncio.wait_for(fn(), max(0.0, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                if deadline is not None and time.monotonic() >= deadline:
+                    # cut off by the deadline, which says nothing about Redis; a lost half-open probe is
+                    # replaced after reset_timeout
+                    raise ConnectionError("Storage deadline exceeded")
+                self.breaker.failure()
+            except RETRYABLE_ERRORS:
+                self.breaker.failure()
+            except Exception:
+                # Redis answered, e.g. with an error reply, so the connection itself is healthy
+                self.breaker.success()
+                raise
+            except BaseException:
+                self.breaker.failure()
+                raise
+            else:
+                self.breaker.success()
+                return result
+            if attempt + 1 >= attempts:
+                break
+            delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                break
+            if not self.breaker.allow():
+                break
+            STORE_RETRIES.inc((operation,))
+            await asyncio.sleep(delay)
+        raise ConnectionError("Can't connect to storage")
+
+    async def get(self, key, attempts=5, deadline=None):
+        r = self.client
+        return await self._call("get", lambda: r.get(key), attempts, deadline)
+
+    async def get_many(self, keys, attempts=5, chunk_size=1000, deadline=None):
+        r = self.client
+        chunks = [keys[start:start + chunk_size] for start in range(0, len(keys), chunk_size)]
+        calls = [self._call("get_many", functools.partial(r.mget, chunk), attempts, deadline) for chunk in chunks]
+        values = []
+        for chunk_values in await asyncio.gather(*calls):
+            values.extend(chunk_values)
+        return values
+
+    async def set(self, key, value, attempts=5, deadline=None):
+        r = self.client
+        try:
+            await self._call("set", lambda: r.set(key, value), attempts, deadline)
+        except ConnectionError:
+            return False
+        return True
+
+    async def cache_get(self, key, attempts=1, deadline=None):
+        r = self.client
+        try:
+            return await self._call("cache_get", lambda: r.get(key), attempts, deadline)
+        except ConnectionError:
+            return None
+
+    async def cache_set(self, key, value, time, attempts=5, deadline=None):
+        r = self.client
+        try:
+            await self._call("cache_set", lambda: r.setex(key, time, value), attempts, deadline)
+        except ConnectionError:
+            return
 
 
 if __name__ == '__main__':
@@ -61,7 +864,3 @@ if __name__ == '__main__':
     print(lst)
     lst = store.get('key2')
     print(lst)
-
-
-
-
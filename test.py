@@ -1,9 +1,41 @@
+import array
+import asyncio
+import http.client
+import json
+import logging
+import os
+import queue
+import shutil
+import signal
+import socket
+import tempfile
+import threading
 import unittest
+import time
+import urllib.request
+import redis
+from http.server import BaseHTTPRequestHandler
+import admission
 import api
-from store import Store
+import bench
+import microbench
+import metrics
+import logs
+import scoring
+import interests
+import migrate_interests
+import prewarm
+import async_api
+import streaming
+from store import AsyncStore, CircuitBreaker, Store, ShardedStore, HashRing
+from admission import RateLimiter, RedisRateLimiter, limit_keys
+from cache import LRUCache, SingleFlight
+from fake_redis import FakeRedisServer
+from server import PooledHTTPServer, PreforkSupervisor, install_shutdown_handler, make_listener, make_server
+from profiler import SamplingProfiler, DEBUG_HEADER
 import hashlib
 import datetime
-from unittest.mock import patch
+from unittest.mock import patch, AsyncMock, Mock
 from six import string_types
 
 
@@ -59,6 +91,50 @@ class TestFields(unittest.TestCase):
         self.assertRaises(ValueError, field.validate, value)
 
 
+class TestRequests(unittest.TestCase):
+    def test_values_are_parsed_once(self):
+        r = api.OnlineScoreRequest(gender=1, birthday="01.08.2004", extra="value")
+        r.validate()
+        self.assertTrue(r.is_valid())
+        self.assertFalse(hasattr(r, "__dict__"))
+        self.assertEqual(r["birthday"], datetime.datetime(2004, 8, 1))
+        self.assertIs(r["birthday"], r["birthday"])
+        self.assertEqual(r.base_fields, ["gender", "birthday", "extra"])
+        self.assertEqual(r.extra, "value")
+        self.assertIsNone(r.phone)
+
+    def test_error_messages(self):
+        r = api.OnlineScoreRequest(phone="", email="stupnikov@otus.ru", birthday="01.07.1920", gender=1)
+        r.validate()
+        self.assertEqual({k: str(v) for k, v in r.errors.items()},
+                         {"phone": "Incorect phone number format, should be 7XXXXXXXXXX",
+                          "birthday": "Incorrect birth day"})
+
+
+class TestTokenVerifier(unittest.TestCase):
+    def test_user_digest_is_cached(self):
+        verifier = api.TokenVerifier(maxsize=2)
+        key = "horns&hoofs" + "h&f" + api.SALT
+        token = hashlib.sha512(key.encode('utf-8')).hexdigest()
+        request = api.MethodRequest(account="horns&hoofs", login="h&f", token=token)
+        self.assertTrue(verifier.verify(request))
+        self.assertTrue(verifier.verify(request))
+        self.assertFalse(verifier.verify(api.MethodRequest(account="horns&hoofs", login="h&f", token=None)))
+        self.assertEqual(verifier.stats(), {"hits": 2, "misses": 1, "failures": 1})
+        # unverified logins never take a slot
+        for i in range(3):
+            self.assertFalse(verifier.matches("horns&hoofs", "random%s" % i, token))
+        self.assertTrue(verifier.verify(request))
+        self.assertEqual(verifier.stats()["hits"], 3)
+        self.assertEqual(len(verifier.digests), 1)
+
+    def test_admin_grace_window(self):
+        verifier = api.TokenVerifier(admin_grace=60)
+        previous = verifier.admin_digest(datetime.datetime(2024, 1, 1, 9, 59, 59))
+        self.assertIn(previous, verifier.admin_digests(datetime.datetime(2024, 1, 1, 10, 0, 30)))
+        self.assertNotIn(previous, verifier.admin_digests(datetime.datetime(2024, 1, 1, 10, 1, 0)))
+
+
 class TestSuite(unittest.TestCase):
     def setUp(self):
         self.context = {}
@@ -167,7 +243,7 @@ class TestSuite(unittest.TestCase):
         self.assertEqual(api.INVALID_REQUEST, code)
         self.assertTrue(len(response))
 
-    @patch('store.Store.get', return_value=b"['books','hi-tech']")
+    @patch('store.Store.get_many', side_effect=lambda keys: [b"['books','hi-tech']"] * len(keys))
     @cases([
         {"client_ids": [1, 2, 3], "date": datetime.datetime.today().strftime("%d.%m.%Y")},
         {"client_ids": [1, 2], "date": "08.04.2018"},
@@ -183,6 +259,1476 @@ class TestSuite(unittest.TestCase):
                             for v in response.values()))
         self.assertEqual(self.context.get("nclients"), len(arguments["client_ids"]))
 
+    @patch('store.Store.get_many', side_effect=lambda keys: [b"['books','hi-tech']"] * len(keys))
+    def test_interests_request_fetches_in_one_batch(self, get_many):
+        arguments = {"client_ids": [1, 2, 1, 3, 2]}
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests", "arguments": arguments}
+        self.generate_token(request)
+        response, code = self.get_response(request)
+        self.assertEqual(api.OK, code)
+        get_many.assert_called_once_with(["i:1", "i:2", "i:3"])
+        self.assertEqual(sorted(response), [1, 2, 3])
+
+    @patch('store.Store.get_many', side_effect=lambda keys: [b"['books','hi-tech']"] * len(keys))
+    def test_interests_response_cache(self, get_many):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                   "arguments": {"client_ids": [1, 2]}}
+        self.generate_token(request)
+        with patch.object(api.MainHTTPHandler, 'interests_cache', scoring.InterestsCache()):
+            response, code = self.get_response(request)
+            etag = self.context["etag"]
+            request["arguments"]["client_ids"] = [2, 1, 2]
+            self.assertEqual(self.get_response(request), (response, code))
+            self.assertEqual(get_many.call_count, 1)
+            self.assertEqual(self.context["etag"], etag)
+            api.MainHTTPHandler.interests_cache.invalidate("i:2")
+            self.get_response(request)
+            self.assertEqual(get_many.call_count, 2)
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.context = {}
+        self.store = Store()
+
+    def make_item(self, method, arguments, login="h&f"):
+        item = {"account": "horns&hoofs", "login": login, "method": method, "arguments": arguments}
+        key = item["account"] + item["login"] + api.SALT
+        item["token"] = hashlib.sha512(key.encode('utf-8')).hexdigest()
+        return item
+
+    @patch('store.Store.cache_set')
+    @patch('store.Store.get_many', side_effect=lambda keys, **kwargs: [b"['books']" if k.startswith("i:") else None
+                                                                       for k in keys])
+    def test_batch_prefetches_in_one_round_trip(self, get_many, cache_set):
+        items = [
+            self.make_item("online_score", {"phone": "79198802222", "email": "stupnikov@otus.ru"}),
+            self.make_item("clients_interests", {"client_ids": [1, 2]}),
+            self.make_item("clients_interests", {"client_ids": [2, 3]}),
+        ]
+        validate = api.BaseRequest.validate
+        with patch.object(api.BaseRequest, "validate", autospec=True, side_effect=validate) as validated:
+            response, code = api.batch_handler({"body": items, "headers": {}}, self.context, self.store)
+        self.assertEqual(api.OK, code)
+        # one interests MGET, the score key goes through cache_get_many's own
+        self.assertEqual(get_many.call_count, 2)
+        self.assertEqual([len(call[0][0]) for call in get_many.call_args_list], [1, 3])
+        # every item's method request and arguments validated once
+        self.assertEqual(validated.call_count, 6)
+        self.assertEqual(response[0], {"response": {"score": 3.0}, "code": api.OK})
+        self.assertEqual(response[2], {"response": {2: ["books"], 3: ["books"]}, "code": api.OK})
+
+    @patch('store.Store.get_many', side_effect=lambda keys, **kwargs: [None for _ in keys])
+    def test_batch_prefetch_uses_local_cache(self, get_many):
+        store = Store(local_cache_size=10)
+        arguments = {"first_name": "a", "last_name": "b"}
+        store.local_cache.set(api.score_key("a", "b"), b"2.5", 60)
+        items = [self.make_item("online_score", arguments), self.make_item("clients_interests", {"client_ids": [1]})]
+        response, code = api.batch_handler({"body": items, "headers": {}}, self.context, store)
+        self.assertEqual(response[0], {"response": {"score": 2.5}, "code": api.OK})
+        self.assertEqual([call[0][0] for call in get_many.call_args_list], [["i:1"]])
+
+    @patch('store.Store.get_many', side_effect=lambda keys, **kwargs: [b"['books']"] * len(keys))
+    def test_batch_skips_interests_cache_hits(self, get_many):
+        cache = scoring.InterestsCache()
+        cache.set([1, 2], ({1: ["cars"], 2: ["cars"]}, '"etag"'), cache.sequence())
+        items = [self.make_item("clients_interests", {"client_ids": [2, 1]}),
+                 self.make_item("clients_interests", {"client_ids": [3]})]
+        with patch.object(api.MainHTTPHandler, 'interests_cache', cache):
+            response, code = api.batch_handler({"body": items, "headers": {}}, self.context, self.store)
+        self.assertEqual(response[0], {"response": {1: ["cars"], 2: ["cars"]}, "code": api.OK})
+        self.assertEqual([call[0][0] for call in get_many.call_args_list], [["i:3"]])
+        self.assertEqual(cache.stats()["hits"], 1)
+
+    @patch('store.Store.get_many', return_value=[])
+    def test_batch_item_errors_are_isolated(self, get_many):
+        items = [
+            self.make_item("online_score", {"phone": "79198802222", "email": "stupnikov@otus.ru"}, login="admin"),
+            self.make_item("online_score", {}),
+            "not a request",
+            {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "token": "", "arguments": {}},
+            None,
+            1,
+        ]
+        with patch("api.logging.exception") as logged:
+            response, code = api.batch_handler({"body": items, "headers": {}}, self.context, self.store)
+        self.assertEqual(api.OK, code)
+        self.assertEqual([r["code"] for r in response],
+                         [api.FORBIDDEN, api.INVALID_REQUEST, api.INVALID_REQUEST, api.FORBIDDEN,
+                          api.INVALID_REQUEST, api.INVALID_REQUEST])
+        logged.assert_not_called()
+        get_many.assert_not_called()
+
+    @patch('store.Store.cache_set')
+    @patch('store.Store.get_many', side_effect=lambda keys, **kwargs: [None for _ in keys])
+    def test_batch_item_field_error_is_serializable(self, get_many, cache_set):
+        items = [
+            self.make_item("online_score", {"first_name": "a", "last_name": "b"}),
+            self.make_item("online_score", {"phone": "123", "email": "stupnikov@otus.ru"}),
+        ]
+        response, code = api.batch_handler({"body": items, "headers": {}}, self.context, self.store)
+        self.assertEqual(api.OK, code)
+        response = json.loads(json.dumps(response))
+        self.assertEqual(response[0], {"response": {"score": 0.5}, "code": api.OK})
+        self.assertEqual(response[1],
+                         {"error": {"phone": "Incorect phone number format, should be 7XXXXXXXXXX"},
+                          "code": api.INVALID_REQUEST})
+
+    def test_batch_must_be_array(self):
+        _, code = api.batch_handler({"body": {}, "headers": {}}, self.context, self.store)
+        self.assertEqual(api.INVALID_REQUEST, code)
+
+
+class TestAsyncSuite(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.context = {}
+        self.store = AsyncMock()
+        self.store.cache_get.return_value = None
+        self.store.get_many.side_effect = lambda keys: [b"['books','hi-tech']"] * len(keys)
+
+    async def get_response(self, request):
+        return await async_api.method_handler({"body": request, "headers": {}}, self.context, self.store)
+
+    def generate_token(self, request):
+        key = request.get("account", "") + request.get("login", "") + api.SALT
+        request["token"] = hashlib.sha512(key.encode('utf-8')).hexdigest()
+
+    async def test_valid_score_request(self):
+        arguments = {"phone": "79198802222", "email": "stupnikov@otus.ru"}
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "arguments": arguments}
+        self.generate_token(request)
+        response, code = await self.get_response(request)
+        self.assertEqual(api.OK, code)
+        self.assertEqual(response, {"score": 3.0})
+        self.store.cache_set.assert_awaited_once()
+
+    async def test_valid_interests_request(self):
+        arguments = {"client_ids": [1, 2, 2]}
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests", "arguments": arguments}
+        self.generate_token(request)
+        response, code = await self.get_response(request)
+        self.assertEqual(api.OK, code)
+        self.assertEqual(response, {1: ["books", "hi-tech"], 2: ["books", "hi-tech"]})
+        self.store.get_many.assert_awaited_once_with(["i:1", "i:2"])
+
+    async def test_bad_auth(self):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "token": "",
+                   "arguments": {}}
+        _, code = await self.get_response(request)
+        self.assertEqual(api.FORBIDDEN, code)
+
+    async def test_matches_sync_context(self):
+        self.assertEqual(set(async_api.METHODS), set(api.METHODS))
+        arguments = {"client_ids": [1, 2]}
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests", "arguments": arguments}
+        self.generate_token(request)
+        await self.get_response(request)
+        context = {}
+        with patch('store.Store.get_many', side_effect=lambda keys: [b"['books','hi-tech']"] * len(keys)):
+            api.method_handler({"body": request, "headers": {}}, context, Store())
+        self.assertEqual({name: self.context.get(name) for name in ("method", "nclients", "etag")},
+                         {name: context.get(name) for name in ("method", "nclients", "etag")})
+
+    async def test_not_modified(self):
+        server = async_api.AsyncHTTPServer(self.store)
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                   "arguments": {"client_ids": [1]}}
+        self.generate_token(request)
+        data = json.dumps(request).encode('utf-8')
+        requests = metrics.REQUESTS.value(("clients_interests", api.OK))
+        code, _, headers = await server.process("/method", {}, data)
+        self.assertEqual(code, api.OK)
+        self.assertEqual(metrics.REQUESTS.value(("clients_interests", api.OK)), requests + 1)
+        code, _, _ = await server.process("/method", {"If-None-Match": dict(headers)["ETag"]}, data)
+        self.assertEqual(code, api.NOT_MODIFIED)
+        writer = Mock()
+        writer.drain = AsyncMock()
+        await server.send(writer, code, {}, True, headers)
+        self.assertNotIn(b"Content-Length", writer.write.call_args[0][0])
+
+    async def test_async_store_backoff_and_deadline(self):
+        store = AsyncStore(backoff_base=10, backoff_cap=10, breaker_threshold=1, breaker_reset_timeout=60)
+        with patch.object(AsyncStore, 'client') as client:
+            client.get = AsyncMock(side_effect=redis.exceptions.TimeoutError())
+            started = time.monotonic()
+            with self.assertRaises(ConnectionError):
+                await store.with_deadline(time.monotonic() + 0.05).get("i:1")
+            self.assertLess(time.monotonic() - started, 1)
+            self.assertEqual(client.get.await_count, 1)
+            self.assertEqual(store.open_circuits(), 1)
+            self.assertIsNone(await store.cache_get("uid:1"))
+            self.assertEqual(client.get.await_count, 1)
+
+    async def test_async_store_call_is_cut_at_deadline(self):
+        store = AsyncStore(breaker_threshold=1)
+
+        async def hang(key):
+            await asyncio.sleep(5)
+
+        with patch.object(AsyncStore, 'client') as client:
+            client.get = hang
+            client.set = lambda key, value: hang(key)
+            started = time.monotonic()
+            self.assertIsNone(await store.with_deadline(time.monotonic() + 0.05).cache_get("i:1"))
+            self.assertFalse(await store.with_deadline(time.monotonic() + 0.05).set("i:1", "[]"))
+            self.assertLess(time.monotonic() - started, 1)
+        # running out of time says nothing about Redis
+        self.assertEqual(store.open_circuits(), 0)
+
+    async def test_negative_length_is_refused(self):
+        server = async_api.AsyncHTTPServer(self.store)
+        listener = await server.start("localhost", 0)
+        reader, writer = await asyncio.open_connection("localhost", listener.sockets[0].getsockname()[1])
+        try:
+            writer.write(b"POST /method HTTP/1.1\r\nHost: localhost\r\nContent-Length: -1\r\n\r\n{}")
+            data = await reader.read()
+        finally:
+            writer.close()
+            await server.stop()
+        self.assertTrue(data.startswith(b"HTTP/1.1 400"))
+
+    async def test_metrics_route(self):
+        server = async_api.AsyncHTTPServer(self.store)
+        listener = await server.start("localhost", 0)
+        reader, writer = await asyncio.open_connection("localhost", listener.sockets[0].getsockname()[1])
+        try:
+            writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+            data = await reader.read()
+        finally:
+            writer.close()
+            await server.stop()
+        self.assertTrue(data.startswith(b"HTTP/1.1 200"))
+        self.assertIn(b"Content-Type: text/plain", data)
+        self.assertIn(b"# TYPE api_requests_total counter", data)
+        store = AsyncStore(breaker_threshold=1)
+        store.breaker.failure()
+        # serve() points the storage gauges at the AsyncStore
+        with patch.object(api.MainHTTPHandler, "store", store):
+            self.assertIn("store_circuit_open 1", metrics.REGISTRY.render())
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_eviction(self):
+        cache = LRUCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual((cache.get("a"), cache.get("b"), cache.get("c")), (1, None, 3))
+        self.assertEqual(cache.stats(), {"hits": 3, "misses": 1, "evictions": 1, "size": 2})
+
+    def test_expiry_uses_shortest_ttl(self):
+        cache = LRUCache(maxsize=2, ttl=60)
+        with patch('cache.time.monotonic', return_value=100):
+            cache.set("a", 1, ttl=5)
+        with patch('cache.time.monotonic', return_value=104):
+            self.assertEqual(cache.get("a"), 1)
+        with patch('cache.time.monotonic', return_value=106):
+            self.assertIsNone(cache.get("a"))
+
+
+class TestSingleFlight(unittest.TestCase):
+    def test_waiters_share_leader_result(self):
+        flights = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        calls, results = [], []
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 42
+
+        leader = threading.Thread(target=lambda: results.append(flights.do("k", compute)))
+        leader.start()
+        started.wait(5)
+        waiters = [threading.Thread(target=lambda: results.append(flights.do("k", compute))) for _ in range(3)]
+        for t in waiters:
+            t.start()
+        time.sleep(0.05)
+        release.set()
+        for t in [leader] + waiters:
+            t.join(5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results), [(42, False), (42, True), (42, True), (42, True)])
+        self.assertEqual(len(flights), 0)
+
+    def test_error_is_shared_and_not_cached(self):
+        flights = SingleFlight()
+        self.assertRaises(ValueError, flights.do, "k", lambda: int("x"))
+        self.assertEqual(flights.do("k", lambda: 1), (1, False))
+
+
+class DictStore(object):
+    def __init__(self):
+        self.data = {}
+
+    def cache_get(self, key):
+        return self.data.get(key)
+
+    def cache_get_many(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def cache_set(self, key, value, time):
+        self.data[key] = str(value).encode('utf-8')
+
+    def cache_set_later(self, key, value, time):
+        self.cache_set(key, value, time)
+
+    def cache_set_many(self, items, time):
+        for key, value in items:
+            self.cache_set(key, value, time)
+
+
+class TestScoring(unittest.TestCase):
+    records = [
+        {"phone": "79198802222", "email": "stupnikov@otus.ru"},
+        {"first_name": "a", "last_name": "b", "phone": "79198802222"},
+        {"first_name": "a", "last_name": "b"},
+        {"gender": 1, "birthday": datetime.datetime(2004, 8, 1)},
+        {"gender": 0, "birthday": datetime.datetime(2004, 8, 1), "email": "stupnikov@otus.ru"},
+        {},
+        {"phone": "79198802222", "email": "stupnikov@otus.ru"},
+    ]
+
+    def test_get_scores_matches_get_score(self):
+        store, batch_store = DictStore(), DictStore()
+        batch_store.data[scoring.score_key("x", "y")] = b"5.0"
+        store.data[scoring.score_key("x", "y")] = b"5.0"
+        records = self.records + [{"first_name": "x", "last_name": "y"}]
+        expected = [scoring.get_score(store, r.get("phone"), r.get("email"), birthday=r.get("birthday"),
+                                      gender=r.get("gender"), first_name=r.get("first_name"),
+                                      last_name=r.get("last_name")) for r in records]
+        self.assertEqual(scoring.get_scores(batch_store, records), expected)
+        self.assertEqual(batch_store.data, store.data)
+
+    def test_get_scores_columns(self):
+        columns = {name: [r.get(name) for r in self.records] for name in scoring.PROFILE_FIELDS}
+        self.assertEqual(scoring.get_scores(DictStore(), columns), scoring.get_scores(DictStore(), self.records))
+
+    def test_zero_score_is_served_from_cache(self):
+        store = DictStore()
+        store.cache_set = Mock(wraps=store.cache_set)
+        self.assertEqual(scoring.get_score(store, None, None), 0)
+        self.assertEqual(scoring.get_score(store, None, None), 0)
+        self.assertEqual(store.cache_set.call_count, 1)
+
+    def test_concurrent_misses_compute_once(self):
+        store = DictStore()
+        barrier = threading.Barrier(4)
+        original = store.cache_set
+
+        def slow_cache_set(key, value, time_):
+            time.sleep(0.05)
+            original(key, value, time_)
+
+        def missing_cache_get(key):
+            # every thread misses before any of them starts computing
+            barrier.wait(5)
+
+        store.cache_set = Mock(side_effect=slow_cache_set)
+        store.cache_get = missing_cache_get
+        waiters = metrics.SCORE_FLIGHTS.value(("waiter",))
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(scoring.get_score(store, "79175002040", None)))
+                   for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(5)
+        self.assertEqual(results, [1.5] * 4)
+        self.assertEqual(store.cache_set.call_count, 1)
+        self.assertEqual(metrics.SCORE_FLIGHTS.value(("waiter",)) - waiters, 3)
+
+    def test_interests_encoding(self):
+        values = ["books", "hi-tech", "otus", "knitting", "вязание"]
+        packed = interests.encode(values)
+        self.assertTrue(interests.is_binary(packed))
+        self.assertEqual(scoring.decode_interests(packed), values)
+        self.assertEqual(interests.encode(["cars", "pets"]), b"\x00\x01\x01\x02")
+        self.assertEqual(scoring.decode_interests(interests.HEADER), [])
+
+    def test_legacy_interests_are_decoded(self):
+        self.assertEqual(scoring.decode_interests(str(["books", "tv"]).encode('utf-8')), ["books", "tv"])
+        self.assertEqual(scoring.decode_interests(None), [])
+
+    def test_migrate_interests(self):
+        server = FakeRedisServer().start()
+        store = Store(port=server.port)
+        try:
+            store.client.set("i:1", str(["books", "tv"]))
+            store.client.set("i:2", str(["cars"]), ex=100)
+            scoring.set_interests(store, 3, ["geek"])
+            store.client.set("uid:1", "5")
+            stats = migrate_interests.migrate(store, batch=2, dry_run=True)
+            self.assertEqual(store.client.get("i:1"), b"['books', 'tv']")
+            stats = migrate_interests.migrate(store, batch=2)
+            self.assertEqual((stats["scanned"], stats["converted"], stats["skipped"]), (3, 2, 1))
+            self.assertLess(stats["bytes_after"], stats["bytes_before"])
+            self.assertTrue(interests.is_binary(store.client.get("i:1")))
+            self.assertEqual(scoring.get_interests(store, 1), ["books", "tv"])
+            self.assertEqual(scoring.get_interests(store, 2), ["cars"])
+            self.assertGreater(store.client.ttl("i:2"), 0)
+            self.assertEqual(store.client.get("uid:1"), b"5")
+        finally:
+            store.close()
+            server.stop()
+
+    def test_migrate_counts_malformed_values(self):
+        server = FakeRedisServer().start()
+        store = Store(port=server.port)
+        try:
+            store.client.set("i:1", "[1, 2]")
+            store.client.set("i:2", str({"a": 1}))
+            store.client.set("i:3", "not json")
+            store.client.set("i:4", str(["books"]))
+            stats = migrate_interests.migrate(store)
+            self.assertEqual((stats["scanned"], stats["converted"], stats["failed"]), (4, 1, 3))
+            self.assertEqual(store.client.get("i:1"), b"[1, 2]")
+            self.assertEqual(store.client.get("i:2"), b"{'a': 1}")
+            self.assertEqual(scoring.get_interests(store, 4), ["books"])
+        finally:
+            store.close()
+            server.stop()
+
+    def test_migrate_keeps_concurrent_write(self):
+        server = FakeRedisServer().start()
+        store, writer = Store(port=server.port), Store(port=server.port)
+        decode_legacy = interests.decode_legacy
+        writes = []
+
+        def racing_decode(value):
+            # another client updates the key between the migration's read and its rewrite
+            if not writes:
+                writes.append(scoring.set_interests(writer, 1, ["music"]))
+            return decode_legacy(value)
+
+        try:
+            store.client.set("i:1", str(["books", "tv"]))
+            store.client.set("i:2", str(["cars"]))
+            with patch("interests.decode_legacy", side_effect=racing_decode):
+                stats = migrate_interests.migrate(store)
+            self.assertEqual(scoring.get_interests(store, 1), ["music"])
+            self.assertEqual(scoring.get_interests(store, 2), ["cars"])
+            self.assertTrue(interests.is_binary(store.client.get("i:2")))
+            self.assertEqual((stats["scanned"], stats["converted"], stats["skipped"]), (2, 1, 1))
+        finally:
+            store.close()
+            writer.close()
+            server.stop()
+
+
+class StubConnection(object):
+    def __init__(self, **kwargs):
+        self.pid = os.getpid()
+
+    def connect(self):
+        pass
+
+    def can_read(self, timeout=0):
+        return False
+
+    def disconnect(self, *args, **kwargs):
+        pass
+
+    def should_reconnect(self):
+        return False
+
+
+class TestStore(unittest.TestCase):
+    def setUp(self):
+        self.store = Store(max_connections=1, pool_timeout=0.01, connection_class=StubConnection)
+
+    def test_client_is_shared(self):
+        self.assertIs(self.store.client, self.store.client)
+
+    def test_pool_stats(self):
+        self.store.client
+        connection = self.store._pool.get_connection()
+        self.assertEqual(self.store.pool_stats()["in_use"], 1)
+        self.assertRaises(Exception, self.store._pool.get_connection)
+        self.store._pool.release(connection)
+        stats = self.store.pool_stats()
+        self.assertEqual((stats["in_use"], stats["idle"], stats["waits"]), (0, 1, 1))
+
+    def test_failed_idle_reconnect_keeps_slot(self):
+        store = Store(max_connections=1, pool_timeout=0.01, idle_timeout=0.01, connection_class=StubConnection)
+        store.client
+        store._pool.release(store._pool.get_connection())
+        time.sleep(0.02)
+        # the base pool connects first, the idle reconnect after it is refused
+        with patch.object(StubConnection, "connect", side_effect=[None, redis.exceptions.ConnectionError()]):
+            self.assertRaises(redis.exceptions.ConnectionError, store._pool.get_connection)
+        stats = store.pool_stats()
+        self.assertEqual((stats["in_use"], stats["idle"]), (0, 1))
+        store._pool.release(store._pool.get_connection())
+
+    def test_local_cache(self):
+        store = Store(local_cache_size=10, local_cache_ttl=60)
+        with patch.object(Store, 'client') as client:
+            client.pipeline.return_value.get.return_value.pttl.return_value.execute.return_value = [b"3.0", 5000]
+            self.assertEqual(store.cache_get("uid:1"), b"3.0")
+            self.assertEqual(store.cache_get("uid:1"), b"3.0")
+            self.assertEqual(client.pipeline.call_count, 1)
+            client.connection_pool.get_encoder.return_value.encode.return_value = b"1.5"
+            store.cache_set("uid:2", 1.5, 3600)
+            self.assertEqual(store.cache_get("uid:2"), b"1.5")
+            client.setex.assert_called_once_with("uid:2", 3600, 1.5)
+        self.assertEqual(store.local_cache_stats()["hits"], 2)
+
+    def test_circuit_breaker(self):
+        store = Store(backoff_base=0, breaker_threshold=3, breaker_reset_timeout=60)
+        with patch.object(Store, 'client') as client:
+            client.get.side_effect = redis.exceptions.TimeoutError()
+            self.assertRaises(ConnectionError, store.get, "i:1")
+            self.assertEqual(client.get.call_count, 3)
+            self.assertEqual(store.breaker.state, "open")
+            self.assertIsNone(store.cache_get("uid:1"))
+            self.assertIsNone(store.cache_set("uid:1", 1, 60))
+            self.assertFalse(store.set("i:1", "[]"))
+            self.assertEqual(client.get.call_count, 3)
+            client.setex.assert_not_called()
+
+    def test_breaker_half_open_probe(self):
+        store = Store(backoff_base=0, breaker_threshold=1, breaker_reset_timeout=60)
+        with patch.object(Store, 'client') as client:
+            client.get.side_effect = [redis.exceptions.ConnectionError(), b"1"]
+            self.assertRaises(ConnectionError, store.get, "i:1")
+            self.assertEqual(client.get.call_count, 1)
+            store.breaker.reset_timeout = 0
+            self.assertEqual(store.get("i:1"), b"1")
+            self.assertEqual(store.breaker.state, "closed")
+
+    def test_expired_deadline_keeps_half_open_probe(self):
+        server = FakeRedisServer().start()
+        store = Store(port=server.port, breaker_threshold=1, breaker_reset_timeout=0.05)
+        try:
+            store.breaker.failure()
+            time.sleep(0.06)
+            self.assertRaises(ConnectionError, store.get, "x", deadline=time.monotonic() - 1)
+            self.assertEqual(store.breaker.state, "open")
+            time.sleep(0.06)
+            self.assertIsNone(store.get("x"))
+            self.assertEqual(store.breaker.state, "closed")
+        finally:
+            store.close()
+            server.stop()
+
+    def test_exhausted_pool_is_not_a_redis_failure(self):
+        server = FakeRedisServer().start()
+        store = Store(port=server.port, max_connections=1, pool_timeout=5, breaker_threshold=1)
+        try:
+            store.client
+            connection = store._pool.get_connection()
+            started = time.monotonic()
+            self.assertRaises(ConnectionError, store.with_deadline(time.monotonic() + 0.05).get, "x")
+            # the wait for a free connection ends at the deadline, not after pool_timeout
+            self.assertLess(time.monotonic() - started, 1)
+            self.assertEqual(store.breaker.state, "closed")
+            store._pool.release(connection)
+            self.assertIsNone(store.get("x"))
+            self.assertEqual(store._pool.timeout, 5)
+        finally:
+            store.close()
+            server.stop()
+
+    def test_lost_probe_is_replaced(self):
+        breaker = CircuitBreaker(threshold=1, reset_timeout=0.05)
+        breaker.failure()
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+
+    def test_retries_count_only_repeated_attempts(self):
+        store = Store(backoff_base=0)
+        retries = metrics.STORE_RETRIES.value(("get",))
+        with patch.object(Store, 'client') as client:
+            client.get.side_effect = redis.exceptions.TimeoutError()
+            self.assertRaises(ConnectionError, store.get, "i:1", attempts=1)
+            self.assertEqual(metrics.STORE_RETRIES.value(("get",)), retries)
+            self.assertRaises(ConnectionError, store.get, "i:1", attempts=3)
+            self.assertEqual(metrics.STORE_RETRIES.value(("get",)) - retries, 2)
+
+    def test_deadline_stops_retries(self):
+        store = Store(backoff_base=10, backoff_cap=10)
+        with patch.object(Store, 'client') as client:
+            client.get.side_effect = redis.exceptions.TimeoutError()
+            started = time.monotonic()
+            self.assertRaises(ConnectionError, store.with_deadline(time.monotonic() + 0.05).get, "i:1")
+            self.assertLess(time.monotonic() - started, 1)
+
+    def test_write_behind_batches_and_flushes_on_close(self):
+        store = Store(write_behind_size=100, write_behind_batch=50)
+        with patch.object(Store, 'cache_set_many', return_value=True) as cache_set_many:
+            for i in range(10):
+                store.cache_set_later("uid:%s" % i, i, 3600)
+            store.close()
+        written = [item for call in cache_set_many.call_args_list for item in call[0][0]]
+        self.assertEqual(written, [("uid:%s" % i, i) for i in range(10)])
+        self.assertLess(cache_set_many.call_count, 10)
+        self.assertEqual(store.write_behind_depth(), 0)
+
+    def test_write_behind_after_stop(self):
+        store = Store(write_behind_size=100)
+        with patch.object(Store, 'cache_set_many', return_value=True) as cache_set_many:
+            store.cache_set_later("uid:1", 1, 3600)
+            store.close()
+            # a write after stop() doesn't start another consumer, it goes out right away
+            store.cache_set_later("uid:2", 2, 3600)
+            self.assertIsNone(store.writer._thread)
+            self.assertEqual(cache_set_many.call_args_list[-1][0], ([("uid:2", 2)], 3600))
+            # a sentinel anywhere in a batch ends the loop without reaching write()
+            store.writer.queue.put(store.writer.STOP)
+            store.writer.queue.put(("uid:3", 3, 60))
+            store.writer.run()
+            self.assertEqual(cache_set_many.call_args_list[-1][0], ([("uid:3", 3)], 60))
+        self.assertEqual(store.write_behind_depth(), 0)
+
+    def test_synchronous_cache_set_later_keeps_deadline(self):
+        store = Store(backoff_base=10, backoff_cap=10)
+        with patch.object(Store, 'client') as client:
+            client.setex.side_effect = redis.exceptions.TimeoutError()
+            started = time.monotonic()
+            store.with_deadline(time.monotonic() + 0.05).cache_set_later("uid:1", 1, 3600)
+            self.assertLess(time.monotonic() - started, 1)
+            self.assertEqual(client.setex.call_count, 1)
+
+    def test_write_behind_drops_on_overflow(self):
+        store = Store(write_behind_size=1)
+        store.writer._thread = threading.current_thread()
+        dropped = metrics.WRITE_BEHIND.value(("dropped",))
+        self.assertTrue(store.writer.put("uid:1", 1, 60))
+        self.assertFalse(store.writer.put("uid:2", 2, 60))
+        self.assertEqual(metrics.WRITE_BEHIND.value(("dropped",)) - dropped, 1)
+
+    def test_get_many_chunks(self):
+        with patch.object(Store, 'client') as client:
+            client.mget.side_effect = lambda keys: [k.encode('utf-8') for k in keys]
+            keys = ["i:%s" % i for i in range(5)]
+            self.assertEqual(self.store.get_many(keys, chunk_size=2), [k.encode('utf-8') for k in keys])
+            self.assertEqual(client.mget.call_count, 3)
+
+
+class TestHashRing(unittest.TestCase):
+    def test_adding_node_remaps_few_keys(self):
+        ring = HashRing(["a:1", "b:1", "c:1", "d:1"])
+        keys = ["uid:%s" % i for i in range(10000)]
+        before = {key: ring.get(key) for key in keys}
+        ring.add("e:1")
+        moved = [key for key in keys if ring.get(key) != before[key]]
+        self.assertLess(len(moved), len(keys) * 0.3)
+        self.assertTrue(all(ring.get(key) == "e:1" for key in moved))
+        ring.remove("e:1")
+        self.assertEqual({key: ring.get(key) for key in keys}, before)
+
+
+class TestShardedStore(unittest.TestCase):
+    def setUp(self):
+        self.servers = [FakeRedisServer().start() for _ in range(4)]
+        self.nodes = ["localhost:%s" % server.port for server in self.servers[:3]]
+        self.replica = "localhost:%s" % self.servers[3].port
+        self.store = ShardedStore(self.nodes, {self.nodes[0]: [self.replica]}, backoff_base=0)
+
+    def tearDown(self):
+        self.store.close()
+        for server in self.servers:
+            server.stop()
+
+    def test_keys_are_spread_and_read_back(self):
+        keys = ["uid:%s" % i for i in range(60)]
+        self.assertTrue(self.store.cache_set_many([(key, i) for i, key in enumerate(keys)], 60))
+        self.assertEqual(self.store.cache_get_many(keys), [str(i).encode('ascii') for i in range(60)])
+        self.assertTrue(all(server.data for server in self.servers[:3]))
+        for key in keys[:5]:
+            self.assertIn(key.encode('utf-8'), self.servers[self.nodes.index(self.store.ring.get(key))].data)
+        self.assertEqual(sorted(self.store.scan("uid:*")), sorted(key.encode('utf-8') for key in keys))
+
+    def test_interests_read_from_replica(self):
+        key = next("i:%s" % i for i in range(100) if self.store.ring.get("i:%s" % i) == self.nodes[0])
+        other = next("i:%s" % i for i in range(100) if self.store.ring.get("i:%s" % i) != self.nodes[0])
+        self.store.set(key, "primary")
+        self.store.set(other, "other")
+        self.servers[3].data[key.encode('utf-8')] = (b"replica", None)
+        self.assertEqual(self.store.get(key), b"replica")
+        self.assertEqual(self.store.get_many([key, other]), [b"replica", b"other"])
+        self.servers[3].stop()
+        self.assertEqual(self.store.get_many([key, other], attempts=1), [b"primary", b"other"])
+
+
+    def test_bulk_calls_of_concurrent_callers_overlap(self):
+        store = ShardedStore(["localhost:1", "localhost:2"], max_connections=16)
+        lock = threading.Lock()
+        inflight = [0, 0]
+
+        def slow_get_many(shard, keys, *args, **kwargs):
+            with lock:
+                inflight[0] += 1
+                inflight[1] = max(inflight)
+            time.sleep(0.05)
+            with lock:
+                inflight[0] -= 1
+            return [None] * len(keys)
+
+        keys = ["uid:%s" % i for i in range(20)]
+        with patch.object(Store, "get_many", autospec=True, side_effect=slow_get_many):
+            threads = [threading.Thread(target=store.get_many, args=(keys,)) for _ in range(16)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        store.close()
+        self.assertGreater(inflight[1], 16)
+
+    def test_one_replica_per_shard_and_call(self):
+        store = ShardedStore(["localhost:1"], {"localhost:1": ["localhost:2", "localhost:3"]})
+        keys = ["i:%s" % i for i in range(50)]
+        with patch.object(Store, "get_many", autospec=True, side_effect=lambda shard, keys: [None] * len(keys)) as mget:
+            store.get_many(keys)
+        self.assertEqual(mget.call_count, 1)
+        self.assertIn(mget.call_args[0][0], store.replicas["localhost:1"])
+
+
+class BarrierHandler(BaseHTTPRequestHandler):
+    barrier = threading.Barrier(2, timeout=5)
+
+    def do_GET(self):
+        self.barrier.wait()
+        self.send_response(api.OK)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestPooledHTTPServer(unittest.TestCase):
+    def test_requests_are_served_concurrently(self):
+        server = PooledHTTPServer(("localhost", 0), BarrierHandler, workers=2)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = "http://localhost:%s/" % server.server_address[1]
+        codes = []
+        clients = [threading.Thread(target=lambda: codes.append(urllib.request.urlopen(url).status))
+                   for _ in range(2)]
+        for t in clients:
+            t.start()
+        for t in clients:
+            t.join()
+        server.shutdown()
+        server.server_close()
+        self.assertEqual(codes, [api.OK, api.OK])
+
+
+class PidHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = str(os.getpid()).encode('ascii')
+        self.send_response(api.OK)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestPreforkSupervisor(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.listener = make_listener(("localhost", 0))
+        self.port = self.listener.getsockname()[1]
+
+    def tearDown(self):
+        self.listener.close()
+        for pid in self.workers():
+            os.kill(pid, signal.SIGKILL)
+        shutil.rmtree(self.directory)
+
+    def serve(self, ready):
+        server = make_server(("localhost", self.port), PidHandler, workers=2, sock=self.listener)
+        install_shutdown_handler(server)
+        open(os.path.join(self.directory, str(os.getpid())), "w").close()
+        ready()
+        server.serve_forever()
+        server.server_close()
+
+    def workers(self):
+        """pids of started workers that haven't been reaped yet"""
+        alive = set()
+        for name in os.listdir(self.directory):
+            try:
+                os.kill(int(name), 0)
+            except ProcessLookupError:
+                continue
+            alive.add(int(name))
+        return alive
+
+    def wait_for(self, predicate, timeout=10):
+        deadline = time.monotonic() + timeout
+        while not predicate():
+            if time.monotonic() > deadline:
+                self.fail("Timed out, workers: %s" % self.workers())
+            time.sleep(0.05)
+
+    def get(self):
+        connection = http.client.HTTPConnection("localhost", self.port, timeout=5)
+        try:
+            connection.request("GET", "/")
+            response = connection.getresponse()
+            return response.status, response.read()
+        finally:
+            connection.close()
+
+    def test_restart_reload_and_stop(self):
+        supervisor = os.fork()
+        if supervisor == 0:
+            code = 1
+            try:
+                PreforkSupervisor(self.serve, 2, stop_timeout=5).run()
+                code = 0
+            finally:
+                os._exit(code)
+        try:
+            self.wait_for(lambda: len(self.workers()) == 2)
+            first = self.workers()
+            self.assertEqual(self.get()[0], api.OK)
+
+            crashed = first.pop()
+            os.kill(crashed, signal.SIGKILL)
+            self.wait_for(lambda: crashed not in self.workers() and len(self.workers()) == 2)
+            generation = self.workers()
+            self.assertIn(first.pop(), generation)
+
+            failures, served, stop = [], set(), threading.Event()
+
+            def load():
+                while not stop.is_set():
+                    try:
+                        status, body = self.get()
+                        served.add(int(body))
+                        if status != api.OK:
+                            failures.append(status)
+                    except OSError as e:
+                        failures.append(e)
+
+            client = threading.Thread(target=load)
+            client.start()
+            try:
+                os.kill(supervisor, signal.SIGHUP)
+                self.wait_for(lambda: not self.workers() & generation and len(self.workers()) == 2)
+                reloaded = self.workers()
+                time.sleep(0.2)
+            finally:
+                stop.set()
+                client.join()
+            self.assertEqual(failures, [])
+            self.assertTrue(served & reloaded)
+
+            os.kill(supervisor, signal.SIGTERM)
+            _, status = os.waitpid(supervisor, 0)
+            self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+            self.assertEqual(self.workers(), set())
+        finally:
+            try:
+                os.kill(supervisor, signal.SIGKILL)
+                os.waitpid(supervisor, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+
+
+    def test_crash_at_startup_backs_off(self):
+        def crash(ready):
+            raise RuntimeError("bad config")
+
+        supervisor = PreforkSupervisor(crash, 1, ready_timeout=5, min_restart_delay=0.2, max_restart_delay=0.3)
+        supervisor.running = True
+        with patch("server.logging"), patch("logging.exception"):
+            supervisor.spawn()
+            delays = []
+            for _ in range(3):
+                self.wait_for(lambda: supervisor.reap() or not supervisor.children)
+                delays.append(supervisor.restart_delay)
+                supervisor.restart_due()
+                self.assertEqual(supervisor.children, {})
+                time.sleep(supervisor.restart_delay + 0.05)
+                supervisor.restart_due()
+                self.assertEqual(len(supervisor.children), 1)
+            supervisor.stop()
+        self.assertEqual(delays, [0.2, 0.3, 0.3])
+
+
+class KeepAliveHandler(bench.QuietHandler):
+    max_keepalive_requests = 2
+
+
+class TestKeepAlive(unittest.TestCase):
+    def setUp(self):
+        self.server = PooledHTTPServer(("localhost", 0), KeepAliveHandler, workers=2)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.port = self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def read_responses(self, sock, count):
+        data = b""
+        while data.count(b"HTTP/1.1 ") < count or not data.endswith(b"}"):
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def test_connection_is_reused_up_to_limit(self):
+        connection = http.client.HTTPConnection("localhost", self.port, timeout=5)
+        connection.request("GET", "/metrics")
+        response = connection.getresponse()
+        response.read()
+        self.assertIsNone(response.getheader("Connection"))
+        self.assertIsNotNone(response.getheader("Content-Length"))
+        sock = connection.sock
+        connection.request("GET", "/metrics")
+        response = connection.getresponse()
+        response.read()
+        self.assertIs(connection.sock, None)
+        self.assertEqual(response.getheader("Connection"), "close")
+        self.assertIsNotNone(sock)
+        connection.close()
+
+    def test_pipelined_requests(self):
+        body = b'{"a": 1}'
+        request = b"POST /unknown HTTP/1.1\r\nHost: localhost\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body)
+        with socket.create_connection(("localhost", self.port), timeout=5) as sock:
+            sock.sendall(request * 2)
+            data = self.read_responses(sock, 2)
+        self.assertEqual(data.count(b"HTTP/1.1 404"), 2)
+
+    def test_idle_connections_give_up_workers(self):
+        idle = []
+        for _ in range(3):
+            connection = http.client.HTTPConnection("localhost", self.port, timeout=5)
+            connection.request("GET", "/metrics")
+            connection.getresponse().read()
+            idle.append(connection)
+        started = time.monotonic()
+        with urllib.request.urlopen("http://localhost:%s/metrics" % self.port, timeout=5) as response:
+            self.assertEqual(response.status, api.OK)
+        self.assertLess(time.monotonic() - started, 1)
+        # idle connections don't hold up the shutdown drain either
+        idle[0] = http.client.HTTPConnection("localhost", self.port, timeout=5)
+        idle[0].request("GET", "/metrics")
+        idle[0].getresponse().read()
+        started = time.monotonic()
+        self.server.shutdown()
+        self.server.server_close()
+        self.assertLess(time.monotonic() - started, 1)
+        for connection in idle:
+            connection.close()
+
+    def test_field_error_is_answered(self):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "arguments": {"phone": "123"}}
+        key = request["account"] + request["login"] + api.SALT
+        request["token"] = hashlib.sha512(key.encode('utf-8')).hexdigest()
+        connection = http.client.HTTPConnection("localhost", self.port, timeout=5)
+        try:
+            connection.request("POST", "/method", json.dumps(request))
+            response = connection.getresponse()
+            body = json.loads(response.read())
+        finally:
+            connection.close()
+        self.assertEqual(response.status, api.INVALID_REQUEST)
+        self.assertEqual(body, {"error": {"phone": "Incorect phone number format, should be 7XXXXXXXXXX"},
+                                "code": api.INVALID_REQUEST})
+
+    def test_empty_batch(self):
+        connection = http.client.HTTPConnection("localhost", self.port, timeout=5)
+        try:
+            connection.request("POST", "/batch", "[]")
+            response = connection.getresponse()
+            body = json.loads(response.read())
+        finally:
+            connection.close()
+        self.assertEqual(body, {"response": [], "code": api.OK})
+
+    def test_unserializable_response_is_500(self):
+        with patch.dict(api.MainHTTPHandler.router, {"odd": lambda request, ctx, store: (object(), api.OK)}):
+            connection = http.client.HTTPConnection("localhost", self.port, timeout=5)
+            try:
+                connection.request("POST", "/odd", '{"a": 1}')
+                response = connection.getresponse()
+                body = json.loads(response.read())
+            finally:
+                connection.close()
+        self.assertEqual(response.status, api.INTERNAL_ERROR)
+        self.assertEqual(body["code"], api.INTERNAL_ERROR)
+
+    def test_bad_request_closes_connection(self):
+        with socket.create_connection(("localhost", self.port), timeout=5) as sock:
+            sock.sendall(b"POST /method HTTP/1.1\r\nHost: localhost\r\nContent-Length: 1\r\n\r\n{")
+            data = self.read_responses(sock, 1)
+            self.assertIn(b"HTTP/1.1 400", data)
+            self.assertIn(b"Connection: close", data)
+            self.assertEqual(sock.recv(1), b"")
+
+
+class InterestsServerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = PooledHTTPServer(("localhost", 0), bench.QuietHandler, workers=1)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.port = self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def post(self, headers=None, client_ids=(1, 2)):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                   "arguments": {"client_ids": list(client_ids)}}
+        key = request["account"] + request["login"] + api.SALT
+        request["token"] = hashlib.sha512(key.encode('utf-8')).hexdigest()
+        connection = http.client.HTTPConnection("localhost", self.port, timeout=5)
+        try:
+            connection.request("POST", "/method", json.dumps(request), headers or {})
+            response = connection.getresponse()
+            return response, response.read()
+        finally:
+            connection.close()
+
+
+class TestConditionalInterests(InterestsServerTest):
+    @patch('store.Store.get_many', side_effect=lambda keys, **kwargs: [b"['books','hi-tech']"] * len(keys))
+    def test_not_modified(self, get_many):
+        response, body = self.post()
+        self.assertEqual(response.status, api.OK)
+        etag = response.getheader("ETag")
+        self.assertTrue(etag)
+        response, body = self.post({"If-None-Match": '"other", %s' % etag})
+        self.assertEqual((response.status, body), (api.NOT_MODIFIED, b""))
+        self.assertIsNone(response.getheader("Content-Length"))
+        self.assertEqual(response.getheader("ETag"), etag)
+        response, body = self.post({"If-None-Match": '"other"'})
+        self.assertEqual(response.status, api.OK)
+
+
+class TestStreaming(InterestsServerTest):
+    def test_parse_body_reads_client_ids_into_array(self):
+        request = {"method": "clients_interests", "token": "]", "arguments": {"client_ids": list(range(5000)),
+                                                                             "date": "01.01.2020"}}
+        data = json.dumps(request).encode('utf-8')
+        parsed = streaming.parse_body(data)
+        self.assertIsInstance(parsed["arguments"]["client_ids"], array.array)
+        self.assertEqual(parsed["arguments"]["client_ids"].tolist(), request["arguments"]["client_ids"])
+        self.assertEqual(dict(parsed, arguments=dict(parsed["arguments"], client_ids=[])),
+                         dict(request, arguments=dict(request["arguments"], client_ids=[])))
+        ids = streaming.read_ids(b"[1, 22,\n333 ,4]", 1, 14, window=6)
+        self.assertEqual(ids.tolist(), [1, 22, 333, 4])
+
+    @cases([
+        b'{"arguments": {"client_ids": [1, 2]}}',
+        b'{"arguments": {"client_ids": [1, -2]}}',
+        b'{"arguments": {"client_ids": [1, 2.5]}}',
+        b'{"arguments": {"client_ids": [1, "2"]}}',
+        b'{"arguments": {"client_ids": [01, 2]}}',
+        b'{"arguments": {"client_ids": [1, 2,]}}',
+        b'{"arguments": {"client_ids": [1, 99999999999999999999]}}',
+        b'{"arguments": {"client_ids": [1, 2], "client_ids": null}}',
+        b'{"arguments": {"x": {"client_ids": [1, 2]}}}',
+        b'{"login": "{\\"client_ids\\": [1, 2]}", "arguments": {"client_ids": []}}',
+        b'[{"arguments": {"client_ids": [1, 2]}}]',
+    ])
+    def test_parse_body_falls_back_to_json(self, data):
+        try:
+            expected = json.loads(data)
+        except ValueError:
+            self.assertRaises(ValueError, streaming.parse_body, data, 0)
+            return
+        parsed = streaming.parse_body(data, 0)
+        if isinstance(parsed, dict) and isinstance(parsed["arguments"].get("client_ids"), array.array):
+            parsed["arguments"]["client_ids"] = parsed["arguments"]["client_ids"].tolist()
+        self.assertEqual(parsed, expected)
+
+    def test_client_ids_field_accepts_array(self):
+        field = api.ClientIDsField()
+        field.validate(array.array('q', [1, 2]))
+        self.assertRaises(ValueError, field.validate, array.array('q', [1, -2]))
+        self.assertRaises(ValueError, field.validate, array.array('d', [1.5]))
+
+    @patch('store.Store.get_many', side_effect=lambda keys, **kwargs: [b"['books']"] * len(keys))
+    def test_large_response_is_chunked(self, get_many):
+        with patch.object(api.MainHTTPHandler, 'stream_min_clients', 3):
+            response, body = self.post(client_ids=[5, 3, 1, 3, 2])
+        self.assertEqual(response.status, api.OK)
+        self.assertEqual(response.getheader("Transfer-Encoding"), "chunked")
+        self.assertIsNone(response.getheader("ETag"))
+        self.assertEqual(json.loads(body), {"response": {str(cid): ["books"] for cid in (1, 2, 3, 5)},
+                                            "code": api.OK})
+        self.assertEqual(list(scoring.iter_interests(Store(), [3, 1, 2, 1], batch_size=2)),
+                         [{1: ["books"], 2: ["books"]}, {3: ["books"]}])
+        self.assertEqual(b"".join(streaming.StreamedResponse(iter([])).chunks(api.OK)),
+                         b'{"response": {}, "code": 200}')
+
+    def test_failed_stream_is_cut_short(self):
+        values = [[b"['books']"] * 1000, ConnectionError("down")]
+        with patch.object(api.MainHTTPHandler, 'stream_min_clients', 3), \
+                patch('store.Store.get_many', side_effect=values):
+            self.assertRaises(http.client.IncompleteRead, self.post, client_ids=range(1500))
+
+    def test_first_batch_failure_is_plain_500(self):
+        with patch.object(api.MainHTTPHandler, 'stream_min_clients', 3), \
+                patch('store.Store.get_many', side_effect=ConnectionError("down")):
+            response, body = self.post(client_ids=range(5))
+        self.assertEqual(response.status, api.INTERNAL_ERROR)
+        self.assertIsNone(response.getheader("Transfer-Encoding"))
+
+    def test_each_batch_gets_its_own_deadline(self):
+        deadlines = []
+
+        def get_many(keys, deadline=None):
+            deadlines.append(deadline)
+            return [b"['books']"] * len(keys)
+
+        with patch('store.Store.get_many', side_effect=get_many):
+            store = Store().with_deadline(time.monotonic() - 1)
+            batches = list(scoring.iter_interests(store, range(5), batch_size=2, batch_budget=10))
+        self.assertEqual(len(batches), 3)
+        self.assertTrue(all(deadline > time.monotonic() for deadline in deadlines))
+
+    def test_sorted_unique(self):
+        ids = array.array('q', [5, 3, 9, 3, 1, 5, 0])
+        self.assertEqual(list(scoring.sorted_unique(ids, run_size=3)), [0, 1, 3, 5, 9])
+
+    def test_too_large_body_is_refused(self):
+        with patch.object(bench.QuietHandler, "max_body_size", 10):
+            response, body = self.post()
+        self.assertEqual(response.status, api.REQUEST_ENTITY_TOO_LARGE)
+        self.assertEqual(response.getheader("Connection"), "close")
+
+    def test_negative_length_is_refused(self):
+        with socket.create_connection(("localhost", self.port), timeout=5) as sock:
+            sock.sendall(b"POST /method HTTP/1.1\r\nHost: localhost\r\nContent-Length: -1\r\n\r\n{}")
+            data = sock.recv(65536)
+        self.assertTrue(data.startswith(b"HTTP/1.1 400"))
+        self.assertIn(b"Connection: close", data)
+
+
+class TestInterestsCache(unittest.TestCase):
+    def test_etag_is_stable(self):
+        self.assertEqual(scoring.interests_etag({1: ["a"], 2: ["b"]}), scoring.interests_etag({2: ["b"], 1: ["a"]}))
+        self.assertNotEqual(scoring.interests_etag({1: ["a"]}), scoring.interests_etag({1: ["b"]}))
+
+    def test_write_invalidates(self):
+        cache = scoring.InterestsCache()
+        cache.set([2, 1], "value", cache.sequence())
+        self.assertEqual(cache.get([1, 2, 1]), "value")
+        cache.invalidate("i:3")
+        cache.invalidate("rl:a:b:1")
+        self.assertEqual(cache.get([1, 2]), "value")
+        cache.invalidate("i:1")
+        self.assertIsNone(cache.get([1, 2]))
+
+    def test_write_during_fetch_invalidates(self):
+        cache = scoring.InterestsCache()
+        seq = cache.sequence()
+        cache.invalidate("i:1")
+        cache.set([1], "stale", seq)
+        self.assertIsNone(cache.get([1]))
+
+    def test_store_set_notifies_listeners(self):
+        server = FakeRedisServer().start()
+        store = Store(port=server.port)
+        cache = scoring.InterestsCache()
+        store.add_set_listener(cache.invalidate)
+        try:
+            cache.set([1], "value", cache.sequence())
+            scoring.set_interests(store, 1, ["books"])
+            self.assertIsNone(cache.get([1]))
+        finally:
+            store.close()
+            server.stop()
+
+
+class TestLogs(unittest.TestCase):
+    def test_truncate(self):
+        value = {"client_ids": list(range(100)), "name": "x" * 1000, "n": 1}
+        result = logs.truncate(value, max_string=10, max_items=3)
+        self.assertEqual(result["client_ids"], [0, 1, 2, "...(100 items)"])
+        self.assertEqual(result["name"], "xxxxxxxxxx...(1000 chars)")
+        self.assertEqual(result["n"], 1)
+
+    def test_json_formatter(self):
+        record = logging.LogRecord("api.access", logging.INFO, __file__, 1, "request %s", ("ok",), None)
+        record.fields = {"code": 200, "request_id": "abc"}
+        line = json.loads(logs.JSONFormatter().format(record))
+        self.assertEqual((line["msg"], line["code"], line["request_id"], line["level"]),
+                         ("request ok", 200, "abc", "INFO"))
+
+    def test_log_access_samples_successes_only(self):
+        with patch.object(logs.ACCESS_LOGGER, 'log') as log:
+            logs.log_access({"request_id": "1", "response": {"score": 5}}, api.OK, sample_rate=0)
+            log.assert_not_called()
+            logs.log_access({"request_id": "2", "response": {"1": ["books"]}}, api.INVALID_REQUEST, sample_rate=0)
+            logs.log_access({"request_id": "3", "response": {"score": 5}}, api.OK)
+        fields = [call[1]["extra"]["fields"] for call in log.call_args_list]
+        self.assertEqual(fields, [{"request_id": "2", "code": api.INVALID_REQUEST},
+                                  {"request_id": "3", "code": api.OK}])
+
+    def test_full_queue_drops_records(self):
+        handler = logs.DroppingQueueHandler(queue.Queue(1))
+        dropped = logs.DROPPED.value()
+        record = logging.LogRecord("api", logging.INFO, __file__, 1, "message", None, None)
+        handler.emit(record)
+        handler.emit(record)
+        self.assertEqual(handler.queue.qsize(), 1)
+        self.assertEqual(logs.DROPPED.value() - dropped, 1)
+
+
+class TestPrewarm(unittest.TestCase):
+    profiles = [
+        {"phone": "79175002040", "email": "stupnikov@otus.ru", "first_name": "a", "last_name": "b"},
+        {"arguments": {"first_name": "c", "last_name": "d", "gender": 1, "birthday": "01.01.2000"}},
+        {"phone": "123"},
+        {"first_name": "a", "last_name": "b"},
+    ]
+
+    def setUp(self):
+        self.redis_server = FakeRedisServer().start()
+        self.store = Store(port=self.redis_server.port)
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "profiles.jsonl")
+        self.write(self.profiles)
+
+    def tearDown(self):
+        self.store.close()
+        self.redis_server.stop()
+        shutil.rmtree(self.dir)
+
+    def write(self, rows, mode="w"):
+        with open(self.path, mode) as f:
+            for row in rows:
+                f.write(json.dumps(row) + "\n")
+            f.write("\n")
+
+    def test_prewarm_matches_get_score(self):
+        stats = prewarm.prewarm(self.store, self.path, processes=2, chunk_size=2)
+        self.assertEqual((stats["rows"], stats["written"], stats["invalid"]), (4, 3, 1))
+        self.assertEqual(self.store.client.get(scoring.score_key("a", "b")), b"0.5")
+        self.assertEqual(scoring.get_score(DictStore(), None, None, birthday=datetime.datetime(2000, 1, 1), gender=1,
+                                           first_name="c", last_name="d"),
+                         float(self.store.client.get(scoring.score_key("c", "d", datetime.datetime(2000, 1, 1)))))
+        self.assertLessEqual(self.store.client.ttl(scoring.score_key("a", "b")), scoring.SCORE_TTL)
+
+    def test_resume_from_checkpoint(self):
+        checkpoint = os.path.join(self.dir, "checkpoint.json")
+        prewarm.prewarm(self.store, self.path, processes=1, checkpoint=checkpoint)
+        self.write([{"first_name": "e", "last_name": "f"}], mode="a")
+        stats = prewarm.prewarm(self.store, self.path, processes=1, checkpoint=checkpoint)
+        self.assertEqual((stats["resumed_at"], stats["rows"], stats["written"]), (4, 1, 1))
+        self.assertEqual(self.store.client.get(scoring.score_key("e", "f")), b"0.5")
+
+
+def busy_handler(seconds):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        pass
+
+
+class TestProfiler(unittest.TestCase):
+    def test_wants(self):
+        profiler = SamplingProfiler(sample_rate=0, debug_token="secret")
+        self.assertTrue(profiler.wants({DEBUG_HEADER: "secret"}))
+        self.assertFalse(profiler.wants({DEBUG_HEADER: "guess"}))
+        self.assertFalse(profiler.wants({}))
+        self.assertTrue(SamplingProfiler(sample_rate=1).wants({}))
+
+    def test_samples_only_profiled_threads(self):
+        profiler = SamplingProfiler(interval=0.001)
+        context = {}
+
+        def profiled():
+            profiler.begin(context, "method")
+            context["method"] = "online_score"
+            busy_handler(0.1)
+            profiler.end()
+
+        threads = [threading.Thread(target=profiled), threading.Thread(target=busy_handler, args=(0.1,))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        profiler.stop()
+        stacks = profiler.collapsed().splitlines()
+        self.assertTrue(stacks)
+        self.assertTrue(all(line.startswith("online_score;") for line in stacks))
+        self.assertTrue(all("test.py:profiled;test.py:busy_handler" in line for line in stacks))
+        path = profiler.dump(os.path.join(tempfile.mkdtemp(), "profile.collapsed"))
+        with open(path) as f:
+            self.assertEqual(f.read(), profiler.collapsed())
+        shutil.rmtree(os.path.dirname(path))
+
+
+class BlockingHandler(BaseHTTPRequestHandler):
+    started = threading.Event()
+    release = threading.Event()
+
+    def do_GET(self):
+        self.started.set()
+        self.release.wait(5)
+        self.send_response(api.OK)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class RateLimitedHandler(bench.QuietHandler):
+    rate_limiter = RateLimiter(0.001, 1)
+
+
+class TestAdmission(unittest.TestCase):
+    def test_token_bucket(self):
+        limiter = RateLimiter(1, 2, rates={"vip": 100})
+        self.assertEqual([limiter.acquire("a", "b") for _ in range(2)], [0, 0])
+        self.assertGreater(limiter.acquire("a", "b"), 0)
+        self.assertEqual(limiter.acquire("a", "c"), 0)
+        self.assertEqual([limiter.acquire("vip", "b") for _ in range(100)], [0] * 100)
+        # a batch over the burst waits for a full bucket, not for tokens it could never hold
+        self.assertAlmostEqual(limiter.acquire("a", "c", cost=5), 1.0, places=2)
+
+    def test_batch_larger_than_burst(self):
+        limiter = RateLimiter(10)
+        self.assertEqual(limiter.acquire("a", "b", 50), 0)
+        retry_after = limiter.acquire("a", "b", 50)
+        self.assertAlmostEqual(retry_after, 1.0, places=2)
+        with patch("admission.time.monotonic", return_value=time.monotonic() + retry_after):
+            self.assertEqual(limiter.acquire("a", "b", 50), 0)
+
+    def test_limit_keys(self):
+        body = [{"account": "a", "login": "b", "token": "t"}, {"account": "a", "login": "b", "token": "t"},
+                {"login": "c", "token": 1}, "junk"]
+        self.assertEqual(limit_keys(body), {("a", "b", "t"): 2, ("", "c", None): 1})
+        self.assertEqual(limit_keys({"account": "a", "login": "b", "method": "x"}), {("a", "b", None): 1})
+
+    def test_redis_rate_limiter_is_shared(self):
+        server = FakeRedisServer().start()
+        store = Store(port=server.port)
+        try:
+            first, second = RedisRateLimiter(store, 0.01, 3), RedisRateLimiter(store, 0.01, 3)
+            self.assertEqual([first.acquire("a", "b"), second.acquire("a", "b"), first.acquire("a", "b")], [0, 0, 0])
+            self.assertGreater(second.acquire("a", "b"), 0)
+            self.assertEqual(first.acquire("c", "d", 50), 0)
+            with patch.object(store, "incr", side_effect=redis.exceptions.ResponseError("OOM")):
+                self.assertEqual(first.acquire("a", "b"), 0)
+        finally:
+            store.close()
+            server.stop()
+
+    def test_full_queue_is_shed(self):
+        server = PooledHTTPServer(("localhost", 0), BlockingHandler, workers=1, queue_size=1, shed=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        address = ("localhost", server.server_address[1])
+        rejected = admission.REJECTED.value(("overloaded",))
+        try:
+            busy = socket.create_connection(address, timeout=5)
+            busy.sendall(b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            self.assertTrue(BlockingHandler.started.wait(5))
+            queued = socket.create_connection(address, timeout=5)
+            with socket.create_connection(address, timeout=5) as shed:
+                response = shed.recv(65536)
+            self.assertTrue(response.startswith(b"HTTP/1.1 503"))
+            self.assertIn(b"Retry-After: 1", response)
+            self.assertEqual(admission.REJECTED.value(("overloaded",)), rejected + 1)
+        finally:
+            BlockingHandler.release.set()
+            busy.close()
+            queued.close()
+            server.shutdown()
+            server.server_close()
+
+    def test_rate_limited_request_gets_429(self):
+        server = PooledHTTPServer(("localhost", 0), RateLimitedHandler, workers=1)
+        RateLimitedHandler.rate_limiter = RateLimiter(0.001, 1)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "token": "forged",
+                   "arguments": {}}
+        forged = json.dumps(request)
+        request["token"] = hashlib.sha512(("horns&hoofs" + "h&f" + api.SALT).encode('utf-8')).hexdigest()
+        body = json.dumps(request)
+        codes = []
+        failures = api.token_verifier.failures
+        try:
+            # requests with a forged token are rejected without draining the partner's bucket
+            for data in (forged, forged, body, body):
+                connection = http.client.HTTPConnection("localhost", server.server_address[1], timeout=5)
+                connection.request("POST", "/method", data)
+                response = connection.getresponse()
+                response.read()
+                codes.append(response.status)
+                connection.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(codes, [api.FORBIDDEN] * 2 + [api.INVALID_REQUEST, api.TOO_MANY_REQUESTS])
+        # each forged request counts as one auth failure, the limiter's own check isn't one
+        self.assertEqual(api.token_verifier.failures, failures + 2)
+        self.assertEqual(response.getheader("Retry-After"), "1000")
+
+
+class TestBench(unittest.TestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual([bench.percentile(values, q) for q in (50, 95, 99, 99.9)], [50, 95, 99, 100])
+        self.assertEqual(bench.percentile([], 50), 0.0)
+
+    def test_run_against_fake_redis(self):
+        url, stop = bench.start_local_server(workers=2, client_space=100)
+        try:
+            requests = bench.synthesize(20, {"online_score": 1, "clients_interests": 1}, client_space=100)
+            rows = bench.run(url, requests, concurrency=2)
+        finally:
+            stop()
+        total = [row for row in rows if row["group"] == "total"][0]
+        codes = [row["name"] for row in rows if row["group"] == "code"]
+        self.assertEqual(total["count"], 20)
+        self.assertEqual(codes, [api.OK])
+
+
+class TestMicrobench(unittest.TestCase):
+    def test_benchmarks_run(self):
+        for name, fn in microbench.benchmarks().items():
+            fn()
+
+    def test_compare(self):
+        baseline = {"a": 100.0, "b": 100.0}
+        regressions = microbench.compare({"a": 119.0, "b": 121.0, "c": 500.0}, baseline, 0.2)
+        self.assertEqual(regressions, [("b", 100.0, 121.0)])
+
+
+class TestMetrics(unittest.TestCase):
+    def test_render(self):
+        registry = metrics.Registry()
+        counter = registry.counter("requests_total", "Requests", ("method", "code"))
+        histogram = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1))
+        registry.gauge("ratio", "Ratio", lambda: 0.5)
+        counter.inc(("online_score", 200))
+        counter.inc(("online_score", 200))
+        histogram.observe(0.05)
+        histogram.observe(2)
+        text = registry.render()
+        self.assertIn('requests_total{method="online_score",code="200"} 2', text)
+        self.assertIn('latency_seconds_bucket{le="0.1"} 1', text)
+        self.assertIn('latency_seconds_bucket{le="1"} 1', text)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 2', text)
+        self.assertIn('latency_seconds_count 2', text)
+        self.assertIn('ratio 0.5', text)
+        self.assertIn('# TYPE latency_seconds histogram', text)
+
+    def test_metrics_route(self):
+        body, content_type, code = api.metrics_handler(Store())
+        self.assertEqual(code, api.OK)
+        self.assertIn("api_requests_total", body)
+        self.assertTrue(content_type.startswith("text/plain"))
+
 
 @unittest.skip("Slow test")
 class TestWithDatabaseConnection(unittest.TestCase):
@@ -191,10 +1737,10 @@ class TestWithDatabaseConnection(unittest.TestCase):
         self.headers = {}
         self.store = Store()
 
-        self.store.set("i:0", ["books", "hi-tech"])
-        self.store.set("i:1", ["pets", "tv"])
-        self.store.set("i:2", ["travel", "music"])
-        self.store.set("i:3", ["cinema", "geek"])
+        scoring.set_interests(self.store, 0, ["books", "hi-tech"])
+        scoring.set_interests(self.store, 1, ["pets", "tv"])
+        scoring.set_interests(self.store, 2, ["travel", "music"])
+        scoring.set_interests(self.store, 3, ["cinema", "geek"])
 
     def get_response(self, request):
         return api.method_handler({"body": request, "headers": self.headers}, self.context, self.store)